@@ -4,35 +4,465 @@
     This database can then be explored through the GUI program metaview.py
 
     Reads contents of given directory <basedir> and all subdirectories, and kicks off a thread to
-    read each file.
+    read each file in turn, or with --workers N reads them in parallel in a pool of worker processes.
     Looks in either the netcdf/hdf5 files (depending on ftype) to find what variables
     are there and stores the metadata for files, coordinates and variables in the database <database_name>.
     In the case of hdf5 files the names of the coordinates [coord1 coord2...] should be given because there is
     no guarantee that the metadata will be adequate to identify which keys are variables and which are
     coordinates.
 
-    In future the -u option will be implemented so that we can check what is already in the database and
-    make sure it is up to date
+    With the -u option an existing database is brought up to date. The size and modification time of
+    each file found is compared with the Files table and only new or changed files are read. The rows
+    for changed and removed files are deleted and only the variables in those files are rewritten.
+
+    A new build is checkpointed about once a minute: the files completed so far and the variables are
+    saved in Build_ tables in the database. If the build is interrupted, eg. by a batch job reaching its
+    walltime, running again with --resume deletes anything written for files completed after the last
+    checkpoint and carries on from there, only reading the files not already in the database.
 
     Usage:
-    python build_metadata_db.py, <basedir> <filetype> <database_name> <options -u to update -v=verbose [coord1 coord2 coord3...]>)
+    python build_metadata_db.py, <basedir> <filetype> <database_name> <options -u to update --resume -v=verbose --workers N --exclude pattern [coord1 coord2 coord3...]>)
+    python build_metadata_db.py index <database_name>
+
+    The indexes used by metaview to look up the rows for each variable, coord and file are created at the
+    end of the build. The index command adds them to a database built before they were, and runs ANALYZE.
+    It also adds the epoch_min, epoch_max, delta_seconds and is_time columns to the Coords table, which
+    hold the range of each time coordinate as epoch times so metaview doesn't have to convert them,
+    and counts the files and variables in each directory for the Directory menu of metaview.
+
+    The directories are crawled with os.scandir, several at a time, and each file is only stat'ed once.
+    Any file or directory whose path matches a --exclude glob pattern (eg. '*/tmp/*') is skipped, the
+    option can be given more than once.
 
     Uses the threading library to make the building of the database multi-threaded. Kicks off one thread per
     file, but limits the number of threads at any time to 10 otherwise OS cannot handle it.
+    If --workers N is given, the files are instead read by a pool of N worker processes which are kept
+    busy from a queue of files. The workers only extract the metadata and pass it back to this process
+    which assigns the ids, matches coordinates and variables and writes to the database.
+    All the writing to the database is done by a single Db_writer thread which batches the inserts and
+    only commits every few thousand rows.
+    The links between each variable and its files and coordinates are written to the Staged_Links table
+    as each file is read, so the memory used does not grow with the number of files, and are compacted
+    into Coords_Fids_Of_Variables with a few SQL statements at the end.
 
 '''
 
 import sys
 import os
+import time
+import fnmatch
+import collections
+import concurrent.futures
 from read_metadata_thread import *
 
+max_crawl_threads=8 # number of directories scanned at the same time
+
+#-----------------------------------------------------------------------------------
+# check whether a file or directory path matches any of the glob patterns in excludes
+# a directory also matches if its path with a trailing / does so '*/tmp/*' excludes
+# the whole of any tmp directory
+#-----------------------------------------------------------------------------------
+def is_excluded(path, excludes):
+    for pattern in excludes:
+        if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path+'/', pattern):
+            return True
+    return False
+
+#-----------------------------------------------------------------------------------
+# check whether filename has one of the allowed extensions for ftype
+#-----------------------------------------------------------------------------------
+def has_allowed_extension(filename):
+    wsplit=filename.split('.')
+    return len(wsplit)>1 and wsplit[-1] in Read_metadata_thread.allowed_extension
+
+#-----------------------------------------------------------------------------------
+# scan one directory with os.scandir
+# The DirEntry already knows whether each entry is a directory or a symbolic link so
+# the only system calls for each file are one stat and a readlink for symbolic links
+# inputs:
+#    dirpath: the directory to scan
+#    excludes: list of glob patterns of paths to skip
+# returns:
+#    dirpath: the directory scanned
+#    subdirs: the paths of the subdirectories to scan
+#    files: list of (filename, file_stat, symlink) for the files with an allowed extension
+#-----------------------------------------------------------------------------------
+def scan_directory(dirpath, excludes):
+    subdirs=[]
+    files=[]
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if is_excluded(entry.path, excludes):
+                    continue
+                try:
+                    is_dir=entry.is_dir()
+                except OSError:
+                    is_dir=False
+                if is_dir:
+                    # like os.walk, don't go into symbolic links to directories
+                    if entry.is_symlink()==False:
+                        subdirs.append(entry.path)
+                elif has_allowed_extension(entry.name):
+                    symlink=''
+                    try:
+                        if entry.is_symlink():
+                            symlink=os.readlink(entry.path)
+                        file_stat=entry.stat()
+                    except OSError:
+                        file_stat=None  # e.g. a broken link, this will be reported as a bad file when it is read
+                    files.append((entry.name, file_stat, symlink))
+    except OSError as err:
+        warnings.warn('scan_directory(): Cannot read directory {dirpath}, error={err}'.format(dirpath=dirpath, err=err), UserWarning)
+
+    subdirs.sort()
+    files.sort(key=lambda f: f[0])
+    return dirpath, subdirs, files
+
+#-----------------------------------------------------------------------------------
+# crawl the directory structure from basedir, scanning up to nthreads directories at the
+# same time as most of the time is spent waiting for the file system
+# The directories are yielded in the same order (breadth first) however many threads are used
+# and only a limited number are scanned ahead of the one being yielded
+# yields:
+#    dirpath, files - see scan_directory()
+#-----------------------------------------------------------------------------------
+def crawl(basedir, excludes=[], nthreads=max_crawl_threads):
+    max_pending=4*nthreads
+    to_scan=collections.deque([basedir])
+    pending=collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        while len(to_scan)>0 or len(pending)>0:
+            while len(to_scan)>0 and len(pending)<max_pending:
+                pending.append(pool.submit(scan_directory, to_scan.popleft(), excludes))
+            dirpath, subdirs, files=pending.popleft().result()
+            to_scan.extend(subdirs)
+            yield dirpath, files
+
+#-----------------------------------------------------------------------------------
+# crawl through the directory structure from basedir creating a Directories entry for
+# each directory not already in known_dirs and yield each file with an allowed extension
+# inputs:
+#    basedir: the base directory to crawl
+#    known_dirs: dictionary of dirpath to did of the directories already in the database,
+#                new directories are added to it
+#    excludes: list of glob patterns of paths to skip
+# yields:
+#    this_dir, filename, file_stat, symlink - the Directory object, name, os.stat and symbolic
+#                                             link target of each file to read
+#-----------------------------------------------------------------------------------
+def find_files(basedir, known_dirs, excludes=[]):
+    for dirpath, files in crawl(basedir, excludes):
+
+        if dirpath in known_dirs:
+            this_dir=Directory(known_dirs[dirpath],dirpath)
+        else:
+            this_dir=Directory(len(known_dirs),dirpath)
+            known_dirs[dirpath]=this_dir.did
+            Read_metadata_thread.lock.acquire()
+            this_dir.insert_into_database('parent',Read_metadata_thread.writer,Read_metadata_thread.verbose)
+            Read_metadata_thread.writer.commit()
+            Read_metadata_thread.lock.release()
+
+        for filename, file_stat, symlink in files:
+            yield this_dir, filename, file_stat, symlink
+
+#-----------------------------------------------------------------------------------
+# checkpoint the build journal, if there is one, so an interrupted build can be resumed
+# from here. This must only be called when no files are being registered.
+#-----------------------------------------------------------------------------------
+def checkpoint_journal(force=False):
+    if Read_metadata_thread.journal!=None:
+        Read_metadata_thread.journal.checkpoint(Read_metadata_thread.variables, force)
+
+#-----------------------------------------------------------------------------------
+# read the files one at a time, each in its own thread. The netcdf and hdf5 libraries are
+# not thread safe so the files can't be read at the same time; use --workers N to read
+# them in parallel with worker processes.
+# files is an iterable of (this_dir, filename, file_stat, symlink)
+#-----------------------------------------------------------------------------------
+def read_files_with_threads(files):
+    for this_dir, filename, file_stat, symlink in files:
+        thr = Read_metadata_thread(this_dir,filename,file_stat,symlink)
+        thr.start()  # this will call run in Read_metadata_thread
+        thr.join()
+        checkpoint_journal()
+
+#-----------------------------------------------------------------------------------
+# register the File_record returned by a worker process - this is done in this process
+# so the ids are assigned and the database is written by one process only
+#-----------------------------------------------------------------------------------
+def register_result(future, this_dir, filename):
+    registrar=Read_metadata_thread(this_dir, filename)
+    try:
+        record=future.result()
+        registrar.register_record(record)
+    except Exception as err:
+        # don't let one bad file stop the whole build
+        filepath=get_filepath(this_dir.dirpath, filename)
+        warnings.warn('register_result(): Cannot read or register file {filename}, error={err}'.format(filename=filepath, err=err), UserWarning)
+        Read_metadata_thread.lock.acquire()
+        Read_metadata_thread.bad_files.append(filepath)
+        Read_metadata_thread.lock.release()
+
+#-----------------------------------------------------------------------------------
+# read the files using a pool of nworkers processes
+# The pool is kept busy by keeping up to max_pending files queued, as soon as a file has
+# been read another one is submitted so one slow file does not hold up the others
+# files is an iterable of (this_dir, filename, file_stat, symlink)
+#-----------------------------------------------------------------------------------
+def read_files_with_processes(files, nworkers):
+    max_pending=4*nworkers
+    pending={}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, initializer=init_worker,
+                                                initargs=(Read_metadata_thread.ftype, Read_metadata_thread.hdf5_coord_names, Read_metadata_thread.verbose)) as pool:
+        for this_dir, filename, file_stat, symlink in files:
+            future=pool.submit(extract_file_metadata, this_dir, filename, file_stat, symlink)
+            pending[future]=(this_dir, filename)
+            if len(pending)>=max_pending:
+                done, not_done=concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    register_result(future, *pending.pop(future))
+                checkpoint_journal()
+
+        # wait for the rest to finish
+        for future in concurrent.futures.as_completed(list(pending)):
+            register_result(future, *pending.pop(future))
+            checkpoint_journal()
+
+#-----------------------------------------------------------------------------------
+# read the files with worker processes if nworkers>0 otherwise with threads
+#-----------------------------------------------------------------------------------
+def read_files(files, nworkers):
+    if nworkers>0:
+        read_files_with_processes(files, nworkers)
+    else:
+        read_files_with_threads(files)
+
+#-----------------------------------------------------------------------------------
+# read the directories, files and coords already in the database so that new files can
+# be matched against them
+# inputs:
+#    cur: cursor on the database
+# returns:
+#    known_dirs: dictionary of dirpath to did
+#    known_files: dictionary of (dirpath, filename) to File_metadata
+#-----------------------------------------------------------------------------------
+def read_existing_files_and_coords(cur):
+    dirpaths=read_all_directories(cur)
+    known_dirs={dirpath:did for did, dirpath in enumerate(dirpaths)}
+
+    known_files={}
+    for row in cur.execute("""SELECT fid, did, filename, symlink, created, modified, size FROM Files""").fetchall():
+        this_file=File_metadata(row, cur)
+        known_files[(dirpaths[this_file.did], this_file.filename)]=this_file
+        Read_metadata_thread.nfiles=max(Read_metadata_thread.nfiles, this_file.fid+1)
+
+    # the cids are the indices into coords
+    for this_coord in read_coords_in_bulk(cur):
+        if this_coord.cid!=len(Read_metadata_thread.coords):
+            raise ValueError(f'read_existing_files_and_coords(): unexpected coord id {this_coord.cid}')
+        Read_metadata_thread.add_coord(this_coord)
+
+    return known_dirs, known_files
+
+#-----------------------------------------------------------------------------------
+# read what is already in the database when updating so that new files can be matched
+# against the existing coords and variables
+# inputs:
+#    cur: cursor on the database
+# returns:
+#    known_dirs: dictionary of dirpath to did
+#    known_files: dictionary of (dirpath, filename) to File_metadata
+#-----------------------------------------------------------------------------------
+def read_existing_db(cur):
+    add_file_size_column(cur)
+    add_coord_epoch_columns(cur)
+    known_dirs, known_files=read_existing_files_and_coords(cur)
+
+    # the vids are the indices into variables, but variables may have been deleted by an
+    # earlier update when all their files were removed so fill any gaps with empty variables
+    for this_var in read_variables_in_bulk(cur, select_all_variables(cur), Read_metadata_thread.verbose):
+        while len(Read_metadata_thread.variables)<this_var.vid:
+            Read_metadata_thread.variables.append(Variable_metadata(len(Read_metadata_thread.variables), '', 0))
+        this_var.prepare_for_update()
+        Read_metadata_thread.add_variable(this_var)
+
+    return known_dirs, known_files
+
+#-----------------------------------------------------------------------------------
+# the settings which must be the same when an interrupted build is resumed, they are saved in
+# the Build_Settings table. The exclude patterns are saved sorted, one on each line
+#-----------------------------------------------------------------------------------
+def get_build_settings(basedir, ftype, excludes):
+    return {'basedir':basedir, 'ftype':ftype, 'excludes':'\n'.join(sorted(set(excludes)))}
+
+#-----------------------------------------------------------------------------------
+# read the state of an interrupted build back from the database at its last checkpoint,
+# anything written for files completed after the checkpoint is deleted first
+# inputs:
+#    cur: cursor on the database
+#    settings: dictionary of the settings of this build which must match those of the
+#              interrupted build
+# returns:
+#    known_dirs: dictionary of dirpath to did
+#    known_files: dictionary of (dirpath, filename) to File_metadata of the completed files
+#-----------------------------------------------------------------------------------
+def read_interrupted_build(cur, settings):
+    journal_settings=read_journal_settings(cur)
+    if journal_settings!=settings:
+        print('cannot resume, the interrupted build used', journal_settings, 'not', settings)
+        exit()
+    nincomplete=delete_incomplete_files(cur)
+    known_dirs, known_files=read_existing_files_and_coords(cur)
+
+    links_summary=read_staged_links_summary(cur)
+    for this_var in read_journal_variables(cur):
+        nfids, dim_cids=links_summary.get(this_var.vid, (0, [[] for d in range(this_var.ndims)]))
+        this_var.set_links_summary(nfids, dim_cids)
+        # a variable only seen in files that were not completed is kept so the vids
+        # stay the indices into variables, but it can't be matched
+        if nfids>0:
+            Read_metadata_thread.add_variable(this_var)
+        else:
+            Read_metadata_thread.variables.append(this_var)
+    print('resuming build with', len(known_files), 'files already read,', nincomplete, 'incomplete files will be read again')
+    return known_dirs, known_files
+
+#-----------------------------------------------------------------------------------
+# compare the files found in basedir with the files already in the database
+# inputs:
+#    basedir: the base directory to trawl
+#    known_dirs: dictionary of dirpath to did of the directories in the database
+#    known_files: dictionary of (dirpath, filename) to File_metadata of the files in the database
+#    excludes: list of glob patterns of paths to skip, files in the database which are now
+#              excluded are removed
+# returns:
+#    files_to_read: list of (this_dir, filename, file_stat, symlink) for the new and changed files
+#    changed_fids: the fids of files whose size or modification time has changed
+#    removed_fids: the fids of files which no longer exist
+#    changed_paths: set of the full paths of the changed files
+#-----------------------------------------------------------------------------------
+def find_changed_files(basedir, known_dirs, known_files, excludes=[]):
+    files_to_read=[]
+    changed_fids=[]
+    changed_paths=set()
+    for this_dir, filename, file_stat, symlink in find_files(basedir, known_dirs, excludes):
+        old_file=known_files.pop((this_dir.dirpath, filename), None)
+        if old_file!=None:
+            # if file_stat is None (e.g. a broken link) read it again so it is reported as a bad file
+            if file_stat!=None and file_stat.st_mtime==old_file.modified:
+                if old_file.size==None:
+                    # database was created before sizes were stored
+                    Read_metadata_thread.writer.execute("""UPDATE Files SET size=? WHERE fid=?""", (file_stat.st_size, old_file.fid))
+                    continue
+                elif file_stat.st_size==old_file.size:
+                    continue
+            changed_fids.append(old_file.fid)
+            changed_paths.add(get_filepath(this_dir.dirpath, filename))
+        files_to_read.append((this_dir, filename, file_stat, symlink))
+
+    # any files left have been removed
+    removed_fids=[this_file.fid for this_file in known_files.values()]
+    return files_to_read, changed_fids, removed_fids, changed_paths
+
+#-----------------------------------------------------------------------------------
+# remove the files fids from the variables and delete their rows from the Files and
+# Global_Attributes tables
+# The links of the variables in these files are copied to the Staged_Links table without
+# the removed files, so they can be matched against the new files and compacted again at the end
+# returns:
+#    the vids of the variables whose links have been staged
+#-----------------------------------------------------------------------------------
+def remove_files(fids):
+    cur=Read_metadata_thread.cur
+    # make sure the writer has finished before writing with the cursor
+    Read_metadata_thread.writer.flush()
+    vids=select_vids_of_fids(cur, fids)
+    expand_links_to_staging(cur, vids, fids)
+    delete_rows(cur, 'Files', 'fid', fids)
+    delete_rows(cur, 'Global_Attributes', 'fid', fids)
+    Read_metadata_thread.con.commit()
+
+    summary=read_staged_links_summary(cur)
+    for vid in vids:
+        this_var=Read_metadata_thread.variables[vid]
+        nfids, dim_cids=summary.get(vid, (0, {}))
+        this_var.set_links_summary(nfids, [dim_cids.get(d, []) for d in range(this_var.ndims)])
+        Read_metadata_thread.changed_vids.add(vid)
+        if nfids==0:
+            # no files left so nothing should match it
+            Read_metadata_thread.variable_index[this_var.get_bucket_key()].remove(vid)
+    return vids
+
+#-----------------------------------------------------------------------------------
+# rewrite the variables that were already in the database and have had files added or
+# removed and insert the new ones, the other variables are left alone
+# This is done with the cursor after the writer has finished
+# inputs:
+#    nvars_before: the number of variables read from the database
+#    staged_vids: the vids of the variables whose links were staged by remove_files()
+#-----------------------------------------------------------------------------------
+def write_updated_variables(nvars_before, staged_vids):
+    cur=Read_metadata_thread.cur
+    changed_vids=sorted([vid for vid in Read_metadata_thread.changed_vids if vid<nvars_before])
+    # variables which have only had files added need their existing links staged too
+    staged_vids=set(staged_vids)
+    expand_links_to_staging(cur, [vid for vid in changed_vids if vid not in staged_vids])
+    for table in ['Variables', 'Var_Attributes', 'Coords_Fids_Of_Variables']:
+        delete_rows(cur, table, 'vid', changed_vids)
+    for vid in changed_vids+list(range(nvars_before, len(Read_metadata_thread.variables))):
+        this_var=Read_metadata_thread.variables[vid]
+        # variables with no files left are not written
+        if this_var.get_nfiles()>0:
+            this_var.insert_into_database('parent',cur,Read_metadata_thread.verbose)
+
+#-----------------------------------------------------------------------------------
+# code to update an existing database with the files in basedir
+# only new and changed files are read
+#-----------------------------------------------------------------------------------
+def update_db(basedir, known_dirs, known_files, nworkers, excludes=[]):
+    start_time=time.time()
+    nvars_before=len(Read_metadata_thread.variables)
+    nfiles_before=len(known_files)
+    files_to_read, changed_fids, removed_fids, changed_paths=find_changed_files(basedir, known_dirs, known_files, excludes)
+    if Read_metadata_thread.verbose:
+        print('update_db():', len(files_to_read), 'files to read', len(changed_fids), 'changed', len(removed_fids), 'removed')
+
+    # remove the old versions of changed files before reading the new versions
+    staged_vids=remove_files(changed_fids+removed_fids)
+    read_files(files_to_read, nworkers)
+    Read_metadata_thread.writer.close()
+    write_updated_variables(nvars_before, staged_vids)
+    compact_staged_links(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+    # databases built before there were indexes get them now
+    create_indexes(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+    create_text_index(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+    create_directory_counts(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+    Read_metadata_thread.con.commit()
+
+    # files which could not be read are not in the database, a changed file which can no longer be read
+    # has had its old entry removed
+    bad_files=set(Read_metadata_thread.bad_files)
+    nchanged=len(changed_paths-bad_files)
+    nadded=len(files_to_read)-len(changed_paths)-len(bad_files-changed_paths)
+    nremoved=len(removed_fids)
+    nunchanged=nfiles_before-len(changed_fids)-nremoved
+    print('Updated in {t:.1f} seconds: {a} files added, {c} changed, {r} removed and {u} unchanged'.format(
+          t=time.time()-start_time, a=nadded, c=nchanged, r=nremoved, u=nunchanged))
+    print('{b} files could not be read, {c} of them were changed files whose old entries have been removed'.format(
+          b=len(bad_files), c=len(changed_paths & bad_files)))
+
 #-----------------------------------------------------------------------------------
 # code to build the database from the metadata of files of type ftype in basedir
 # inputs:
 #    basedir: the base directory to trawl
 #    dbname: the full path and filename of the database
+#    nworkers: if >0 use a pool of this many processes to read the files, otherwise use threads
+#    excludes: list of glob patterns of files and directories to skip eg. '*/tmp/*'
+#    resume: if True carry on with a build of dbname that was interrupted
 # -----------------------------------------------------------------------------------
-def build_db(basedir,dbname):
+def build_db(basedir,dbname,nworkers=0,excludes=[],resume=False):
 
     # open the database dbname - this will create it if it does not exist
     Read_metadata_thread.con = sqlite3.connect(dbname,check_same_thread=False)
@@ -41,76 +471,122 @@ def build_db(basedir,dbname):
     res = Read_metadata_thread.cur.execute("SELECT name FROM sqlite_master")
     db_exists=False
     table_names=res.fetchall()
+    # a build that was interrupted leaves its journal in the database
+    interrupted=('Build_Progress',) in table_names
     if len(table_names)>0:
         print(table_names)
         db_exists=True
-        if Read_metadata_thread.update==False:
+        if interrupted and resume==False:
+            print('the build of', dbname, 'did not finish, use --resume to carry on with it')
+            exit()
+        if Read_metadata_thread.update==False and resume==False:
             print(dbname, 'already exists')
             exit()
-        else:
-            res=Read_metadata_thread.cur.execute("""SELECT name FROM Variables""").fetchone()
-            if len(res)>0:
-                print('update not yet handled')
-                exit()
-
+    if resume and interrupted==False:
+        print(dbname, 'has no interrupted build to resume')
+        exit()
 
+    settings=get_build_settings(basedir, Read_metadata_thread.ftype, excludes)
+    known_dirs={}
+    known_files={}
     if db_exists==False:
         create_tables(Read_metadata_thread.cur, verbose=Read_metadata_thread.verbose)
+        create_journal_tables(Read_metadata_thread.cur, settings)
+    elif resume:
+        known_dirs, known_files=read_interrupted_build(Read_metadata_thread.cur, settings)
+    else:
+        known_dirs, known_files=read_existing_db(Read_metadata_thread.cur)
+    # the links between variables, files and coords are written to a staging table as the files are read
+    create_staging_table(Read_metadata_thread.cur)
+    Read_metadata_thread.con.commit()
 
-    ndirs=0    
-
-    # now trawl through the directory structure from basedir
-    if Read_metadata_thread.verbose:
-        print('trawling directory', basedir, 'for', Read_metadata_thread.ftype)
-    max_threads=10
-    threads=[]
-    for dirpath, dirnames, filenames in os.walk(basedir):
-
-        this_dir=Directory(ndirs,dirpath)
-        Read_metadata_thread.lock.acquire()
-        this_dir.insert_into_database('parent',Read_metadata_thread.cur,Read_metadata_thread.verbose)
-        Read_metadata_thread.con.commit()
-        ndirs=ndirs+1
-        Read_metadata_thread.lock.release()
-
-        for filename in filenames:
-            wsplit=filename.split('.')
-            if len(wsplit)>1:
-                if wsplit[-1] in Read_metadata_thread.allowed_extension:
-
-                    thr = Read_metadata_thread(this_dir,filename)
-                    threads.append(thr)
-                    thr.start()  # this will call run in Read_metadata_thread
-
-            if len(threads)==max_threads:
-                # wait till threads finish
-                for x in threads: 
-                    x.join()
-                threads.clear()
+    # all the writing is done by the writer thread
+    Read_metadata_thread.writer=Db_writer(dbname, verbose=Read_metadata_thread.verbose)
+    Read_metadata_thread.writer.start()
 
-    # wait till threads finish
-    for x in threads: 
-        x.join()
+    try:
+        # now trawl through the directory structure from basedir
+        if Read_metadata_thread.verbose:
+            print('trawling directory', basedir, 'for', Read_metadata_thread.ftype)
+        if db_exists and resume==False:
+            update_db(basedir, known_dirs, known_files, nworkers, excludes)
+        else:
+            # a new build is checkpointed so it can be resumed if it is interrupted
+            Read_metadata_thread.journal=Build_journal(Read_metadata_thread.writer, verbose=Read_metadata_thread.verbose)
+            files=(f for f in find_files(basedir, known_dirs, excludes) if (f[0].dirpath, f[1]) not in known_files)
+            read_files(files, nworkers)
 
-    for this_var in Read_metadata_thread.variables:
-        this_var.insert_into_database('parent',Read_metadata_thread.cur,Read_metadata_thread.verbose)
-    # commit the changes
-    Read_metadata_thread.con.commit()
+            for this_var in Read_metadata_thread.variables:
+                if this_var.get_nfiles()>0:
+                    this_var.insert_into_database('parent',Read_metadata_thread.writer,Read_metadata_thread.verbose)
+            # commit the changes and wait for the writer to finish
+            Read_metadata_thread.writer.close()
+            compact_staged_links(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+            drop_journal_tables(Read_metadata_thread.cur)
+            create_indexes(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+            create_text_index(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+            create_directory_counts(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+            Read_metadata_thread.con.commit()
+    finally:
+        # the writer is not a daemon thread so if the build fails python would wait for it forever
+        if Read_metadata_thread.writer.is_alive():
+            Read_metadata_thread.writer.close()
+    ndirs=Read_metadata_thread.cur.execute("""SELECT COUNT(*) FROM Directories""").fetchone()[0]
+    nfiles=Read_metadata_thread.cur.execute("""SELECT COUNT(*) FROM Files""").fetchone()[0]
+    nvars=Read_metadata_thread.cur.execute("""SELECT COUNT(*) FROM Variables""").fetchone()[0]
     Read_metadata_thread.con.close()
 
-    print(ndirs, 'Directories', Read_metadata_thread.nfiles, 'Files', len(Read_metadata_thread.coords), 'Coords and', len(Read_metadata_thread.variables), 'Variables created')
+    print(ndirs, 'Directories', nfiles, 'Files', len(Read_metadata_thread.coords), 'Coords and', nvars, 'Variables in database')
     if len(Read_metadata_thread.bad_files)>0:
         print('Unable to read the following files')
     for bad in Read_metadata_thread.bad_files:
         print(bad)
 
+#-----------------------------------------------------------------------------------
+# bring a database built with an older version up to date: add the indexes, the full-text index of the
+# attributes, the directory counts and the epoch columns of the Coords table and run ANALYZE so sqlite
+# can choose the best index for each query
+#-----------------------------------------------------------------------------------
+def index_db(dbname):
+    if os.path.exists(dbname)==False:
+        print(dbname, 'does not exist')
+        exit()
+    start_time=time.time()
+    con=sqlite3.connect(dbname)
+    cur=con.cursor()
+    table_names=[row[0] for row in cur.execute("""SELECT name FROM sqlite_master WHERE type='table'""").fetchall()]
+    if 'Variables' not in table_names:
+        print(dbname, 'is not a metadata database')
+        exit()
+    if 'Build_Progress' in table_names or 'Staged_Links' in table_names:
+        print('the build of', dbname, 'did not finish, use --resume to carry on with it')
+        exit()
+    ncoords=add_coord_epoch_columns(cur)
+    if ncoords>0:
+        print('Added the epoch times of', ncoords, 'coords')
+    create_indexes(cur, verbose=True)
+    create_text_index(cur, verbose=True)
+    create_directory_counts(cur, verbose=True)
+    cur.execute("ANALYZE")
+    con.commit()
+    con.close()
+    print('Indexed {dbname} in {t:.1f} seconds'.format(dbname=dbname, t=time.time()-start_time))
+
 # -----------------------------------------------------------------------------------
-# main - read the arguments and call build_db
+# main - read the arguments and call build_db, or index_db for the index command
 # -----------------------------------------------------------------------------------
 def main():
 
+    if len(sys.argv)>1 and sys.argv[1]=='index':
+        if len(sys.argv)!=3:
+            print('usage:', sys.argv[0], 'index <database_name>')
+            exit()
+        index_db(sys.argv[2])
+        return
+
     if len(sys.argv)<4:
-        print('usage:', sys.argv[0], '<basedir> <filetype (nc/hdf5)> <database_name> <options eg -u to update, -v=verbose> <[coord1 coord2 coord3...]')
+        print('usage:', sys.argv[0], '<basedir> <filetype (nc/hdf5)> <database_name> <options eg -u to update, --resume, -v=verbose, --workers N, --exclude pattern> <[coord1 coord2 coord3...]')
+        print('   or:', sys.argv[0], 'index <database_name>')
         exit()
     else:
         basedir=sys.argv[1]
@@ -119,21 +595,41 @@ def main():
             exit()
 
         dbname=sys.argv[3]
-        for i in range(4,len(sys.argv)):
+        nworkers=0
+        excludes=[]
+        resume=False
+        i=4
+        while i<len(sys.argv):
             if sys.argv[i]=='-u':
                 Read_metadata_thread.update=True
+            elif sys.argv[i]=='--resume':
+                resume=True
             elif sys.argv[i]=='-v':
                 Read_metadata_thread.verbose=True
+            elif sys.argv[i]=='--workers':
+                i+=1
+                if i==len(sys.argv) or sys.argv[i].isdigit()==False or int(sys.argv[i])<1:
+                    print('--workers must be followed by the number of worker processes')
+                    exit()
+                nworkers=int(sys.argv[i])
+            elif sys.argv[i]=='--exclude':
+                i+=1
+                if i==len(sys.argv):
+                    print('--exclude must be followed by a glob pattern eg. \'*/tmp/*\'')
+                    exit()
+                excludes.append(sys.argv[i])
             else:
                 Read_metadata_thread.hdf5_coord_names.append(sys.argv[i])
+            i+=1
         if len(Read_metadata_thread.hdf5_coord_names)==0 and Read_metadata_thread.ftype=='hdf5':
             print('coordinate names must be given')
             exit()
 
-        if Read_metadata_thread.update==True:
-            print('update not yet implemented')
+    if resume and Read_metadata_thread.update:
+        print('-u and --resume cannot be used together, resume the build first')
+        exit()
 
-    build_db(basedir,dbname)
+    build_db(basedir,dbname,nworkers,excludes,resume)
 
 
 
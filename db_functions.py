@@ -19,10 +19,16 @@ import numpy as np
 import datetime as dt
 import os
 import string
+import re
+import threading
+import queue
+import time
+from urllib.request import pathname2url
 
 FILE_SPECIFIC_VAL='File specific'  # used to set the value of an attribute that we don't really care about
                                    # and is different for different variables in different files
 UNKNOWN_ID=-1
+COORD_TOLERANCE=1e-6 # coordinate values closer than this are treated as the same
 
 #--------------------------------------------------------------------------------------------
 # create all the tables we need to store metadata
@@ -31,15 +37,345 @@ def create_tables(cur,verbose=False):
     if verbose:
         print('Creating tables')
     cur.execute("CREATE TABLE Directories(did INTEGER PRIMARY KEY, dirpath TEXT)")
-    cur.execute("CREATE TABLE Files(fid INTEGER PRIMARY KEY, did INTEGER, filename TEXT, symlink TEXT, created REAL, modified REAL)")
+    cur.execute("CREATE TABLE Files(fid INTEGER PRIMARY KEY, did INTEGER, filename TEXT, symlink TEXT, created REAL, modified REAL, size INTEGER)")
     cur.execute("CREATE TABLE Global_Attributes(fid INTEGER, name TEXT, value)")
-    cur.execute("CREATE TABLE Coords(cid INTEGER PRIMARY KEY, name TEXT, nvals INTEGER, min_val REAL, max_val REAL, delta REAL)")
+    # epoch_min, epoch_max and delta_seconds are the range of time coordinates (is_time=1) converted to epoch
+    # times when the coord is created so they don't have to be converted every time the coords are filtered
+    cur.execute("CREATE TABLE Coords(cid INTEGER PRIMARY KEY, name TEXT, nvals INTEGER, min_val REAL, max_val REAL, delta REAL, epoch_min REAL, epoch_max REAL, delta_seconds REAL, is_time INTEGER)")
     cur.execute("CREATE TABLE Discrete_Coord_Values(cid INTEGER, value REAL)")
     cur.execute("CREATE TABLE Coord_Attributes(cid INTEGER, name TEXT, value)")
     cur.execute("CREATE TABLE Variables(vid INTEGER PRIMARY KEY, name TEXT, ndims INTEGER)")
     cur.execute("CREATE TABLE Coords_Fids_Of_Variables(vid INTEGER, cid INTEGER, fid INTEGER, dimix INTEGER)")
     cur.execute("CREATE TABLE Var_Attributes(vid INTEGER, name TEXT, value)")
 
+#--------------------------------------------------------------------------------------------
+# The indexes used to find the rows for a variable, coord or file. They are created at the end
+# of building the database by create_indexes() rather than with the tables, so they don't slow
+# down the inserts. The index of Coords_Fids_Of_Variables by vid holds all the columns so the
+# links of a variable are read from the index alone and come out in dimix, fid order.
+# The attribute and discrete value indexes only hold the id so the rows for an id still come
+# out in the order they were inserted.
+# The indexes of Files by filename let a filename pattern that starts with fixed characters, eg. 'era5_*',
+# be found with a range search of the index (see get_filename_condition()).
+#--------------------------------------------------------------------------------------------
+index_definitions=[
+    ("Coords_Fids_Of_Variables_vid", "Coords_Fids_Of_Variables(vid, dimix, fid, cid)"),
+    ("Coords_Fids_Of_Variables_fid", "Coords_Fids_Of_Variables(fid, vid)"),
+    ("Var_Attributes_vid", "Var_Attributes(vid)"),
+    ("Coord_Attributes_cid", "Coord_Attributes(cid)"),
+    ("Discrete_Coord_Values_cid", "Discrete_Coord_Values(cid)"),
+    ("Global_Attributes_fid", "Global_Attributes(fid)"),
+    ("Files_did_filename", "Files(did, filename)"),
+    ("Files_filename", "Files(filename)"),
+    ("Variables_name", "Variables(name)"),
+    ]
+
+def create_indexes(cur, verbose=False):
+    for name, definition in index_definitions:
+        if verbose:
+            print('Creating index', name, 'on', definition)
+        cur.execute("CREATE INDEX IF NOT EXISTS "+name+" ON "+definition)
+
+#--------------------------------------------------------------------------------------------
+# The text attributes of the variables, coords and files are also put in an SQLite FTS5 full-text
+# index, Attribute_Text, so they can be searched for words by search_attribute_text(). kind is
+# 'variable', 'coord' or 'file' and id is the vid, cid or fid. Only the value is indexed.
+# The index is made again from the attribute tables each time so it is always up to date.
+# returns:
+#    True if the index was made, False if this sqlite does not have FTS5
+#--------------------------------------------------------------------------------------------
+text_index_sources=[
+    ('variable', 'vid', 'Var_Attributes'),
+    ('coord', 'cid', 'Coord_Attributes'),
+    ('file', 'fid', 'Global_Attributes'),
+    ]
+
+def create_text_index(cur, verbose=False):
+    if verbose:
+        print('Creating full-text index of attributes')
+    cur.execute("DROP TABLE IF EXISTS Attribute_Text")
+    try:
+        cur.execute("CREATE VIRTUAL TABLE Attribute_Text USING fts5(value, name UNINDEXED, kind UNINDEXED, id UNINDEXED)")
+    except sqlite3.OperationalError as err:
+        print('Cannot create full-text index of attributes, error=', err)
+        return False
+    for kind, id_column, table in text_index_sources:
+        cur.execute("INSERT INTO Attribute_Text (value, name, kind, id) SELECT value, name, ?, "+id_column+
+                    " FROM "+table+" WHERE typeof(value)='text'", (kind,))
+    return True
+
+def has_text_index(cur):
+    return cur.execute("""SELECT COUNT(*) FROM sqlite_master WHERE name='Attribute_Text'""").fetchone()[0]>0
+
+#--------------------------------------------------------------------------------------------
+# The number of files and variables in each directory are kept in the Directory_Counts table for the
+# Directory menu of metaview, so they don't have to be counted each time it starts. Like the text index
+# the table is made again from the Files and Coords_Fids_Of_Variables tables each time.
+#--------------------------------------------------------------------------------------------
+def create_directory_counts(cur, verbose=False):
+    if verbose:
+        print('Counting the files and variables in each directory')
+    cur.execute("DROP TABLE IF EXISTS Directory_Counts")
+    cur.execute("CREATE TABLE Directory_Counts(did INTEGER PRIMARY KEY, nfiles INTEGER, nvariables INTEGER)")
+    cur.execute("""INSERT INTO Directory_Counts (did, nfiles, nvariables)
+                   SELECT d.did, (SELECT COUNT(*) FROM Files f WHERE f.did=d.did),
+                          (SELECT COUNT(DISTINCT l.vid) FROM Files f JOIN Coords_Fids_Of_Variables l ON l.fid=f.fid WHERE f.did=d.did)
+                   FROM Directories d""")
+
+#--------------------------------------------------------------------------------------------
+# read the counts made by create_directory_counts(), for a database without them only the files are counted
+# returns:
+#    dictionary of did to (nfiles, nvariables) where nvariables is None if it was not counted
+#--------------------------------------------------------------------------------------------
+def read_directory_counts(cur):
+    if cur.execute("""SELECT COUNT(*) FROM sqlite_master WHERE name='Directory_Counts'""").fetchone()[0]>0:
+        return {did:(nfiles, nvariables) for did, nfiles, nvariables in cur.execute("""SELECT did, nfiles, nvariables FROM Directory_Counts""")}
+    return {did:(nfiles, None) for did, nfiles in cur.execute("""SELECT did, COUNT(*) FROM Files GROUP BY did""")}
+
+#--------------------------------------------------------------------------------------------
+# Thread that does all the writing to the database when building it.
+# It looks like a cursor to the insert_into_database() functions as it has execute() and executemany()
+# but these just add the rows to a buffer. commit() passes the buffer to the writer thread on a queue.
+# The buffer is not limited itself but commit() is called after each file is registered so it only holds
+# the rows of the files being registered at the time.
+# The writer thread has its own connection and uses executemany for each batch, but only commits the
+# transaction when commit_rows rows have been written or commit_seconds have passed since the last commit.
+# This means we don't have an fsync for every file which is slow, particularly on NFS.
+# Rows for the same table are written in the order they were given which matters for
+# Coords_Fids_Of_Variables.
+#--------------------------------------------------------------------------------------------
+class Db_writer(threading.Thread):
+
+    def __init__(self, dbname, commit_rows=10000, commit_seconds=5.0, verbose=False):
+        threading.Thread.__init__(self, name='Db_writer')
+        self.dbname=dbname
+        self.commit_rows=commit_rows
+        self.commit_seconds=commit_seconds
+        self.verbose=verbose
+        self.queue=queue.Queue(maxsize=1000) # limit the number of batches waiting so we don't run out of memory
+        self.buffer_lock=threading.Lock()
+        self.buffer={}    # dictionary of sql to a list of rows waiting to be sent to the writer
+        self.nrows=0      # number of rows written
+        self.ncommits=0
+        self.error=None   # set if the writer thread fails
+
+    #---------------------------------------------------------------------------------------
+    # add a row to the buffer - the row is not written until commit() is called
+    #---------------------------------------------------------------------------------------
+    def execute(self, sql, row=()):
+        self.executemany(sql, [row])
+
+    def executemany(self, sql, rows):
+        self.buffer_lock.acquire()
+        if sql in self.buffer:
+            self.buffer[sql].extend(rows)
+        else:
+            self.buffer[sql]=list(rows)
+        self.buffer_lock.release()
+
+    #---------------------------------------------------------------------------------------
+    # pass the rows in the buffer to the writer thread
+    # the rows are committed to the database when the writer thread decides
+    #---------------------------------------------------------------------------------------
+    def commit(self):
+        self.check_error()
+        self.buffer_lock.acquire()
+        batch=self.buffer
+        self.buffer={}
+        self.buffer_lock.release()
+        if len(batch)>0:
+            self.queue.put(('rows', batch))
+
+    #---------------------------------------------------------------------------------------
+    # wait until all the rows given so far have been committed to the database
+    #---------------------------------------------------------------------------------------
+    def flush(self):
+        self.commit()
+        done=threading.Event()
+        self.queue.put(('flush', done))
+        while done.wait(timeout=1)==False:
+            self.check_error()
+        self.check_error()
+
+    #---------------------------------------------------------------------------------------
+    # commit everything and stop the writer thread
+    #---------------------------------------------------------------------------------------
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            # the thread is always stopped, even if writing failed
+            self.queue.put(('close', None))
+            self.join()
+        self.check_error()
+        if self.verbose:
+            print('Db_writer.close():', self.nrows, 'rows written in', self.ncommits, 'commits')
+
+    def check_error(self):
+        if self.error!=None:
+            raise RuntimeError('Db_writer: failed writing to database '+self.dbname) from self.error
+
+    #---------------------------------------------------------------------------------------
+    # the writer thread - write each batch as it arrives and commit every commit_rows rows
+    # or commit_seconds seconds
+    #---------------------------------------------------------------------------------------
+    def run(self):
+        con=sqlite3.connect(self.dbname)
+        cur=con.cursor()
+        nuncommitted=0
+        last_commit=time.time()
+        while True:
+            try:
+                message, data=self.queue.get(timeout=self.commit_seconds)
+            except queue.Empty:
+                message, data=(None, None)
+            if self.error==None:
+                try:
+                    if message=='rows':
+                        for sql in data:
+                            cur.executemany(sql, data[sql])
+                            nuncommitted+=len(data[sql])
+                    if nuncommitted>0 and (message!='rows' or nuncommitted>=self.commit_rows or time.time()-last_commit>=self.commit_seconds):
+                        con.commit()
+                        self.nrows+=nuncommitted
+                        self.ncommits+=1
+                        nuncommitted=0
+                        last_commit=time.time()
+                except Exception as err:
+                    # keep reading the queue so nothing waiting on it blocks, the error is raised by check_error()
+                    self.error=err
+            if message=='flush':
+                data.set()
+            elif message=='close':
+                break
+        con.close()
+
+#--------------------------------------------------------------------------------------------
+# Rows kept back while one file is registered so that they are only given to the Db_writer once
+# the whole file has been registered, see Read_metadata_thread.register_record(). Like Db_writer
+# it looks like a cursor to the insert_into_database() functions.
+#--------------------------------------------------------------------------------------------
+class Row_buffer:
+
+    def __init__(self):
+        self.buffer={} # dictionary of sql to a list of rows
+
+    def execute(self, sql, row=()):
+        self.executemany(sql, [row])
+
+    def executemany(self, sql, rows):
+        if sql in self.buffer:
+            self.buffer[sql].extend(rows)
+        else:
+            self.buffer[sql]=list(rows)
+
+    # give the rows to cur, usually the Db_writer, in the order they were added for each table
+    def write_to(self, cur):
+        for sql in self.buffer:
+            cur.executemany(sql, self.buffer[sql])
+
+#--------------------------------------------------------------------------------------------
+# Journal of the progress of building a database so that a build which is killed can be resumed.
+# At each checkpoint the fids of the files completed since the last checkpoint are added to the
+# Build_Progress table and the variables are saved in Build_Variables and Build_Var_Attributes. The links
+# between the variables, files and coords are already in Staged_Links. The checkpoint is passed to the
+# Db_writer as one batch so it is committed together with everything written before it.
+# Files in the Files table but not in Build_Progress had not been completed and are deleted on resuming.
+# checkpoint() must only be called when no files are part way through being registered.
+#--------------------------------------------------------------------------------------------
+class Build_journal:
+
+    def __init__(self, writer, checkpoint_seconds=60, verbose=False):
+        self.writer=writer
+        self.checkpoint_seconds=checkpoint_seconds
+        self.verbose=verbose
+        self.lock=threading.Lock()
+        self.completed_fids=[]  # files completed since the last checkpoint
+        self.last_checkpoint=time.time()
+        self.ncheckpoints=0
+
+    #---------------------------------------------------------------------------------------
+    # called when all the metadata of file fid has been passed to the writer
+    #---------------------------------------------------------------------------------------
+    def file_completed(self, fid):
+        self.lock.acquire()
+        self.completed_fids.append(fid)
+        self.lock.release()
+
+    #---------------------------------------------------------------------------------------
+    # save the variables and the completed files if checkpoint_seconds have passed since the
+    # last checkpoint or force is True
+    #---------------------------------------------------------------------------------------
+    def checkpoint(self, variables, force=False):
+        if force==False and time.time()-self.last_checkpoint<self.checkpoint_seconds:
+            return
+        # start a new batch so the checkpoint is written together
+        self.writer.commit()
+        self.lock.acquire()
+        fids=self.completed_fids
+        self.completed_fids=[]
+        self.lock.release()
+        self.writer.execute("""DELETE FROM Build_Variables""")
+        self.writer.execute("""DELETE FROM Build_Var_Attributes""")
+        self.writer.executemany("""INSERT INTO Build_Variables (vid, name, ndims) VALUES (?,?,?)""",
+                                [(this_var.vid, this_var.name, this_var.ndims) for this_var in variables])
+        self.writer.executemany("""INSERT INTO Build_Var_Attributes (vid, name, value) VALUES (?,?,?)""",
+                                [(this_var.vid, att.name, att.value) for this_var in variables for att in this_var.attributes])
+        self.writer.executemany("""INSERT INTO Build_Progress (fid) VALUES (?)""", [(fid,) for fid in fids])
+        # wait for the checkpoint to be committed so it is safe once this returns
+        self.writer.flush()
+        self.last_checkpoint=time.time()
+        self.ncheckpoints+=1
+        if self.verbose:
+            print('Build_journal.checkpoint():', len(fids), 'files completed since last checkpoint,', len(variables), 'variables')
+
+#----------------------------------------------------------------------------------------------------------
+# create the tables for the Build_journal, settings is a dictionary of the settings used for the build
+# which are checked when resuming
+#----------------------------------------------------------------------------------------------------------
+def create_journal_tables(cur, settings):
+    cur.execute("CREATE TABLE Build_Settings(name TEXT, value)")
+    cur.execute("CREATE TABLE Build_Progress(fid INTEGER PRIMARY KEY)")
+    cur.execute("CREATE TABLE Build_Variables(vid INTEGER PRIMARY KEY, name TEXT, ndims INTEGER)")
+    cur.execute("CREATE TABLE Build_Var_Attributes(vid INTEGER, name TEXT, value)")
+    cur.executemany("INSERT INTO Build_Settings (name, value) VALUES (?,?)", list(settings.items()))
+
+def read_journal_settings(cur):
+    return dict(cur.execute("SELECT name, value FROM Build_Settings").fetchall())
+
+def drop_journal_tables(cur):
+    for table in ['Build_Settings', 'Build_Progress', 'Build_Variables', 'Build_Var_Attributes']:
+        cur.execute("DROP TABLE IF EXISTS "+table)
+
+#----------------------------------------------------------------------------------------------------------
+# delete everything written for files that were not completed at the last checkpoint.
+# The coords created after the last one still in use are deleted too, so the cids stay
+# the indices into the coords when they are read back
+# returns:
+#    the number of files deleted
+#----------------------------------------------------------------------------------------------------------
+def delete_incomplete_files(cur):
+    nfiles=cur.execute("SELECT COUNT(*) FROM Files WHERE fid NOT IN (SELECT fid FROM Build_Progress)").fetchone()[0]
+    for table in ['Files', 'Global_Attributes', 'Staged_Links']:
+        cur.execute("DELETE FROM "+table+" WHERE fid NOT IN (SELECT fid FROM Build_Progress)")
+    max_cid=cur.execute("SELECT MAX(cid) FROM Staged_Links").fetchone()[0]
+    if max_cid==None:
+        max_cid=-1
+    for table in ['Coords', 'Discrete_Coord_Values', 'Coord_Attributes']:
+        cur.execute("DELETE FROM "+table+" WHERE cid>?", (max_cid,))
+    return nfiles
+
+#----------------------------------------------------------------------------------------------------------
+# read the variables saved at the last checkpoint
+# returns:
+#    list of Variable_metadata with their attributes but no links, the index into the list is the vid
+#----------------------------------------------------------------------------------------------------------
+def read_journal_variables(cur):
+    variables=[Variable_metadata(vid, name, ndims) for vid, name, ndims in cur.execute("SELECT vid, name, ndims FROM Build_Variables ORDER BY vid").fetchall()]
+    for vid, name, value in cur.execute("SELECT vid, name, value FROM Build_Var_Attributes ORDER BY rowid").fetchall():
+        variables[vid].attributes.append(Attribute(name, value))
+    return variables
+
 #-----------------------------------------------------------------
 # function to combine a directory path and filename to give a filepath
 #----------------------------------------------------------------
@@ -157,26 +493,34 @@ class File_metadata:
         self.symlink=row[3]
         self.created=row[4]
         self.modified=row[5]
+        # size was only added to the Files table for updating so may not be in the row
+        if len(row)>6:
+            self.size=row[6]
+        else:
+            self.size=None
 
     #---------------------------------------------------------------------------------------
     # initiation when creating database. This sets up all but the global attributes
     # global attributes can be added later. 
+    # file_stat (the os.stat of the file) and symlink (the target if it is a symbolic link or '')
+    # are given if the directory crawler already has them so we don't ask the file system again
     #---------------------------------------------------------------------------------------
-    def init_from_data(self, fid, did, dirpath, filename):
+    def init_from_data(self, fid, did, dirpath, filename, file_stat=None, symlink=''):
         self.fid=fid
         self.did=did
         self.filename=filename
-        self.symlink=''
-        # check whether this file is a symbolink link and what its creation and modification dates are
-        my_filepath=get_filepath(dirpath, filename)
-        if os.path.islink(my_filepath):
-            self.symlink=os.readlink(my_filepath)
-            # get dates as epoch time for actual file in symbolic link
-            self.created=os.path.getctime(self.symlink)
-            self.modified=os.path.getmtime(self.symlink)
-        else:
-            self.created=os.path.getctime(my_filepath)
-            self.modified=os.path.getmtime(my_filepath)
+        if file_stat==None:
+            # check whether this file is a symbolink link and what its creation and modification dates are
+            my_filepath=get_filepath(dirpath, filename)
+            if os.path.islink(my_filepath):
+                symlink=os.readlink(my_filepath)
+            # os.stat follows symbolic links
+            file_stat=os.stat(my_filepath)
+        self.symlink=symlink
+        # get dates as epoch time and size for actual file
+        self.created=file_stat.st_ctime
+        self.modified=file_stat.st_mtime
+        self.size=file_stat.st_size
         self.global_attributes=[]
 
     #---------------------------------------------------------------------------------------
@@ -195,11 +539,10 @@ class File_metadata:
         # create an entry in Files table for this file
         if verbose:
             print(thread_name, ' File_metadata.insert_into_database(): Creating File entry', self.fid, self.filename)
-        cur.execute("""INSERT INTO Files (fid, did, filename, symlink, created, modified) VALUES(?,?,?,?,?,?)""",
-                   (self.fid, self.did, self.filename, self.symlink, self.created, self.modified))
-        for att in self.global_attributes:
-            cur.execute("""INSERT INTO Global_Attributes(fid, name, value) VALUES (?,?,?)""",
-                        (self.fid, att.name, att.value))
+        cur.execute("""INSERT INTO Files (fid, did, filename, symlink, created, modified, size) VALUES(?,?,?,?,?,?,?)""",
+                   (self.fid, self.did, self.filename, self.symlink, self.created, self.modified, self.size))
+        cur.executemany("""INSERT INTO Global_Attributes(fid, name, value) VALUES (?,?,?)""",
+                        [(self.fid, att.name, att.value) for att in self.global_attributes])
 
 
     #--------------------------------------------------------------------------------------------------
@@ -250,86 +593,156 @@ class File_metadata:
         for att in self.global_attributes:
             print('\t', att.name, att.value)
 
+#--------------------------------------------------------------------------------------------
+# the REGEXP function for SQLite, which calls regexp(pattern, value) for value REGEXP pattern
+#--------------------------------------------------------------------------------------------
+def regexp(pattern, value):
+    return value!=None and re.search(pattern, value)!=None
+
+#--------------------------------------------------------------------------------------------
+# work out the SQL condition for the files whose filename matches filename_exp. filename_exp can be
+#    ''                            all files
+#    a regular expression          if it has any of ^$()|+{\ filenames containing a match, using REGEXP
+#    a glob pattern, eg. '*.nc'    otherwise if it has any of *?[ the whole filename must match it using GLOB
+#    anything else, eg. '2019'     filenames containing it
+# A glob pattern starting with fixed characters is found from the Files indexes by filename.
+# The REGEXP function is added to the connection of cur when it is needed. If filename_exp is not a
+# valid regular expression it is matched as part of the filename instead.
+# inputs:
+#    column: the filename column in the SQL, param: the parameter for the value in the SQL, eg. '?1'
+# returns:
+#    condition, value - the SQL condition and the value to bind to param
+#--------------------------------------------------------------------------------------------
+def get_filename_condition(cur, filename_exp, column='filename', param='?'):
+    if filename_exp=='':
+        return param+" IS NULL", None
+    if any(c in filename_exp for c in '^$()|+{\\'):
+        try:
+            re.compile(filename_exp)
+            cur.connection.create_function('regexp', 2, regexp, deterministic=True)
+            return column+" REGEXP "+param, filename_exp
+        except re.error as err:
+            print('filename', filename_exp, 'is not a valid regular expression, error=', err)
+    elif any(c in filename_exp for c in '*?['):
+        return column+" GLOB "+param, filename_exp
+    return "instr("+column+", "+param+")>0", filename_exp
+
 #--------------------------------------------------
 # Files_metadata holds the data for all files
+# The columns of the Files table are kept in numpy arrays rather than as one File_metadata for each file
+# so it takes much less memory for a large database. A File_metadata is only made for a file when it is
+# asked for with get_matching_fid().
 #--------------------------------------------------
 class Files_metadata:
 
+    dtype=[('fid', np.int64), ('did', np.int64), ('created', np.float64), ('modified', np.float64)]
+
     #---------------------------------------------------------------------------------------
     # initiation 
     #---------------------------------------------------------------------------------------
     def __init__(self):
-        self.all_files_metadata=[]
+        self.clear()
 
     #---------------------------------------------------------------------------------------
     # read files from database where cur is a cursor for the database and did is the directory id
     # if did=-1 then we get all files otherwise select those with matching did
-    # if filename_exp=='' get all files, otherwise select those that match
+    # if filename_exp=='' get all files, otherwise select those that match (see get_filename_condition())
+    # Only the matching rows are read. The did and filename_exp of the last read are kept so
+    # is_same_search() can tell whether the files need to be read again.
     #---------------------------------------------------------------------------------------
     def read_from_database(self,cur,did=-1, filename_exp=''):
-        if self.get_nfiles()>0:
-            self.clear()
-        # select all data from Files table
+        condition, value=get_filename_condition(cur, filename_exp, 'filename', '?1')
+        # the did is only in the SQL when it is needed so the index of Files by did can be used
         if did==-1:
-            cur.execute("""SELECT fid, did, filename, symlink, created, modified FROM Files""")
+            cur.execute("""SELECT fid, did, filename, symlink, created, modified FROM Files WHERE """+condition, (value,))
         else:
-            cur.execute("""SELECT fid, did, filename, symlink, created, modified FROM Files WHERE did=?""", (did,))
-        for row in cur.fetchall():
-            this_file=File_metadata(row, cur)
-            if filename_exp!='':
-                match=this_file.filename.find(filename_exp)
-            else:
-                match=0
-            if match>=0:
-                self.all_files_metadata.append(this_file)
+            cur.execute("""SELECT fid, did, filename, symlink, created, modified FROM Files WHERE did=?2 AND """+condition, (value, did))
+        rows=cur.fetchall()
+        self.columns=np.zeros(len(rows), Files_metadata.dtype)
+        self.columns['fid']=[row[0] for row in rows]
+        self.columns['did']=[row[1] for row in rows]
+        # None (NULL) is kept as nan
+        self.columns['created']=[np.nan if row[4]==None else row[4] for row in rows]
+        self.columns['modified']=[np.nan if row[5]==None else row[5] for row in rows]
+        self.filenames=np.asarray([row[2] for row in rows], dtype=object)
+        self.symlinks=np.asarray([row[3] for row in rows], dtype=object)
+        self.set_fid_index()
+        self.search=(did, filename_exp)
+
+    #---------------------------------------------------------------------------------------
+    # returns True if the files were last read for the same did and filename_exp
+    #---------------------------------------------------------------------------------------
+    def is_same_search(self, did, filename_exp):
+        return self.search==(did, filename_exp)
+
+    #---------------------------------------------------------------------------------------
+    # work out fid_index where fid_index[fid] is the index of file fid in the columns or -1 if it
+    # is not there so files can be found without searching
+    #---------------------------------------------------------------------------------------
+    def set_fid_index(self):
+        fids=self.columns['fid']
+        if len(fids)>0:
+            self.fid_index=np.full(int(np.amax(fids))+1, -1, np.int64)
+            self.fid_index[fids]=np.arange(len(fids))
+        else:
+            self.fid_index=np.zeros(0, np.int64)
             
     #---------------------------------------------------------------------------------------
     # returns number of files stored
     #---------------------------------------------------------------------------------------
     def get_nfiles(self):
-        return len(self.all_files_metadata)
+        return len(self.columns)
 
 
     #---------------------------------------------------------------------------------------
     # clear the list of files
     #---------------------------------------------------------------------------------------
     def clear(self):
-        self.all_files_metadata.clear()
+        self.columns=np.zeros(0, Files_metadata.dtype)
+        self.filenames=np.zeros(0, object)
+        self.symlinks=np.zeros(0, object)
+        self.set_fid_index()
+        self.search=None
 
     #---------------------------------------------------------------------------------------
     # returns a list of the fids of the files that have a directory id that equals the did requested
     #---------------------------------------------------------------------------------------
     def get_fids_for_matching_did(self,did):
-        matches=[this_file.did==did for this_file in self.all_files_metadata]
-        ix=np.where(matches)
-        fids=[self.all_files_metadata[f].fid for f in ix[0]]
-        return fids
+        return self.columns['fid'][self.columns['did']==did].tolist()
 
     #---------------------------------------------------------------------------------------
     # returns a list of the fids of all the files in this list
     #---------------------------------------------------------------------------------------
     def get_fids(self):
-        fids=[f.fid for f in self.all_files_metadata]
-        return fids
+        return self.columns['fid'].tolist()
+
+    #---------------------------------------------------------------------------------------
+    # returns a numpy boolean array indexed by fid which is True for the files in this list
+    #---------------------------------------------------------------------------------------
+    def get_fid_mask(self):
+        return self.fid_index>=0
     
     #---------------------------------------------------------------------------------------
     # returns the file_metadata for the file with an fid that matches that given, (None if not found)
-    # if all the files have been read from the database then the fid is the same as the index into the array
     #---------------------------------------------------------------------------------------
     def get_matching_fid(self,fid):
         this_file=None
-        if fid<self.get_nfiles() and self.all_files_metadata[fid].fid==fid:
-            this_file=self.all_files_metadata[fid]
-        else:
-            matches=[this_file.fid==fid for this_file in self.all_files_metadata]
-            ix=np.where(matches)
-            if len(ix[0])==1:
-                this_file=self.all_files_metadata[ix[0][0]]
+        if fid>=0 and fid<len(self.fid_index) and self.fid_index[fid]>=0:
+            this_file=self.get_file(self.fid_index[fid])
         return this_file
+
+    #---------------------------------------------------------------------------------------
+    # make the File_metadata for the file at index ix in the columns
+    #---------------------------------------------------------------------------------------
+    def get_file(self, ix):
+        column_values=self.columns[ix]
+        times=[None if np.isnan(column_values[t]) else float(column_values[t]) for t in ['created', 'modified']]
+        row=(int(column_values['fid']), int(column_values['did']), self.filenames[ix], self.symlinks[ix], times[0], times[1])
+        return File_metadata(row, None)
     
     def print(self):
-        for this_file in self.all_files_metadata:
-           this_file.print()
+        for ix in range(self.get_nfiles()):
+           self.get_file(ix).print()
 
 #--------------------------------------------------
 # Coord_metadata holds the metadata for a coordinate
@@ -372,12 +785,18 @@ class Coord_filter:
 # but when comparing times we will convert to epoch times
 class Coord_metadata:
 
+    chunk_size=1000000 # maximum number of coordinate values read into memory at a time by init_from_data
+
     def __init__(self,*args):
-        # there are 2 possible ways to initialise a Coord
+        # there are 3 possible ways to initialise a Coord
         # init_from_data is initation when reading metadata from file and takes cid, name, coord_values and thread_name
         # init_from_database - is initiation from the database and takes row and cur from Coord table
+        # init_from_rows - is initiation from rows already read from the database (see read_coords_in_bulk())
+        #                  and takes row, attribute rows and discrete values
         if len(args)==2: 
             self.init_from_database(*args)
+        elif len(args)==3:
+            self.init_from_rows(*args)
         else:
             self.init_from_data(*args)
 
@@ -400,6 +819,20 @@ class Coord_metadata:
     #    cur is a cursor on the database
     #-------------------------------------------------------------------------------------------------------
     def init_from_database(self,row, cur):
+        cur.execute("""SELECT name,value FROM Coord_Attributes WHERE cid=?""", (row[0],))
+        attr_rows=cur.fetchall()
+        values=[]
+        if row[5]==0:
+            cur.execute("""SELECT value FROM Discrete_Coord_Values WHERE cid=?""", (row[0],))
+            values=[val[0] for val in cur.fetchall()]
+        self.init_from_rows(row, attr_rows, values)
+
+    #-------------------------------------------------------------------------------------------------------
+    # initiate from a row of the Coord table, the name, value rows of its attributes from the
+    # Coord_Attributes table and its values from the Discrete_Coord_Values table (which may be empty)
+    #-------------------------------------------------------------------------------------------------------
+    def init_from_rows(self, row, attr_rows, values):
+        self.min_max_delta=None
         self.cid=row[0]
         self.name=row[1]
         self.nvals=row[2]
@@ -416,68 +849,33 @@ class Coord_metadata:
         self.attributes=[]
         self.units_attrix=-1
         self.calendar_attrix=-1
-        self.read_attributes(cur)
+        for attr in attr_rows:
+            self.add_attribute(attr[0], attr[1])
         
-        if self.delta==0:
-            cur.execute("""SELECT value FROM Discrete_Coord_Values WHERE cid=?""", (self.cid,))
-            val_rows=cur.fetchall()
-            if len(val_rows)>0:
-                self.values=np.asarray([val[0] for val in val_rows])
+        if self.delta==0 and len(values)>0:
+            self.values=np.asarray(values)
+
+        # use the epoch range stored in the database if there is one, otherwise it is worked out
+        # by get_min_max_delta() when it is needed
+        if len(row)>9 and row[9]==1 and row[6]!=None and row[7]!=None and row[8]!=None:
+            self.min_max_delta=(row[6], row[7], row[8]/3600)
+        elif len(row)>9 and row[9]==0:
+            self.min_max_delta=(self.min_val, self.max_val, self.delta)
 
     #--------------------------------------------------
     # initiate from reading datafile (coord_values can be an empty list)
     #--------------------------------------------------
     def init_from_data(self,cid, name, coord_values, thread_name):
+        self.min_max_delta=None # worked out by get_min_max_delta() once all the attributes have been added
         self.cid=cid
         self.name=name
         self.delta=0
         self.nvals=len(coord_values)
         self.values=[]
 
-        # sqlite3 doesn't handle integers well - it creates blobs depending on size of integer so best
-        # to save data as float
         if self.nvals>0:
             assert(isinstance(coord_values[0], str)==False) # we don't handle str type coord values
-            if hasattr(coord_values, 'mask'):
-                # there are occasions when the coord_values are integer but have a mask
-                # in that case we need to convert coord_values to float so we can set the masked values to nan
-                was_int=False
-                if isinstance(coord_values.data[0], np.int64) or isinstance(coord_values.data[0], np.int32) or isinstance(coord_values.data[0], int): # if the values were integer we have to cast to float so we can add nan
-                    was_int=True
-                    coord_type=type(coord_values.data[0])
-                    coord_values2=np.zeros(len(coord_values.data))
-                    coord_values2[:]=coord_values.data
-                else:
-                    coord_values2=coord_values.data
-                # sometimes mask is not an array when data is
-                if isinstance(coord_values.mask, np.ndarray):
-                    ix=np.where(coord_values.mask==True)
-                    if len(ix[0])>0:
-                        coord_values2[ix]=np.nan
-                        extra=''
-                        if was_int:
-                            extra=f'was int type {coord_type}'
-                        print(f'{thread_name}: Coord_metadata.init_from_data(): cid {self.cid} {self.name} has masked coord values', extra)
-                             
-                else:
-                    # check the mask is false otherwise all data is nan
-                    assert(coord_values.mask==False)
-                coord_values=coord_values2
-
-            self.min_val=float(np.nanmin(coord_values))
-            self.max_val=float(np.nanmax(coord_values))
-
-            if self.nvals>1:
-                deltas=abs(coord_values[1:]-coord_values[:-1])
-                # in case there are some nan values just use the non-nan deltas
-                ix=np.where(np.isfinite(deltas))
-                deltas=deltas[ix[0]]
-                delta_deltas=deltas[1:]-deltas[:-1]
-                ix=np.where(abs(delta_deltas)>0.0001)
-                if len(ix[0])==0:
-                    self.delta=float(np.mean(deltas))
-                else:
-                    self.values=[float(v) for v in coord_values]
+            self.summarise_values(coord_values, thread_name)
         else:
             self.min_val=np.nan
             self.max_val=np.nan
@@ -486,12 +884,88 @@ class Coord_metadata:
         self.units_attrix=-1
         self.calendar_attrix=-1
 
+    #----------------------------------------------------------------------------------------
+    # read up to chunk_size coordinate values starting at start
+    # coord_values can be anything that can be sliced eg. a netcdf variable, h5py dataset or array
+    # returns:
+    #    values - array of the values with any masked values set to nan. Integers are converted to float
+    #             because sqlite3 doesn't handle integers well and so we can set masked values to nan
+    #    nmasked - the number of masked values
+    #----------------------------------------------------------------------------------------
+    def read_chunk(self, coord_values, start):
+        chunk=np.ma.asarray(coord_values[start:start+Coord_metadata.chunk_size])
+        if chunk.dtype.kind!='f':
+            chunk=chunk.astype(np.float64)
+        return chunk.filled(np.nan), np.ma.count_masked(chunk)
+
+    #----------------------------------------------------------------------------------------
+    # work out min_val, max_val and whether the values are evenly spaced (delta apart) with one pass
+    # through the values a chunk at a time. The spacing is evenly spaced if the differences between
+    # neighbouring deltas, ignoring any nan values, are all less than 0.0001.
+    # If they are not evenly spaced the values are kept in self.values as a numpy array which needs a
+    # second pass if there was more than one chunk
+    #----------------------------------------------------------------------------------------
+    def summarise_values(self, coord_values, thread_name):
+        self.min_val=np.nan
+        self.max_val=np.nan
+        evenly_spaced=True
+        last_value=None  # the last value of the previous chunk so we get the delta between chunks
+        last_delta=None  # the last finite delta so far
+        delta_sum=0.0
+        ndeltas=0
+        nmasked=0
+        for start in range(0, self.nvals, Coord_metadata.chunk_size):
+            values, this_nmasked=self.read_chunk(coord_values, start)
+            nmasked+=this_nmasked
+            # fmin and fmax ignore nan unless all values are nan
+            self.min_val=float(np.fmin(self.min_val, np.fmin.reduce(values)))
+            self.max_val=float(np.fmax(self.max_val, np.fmax.reduce(values)))
+
+            if self.nvals>1 and evenly_spaced:
+                if last_value is None:
+                    deltas=abs(values[1:]-values[:-1])
+                else:
+                    deltas=abs(np.diff(np.concatenate((last_value, values))))
+                # in case there are some nan values just use the non-nan deltas
+                deltas=deltas[np.isfinite(deltas)]
+                if last_delta is None:
+                    delta_deltas=deltas[1:]-deltas[:-1]
+                else:
+                    delta_deltas=np.diff(np.concatenate((last_delta, deltas)))
+                if np.any(abs(delta_deltas)>0.0001):
+                    evenly_spaced=False
+                else:
+                    delta_sum+=float(np.sum(deltas, dtype=np.float64))
+                    ndeltas+=len(deltas)
+                if len(deltas)>0:
+                    last_delta=deltas[-1:]
+            last_value=values[-1:]
+
+        if nmasked>0:
+            print(f'{thread_name}: Coord_metadata.init_from_data(): cid {self.cid} {self.name} has {nmasked} masked coord values')
+
+        if self.nvals>1:
+            if evenly_spaced:
+                if ndeltas>0:
+                    self.delta=delta_sum/ndeltas
+                else:
+                    self.delta=np.nan
+            elif self.nvals<=Coord_metadata.chunk_size:
+                # all the values are in the only chunk
+                self.values=values.astype(np.float64)
+            else:
+                self.values=np.zeros(self.nvals)
+                for start in range(0, self.nvals, Coord_metadata.chunk_size):
+                    values, this_nmasked=self.read_chunk(coord_values, start)
+                    self.values[start:start+len(values)]=values
+
     #----------------------------------------------------------------------------------------
     # add an attribute when creating from data file
     # check whether attribute is units or calendar so we can check if this is a time coord
     #----------------------------------------------------------------------------------------
     def add_attribute(self, name, value):
         self.attributes.append(Attribute(name,value))
+        self.min_max_delta=None
         if name=='units':
             self.units_attrix=len(self.attributes)-1
         elif name=='calendar':
@@ -530,14 +1004,14 @@ class Coord_metadata:
         matches=False
         if self.name==other.name and self.nvals==other.nvals:
             # handle min_val or max_val being NaN
-            min_val_match= ((np.isnan(self.min_val) and np.isnan(other.min_val)) or abs(self.min_val-other.min_val)<1e-6) 
-            max_val_match= ((np.isnan(self.max_val) and np.isnan(other.max_val)) or abs(self.max_val-other.max_val)<1e-6)
+            min_val_match= ((np.isnan(self.min_val) and np.isnan(other.min_val)) or abs(self.min_val-other.min_val)<COORD_TOLERANCE) 
+            max_val_match= ((np.isnan(self.max_val) and np.isnan(other.max_val)) or abs(self.max_val-other.max_val)<COORD_TOLERANCE)
             values_match=False
             if len(self.values)>0 and len(other.values)>0:
-                if np.all(abs(np.asarray(self.values)-np.asarray(other.values))<1e-6):
+                if np.all(abs(np.asarray(self.values)-np.asarray(other.values))<COORD_TOLERANCE):
                     values_match=True
             else:
-                if abs(self.delta-other.delta)<1e-6:
+                if abs(self.delta-other.delta)<COORD_TOLERANCE:
                     values_match=True
             if min_val_match and max_val_match and values_match:
                 matches=True
@@ -564,6 +1038,29 @@ class Coord_metadata:
 
         return matches
         
+    #----------------------------------------------------------------------------------------
+    # Fingerprints are used to index the coordinates so we only need to call matches_coord
+    # for the few coordinates that could match rather than every coordinate.
+    # A fingerprint is made of the name, nvals, the attributes sorted by name and the
+    # min_val and max_val rounded to COORD_TOLERANCE. Two values within COORD_TOLERANCE of each
+    # other may round to neighbouring integers so get_fingerprints_to_check() returns the
+    # fingerprints for the neighbouring rounded values too.
+    #----------------------------------------------------------------------------------------
+    def quantise(value):
+        if np.isfinite(value):
+            return int(round(value/COORD_TOLERANCE))
+        return None
+
+    def get_fingerprint(self):
+        attrs=tuple(sorted([(attr.name, attr.value) for attr in self.attributes], key=lambda a: a[0]))
+        return (self.name, self.nvals, attrs, Coord_metadata.quantise(self.min_val), Coord_metadata.quantise(self.max_val))
+
+    def get_fingerprints_to_check(self):
+        name, nvals, attrs, qmin, qmax=self.get_fingerprint()
+        qmins=[qmin] if qmin==None else [qmin-1, qmin, qmin+1]
+        qmaxs=[qmax] if qmax==None else [qmax-1, qmax, qmax+1]
+        return [(name, nvals, attrs, this_qmin, this_qmax) for this_qmin in qmins for this_qmax in qmaxs]
+
     #----------------------------------------------------------------------------------------
     # Check whether this coord has same metadata as given coord but don't worry about values
     # Both should have matching name and attribute names and values
@@ -613,7 +1110,7 @@ class Coord_metadata:
     #----------------------------------------------------------------------------------------
     # code to insert coord into Coords table, any values into Discrete_Coord_Values table
     # and any attributes into Coords_Attributes table
-    # cur is the cursor for the database
+    # cur is the cursor for the database (or a Db_writer)
     #----------------------------------------------------------------------------------------
     def insert_into_database(self, thread_name, cur,verbose=False):
         # create Coord entry
@@ -626,16 +1123,16 @@ class Coord_metadata:
                 else:
                     extra='no values'
             print(thread_name, ' Coord_metadata.insert_into_database(): Creating Coord entry', self.cid, self.name, 'nvals=',self.nvals, 'min=',self.min_val, 'max=',self.max_val, extra)
-        cur.execute("""INSERT INTO Coords (cid, name, nvals, min_val, max_val, delta) VALUES (?,?,?,?,?,?)""",
-                    (self.cid, self.name, self.nvals, self.min_val, self.max_val, self.delta))
+        epoch_min, epoch_max, delta_seconds, is_time=self.get_epoch_range(thread_name)
+        cur.execute("""INSERT INTO Coords (cid, name, nvals, min_val, max_val, delta, epoch_min, epoch_max, delta_seconds, is_time) VALUES (?,?,?,?,?,?,?,?,?,?)""",
+                    (self.cid, self.name, self.nvals, self.min_val, self.max_val, self.delta, epoch_min, epoch_max, delta_seconds, is_time))
         if len(self.values)>0:
-            for i in range(self.nvals):
-                cur.execute("""INSERT INTO Discrete_Coord_Values (cid, value) VALUES (?,?)""", (self.cid, self.values[i]) )
+            cur.executemany("""INSERT INTO Discrete_Coord_Values (cid, value) VALUES (?,?)""", [(self.cid, float(value)) for value in self.values])
         if len(self.attributes)>0:
-            for att in self.attributes:
-                if verbose:
+            if verbose:
+                for att in self.attributes:
                     print(thread_name, ' Coord_metadata.insert_into_database(): creating coord attribute for cid',self.cid, att.name,att.value) 
-                cur.execute("""INSERT INTO Coord_Attributes (cid, name, value) VALUES (?,?,?)""", (self.cid, att.name, att.value))
+            cur.executemany("""INSERT INTO Coord_Attributes (cid, name, value) VALUES (?,?,?)""", [(self.cid, att.name, att.value) for att in self.attributes])
                 
     #----------------------------------------------------------------------------------------
     # convert value to an epoch time - should only be called if we know this is a datetime coordinate
@@ -654,12 +1151,33 @@ class Coord_metadata:
 
         return epoch
     
+    #----------------------------------------------------------------------------------------
+    # get the values for the epoch_min, epoch_max, delta_seconds and is_time columns of the Coords table
+    # epoch_min, epoch_max and delta_seconds are None if this is not a time coordinate or the
+    # times can't be converted, in which case they will be worked out again when needed
+    #----------------------------------------------------------------------------------------
+    def get_epoch_range(self, thread_name=''):
+        epoch_min=None
+        epoch_max=None
+        delta_seconds=None
+        is_time, calendar=self.is_time()
+        if is_time:
+            try:
+                epoch_min, epoch_max, delta_hours=self.get_min_max_delta()
+                delta_seconds=delta_hours*3600
+            except Exception as err:
+                print(thread_name, ' Coord_metadata.get_epoch_range(): cannot convert times of coord', self.cid, self.name, err)
+        return epoch_min, epoch_max, delta_seconds, int(is_time)
+
     #----------------------------------------------------------------------------------------
     # this function returns the min_val, max_val and delta value of this coordinate
     # If the coordinate is a time coordinate the values are returned as epoch times for min and max
-    # and number of hours for delta.
+    # and number of hours for delta. These are read from the database if they were stored when
+    # the coord was created, otherwise they are worked out the first time and kept.
     #----------------------------------------------------------------------------------------
     def get_min_max_delta(self):
+        if self.min_max_delta!=None:
+            return self.min_max_delta
         min_val=self.min_val
         max_val=self.max_val
         delta=self.delta
@@ -682,6 +1200,7 @@ class Coord_metadata:
                     delta_dates=next_date-num2date(self.min_val,units=units,calendar=calendar)
                     delta=delta_dates.days*24+delta_dates.seconds/3600 # delta in hours
 
+        self.min_max_delta=(min_val, max_val, delta)
         return min_val, max_val, delta
     
 
@@ -795,11 +1314,20 @@ class Coord_metadata:
 class Variable_metadata:
 
     max_fids_cids_to_print=8
+    max_cids_per_dim=2 # number of different cids kept for each dimension when building the database
+    # some attributes can be different in different files and I've even found that sometimes
+    # they are string and sometimes float!
+    # the ones that should definitely match are:
+    must_match_attr_names=['long_name','standard_name','units', 'dataset','statistic', 'time_step', 'var_desc']
     
     def __init__(self,*args):
-        # args are row, cur and verbose for initiation from database and vid and name for initiation from data
+        # args are row, cur and verbose for initiation from database, row, links, attributes and verbose
+        # for initiation from rows already read (see read_variables_in_bulk()) and vid and name for
+        # initiation from data
         if isinstance(args[1], str):
             self.init_from_data(*args)
+        elif len(args)==4:
+            self.init_from_links(*args)
         else:
             self.init_from_database(*args)
 
@@ -813,6 +1341,18 @@ class Variable_metadata:
     #    cur is a cursor on the database
     #-------------------------------------------------------------------------------------------
     def init_from_database(self,row, cur, verbose):
+        # cid fid pairs are read out in the order they were put in,
+        # i.e. each dimension will be read for all the fids, if the fid=-1 then only 1 cid will be read for that dimension
+        res_cids_fids_dimix=cur.execute("""SELECT cid, fid, dimix FROM Coords_Fids_Of_Variables WHERE vid=?""", (row[0],)).fetchall()
+        cur.execute("""SELECT name,value FROM Var_Attributes WHERE vid=?""", (row[0],))
+        attributes=[Attribute(row_a[0], row_a[1]) for row_a in cur.fetchall()]
+        self.init_from_links(row, np.asarray(list(map(list,res_cids_fids_dimix))), attributes, verbose)
+
+    #--------------------------------------------------------------------------------------------
+    # Initiate from row of the Variable table, the links which are an array of the cid, fid, dimix
+    # rows of the Coords_Fids_Of_Variables table for this variable and its list of Attributes
+    #--------------------------------------------------------------------------------------------
+    def init_from_links(self, row, cids_fids_dimix_arr, attributes, verbose):
         self.vid=row[0]
         self.name=row[1]
         self.ndims=row[2]
@@ -822,12 +1362,7 @@ class Variable_metadata:
         # to each fid.
         # To save space in the database, if cids for a dimension are the same for all files we store
         # a single cid with matching fid as -1 (but only is there is a dimension with different
-        # find the matching coords ids and fids
-        res_cids_fids_dimix=cur.execute("""SELECT cid, fid, dimix FROM Coords_Fids_Of_Variables WHERE vid=?""", (self.vid,)).fetchall()
-        # cid fid pairs are read out in the order they were put in,
-        # i.e. each dimension will be read for all the fids, if the fid=-1 then only 1 cid will be read for that dimension
-        cids_fids_dimix_arr =np.asarray(list(map(list,res_cids_fids_dimix)))
-        if len(cids_fids_dimix_arr.shape)==2:
+        if len(cids_fids_dimix_arr.shape)==2 and len(cids_fids_dimix_arr)>0:
             cids=cids_fids_dimix_arr[:,0]
             fids=cids_fids_dimix_arr[:,1]
             dixes=cids_fids_dimix_arr[:,2]
@@ -864,34 +1399,82 @@ class Variable_metadata:
             pdb.set_trace()
             self.cids=[]
             self.fids=[]
-             
-        # get the attributes
-        self.attributes=[]
-        cur.execute("""SELECT name,value FROM Var_Attributes WHERE vid=?""", (self.vid,))
-        self.attributes=[Attribute(row_a[0], row_a[1]) for row_a in cur.fetchall()]
+        self.nfids=len(self.fids)
+        self.attributes=attributes
 
     #-----------------------------------------------------------------------------------------------------
     # When initiating from reading data file, adding coordinate ids and fids and attributes is done after
     # initiation.
-    # When another file is read with the same variables but different coordinates, we will append that fid
+    # When another file is read with the same variables but different coordinates, we will add that fid
     # and its coordinate cids to the existing variable
-    # We don't know at the start how many files this variable will appear in so fids and cids are created as lists.
+    # The links between the variable, its files and coordinates are written to the Staged_Links table as
+    # each file is read (see stage_links()) rather than kept in memory until the end, so the memory used
+    # does not grow with the number of files. All we keep is enough to match the variable against new ones.
     #-----------------------------------------------------------------------------------------------------
     def init_from_data(self,vid, name, ndims):
         self.vid=vid
         self.name=name
         self.ndims=ndims
         self.multi_dim=-1
-        # we need to store the cids for each dimension for each file i.e. cids=[dim0_cids, dim1_cids...]
-        # where dim<x>_cids is a list of cids for each dimension and is of length nfids corresponding
-        # to each fid.
-        # cids will be set up by add_cids_for_fid()
-        # in the end all but one dimension should have the same cid for all files but we can't work this
-        # out until all have been added which is when we insert_into_database
+        self.nfids=0
+        # cids=[dim0_cids, dim1_cids...] where dim<x>_cids is a list of the different cids found so far
+        # for dimension x in the order they were found. We only need to know the first one and whether
+        # there are others so at most max_cids_per_dim are kept
         self.cids=[[] for d in range(self.ndims)]
+        # the fids and their cids for each dimension that have been added but not yet staged
         self.fids=[]
+        self.fid_cids=[]
         self.attributes=[]
 
+    #-----------------------------------------------------------------------------------------------------
+    # When updating a database the variables are read from the database but more files may then be added
+    # to them, so keep only the different cids for each dimension as when creating the database
+    #-----------------------------------------------------------------------------------------------------
+    def prepare_for_update(self):
+        if self.ndims>0:
+            dim_cids=[[int(cid) for cid in self.cids[d]] for d in range(self.ndims)]
+        else:
+            dim_cids=[]
+        self.set_links_summary(len(self.fids), dim_cids)
+
+    #-----------------------------------------------------------------------------------------------------
+    # set the number of files and the cids for each dimension of a variable whose links have been staged
+    # inputs:
+    #    nfids - the number of files the variable is in
+    #    dim_cids - for each dimension a list of the cids in the order they were found (may contain repeats)
+    #-----------------------------------------------------------------------------------------------------
+    def set_links_summary(self, nfids, dim_cids):
+        self.nfids=nfids
+        self.cids=[[] for d in range(self.ndims)]
+        for d in range(self.ndims):
+            for cid in dim_cids[d]:
+                if cid not in self.cids[d] and len(self.cids[d])<Variable_metadata.max_cids_per_dim:
+                    self.cids[d].append(cid)
+        self.multi_dim=-1
+        for d in range(self.ndims):
+            if len(self.cids[d])>1:
+                self.multi_dim=d
+        self.fids=[]
+        self.fid_cids=[]
+
+    #-----------------------------------------------------------------------------------------------------
+    # get_state() returns the parts of the variable that change when another variable is matched to it
+    # so that set_state() can put them back if the file of the other variable can't be registered
+    # The fids and cids must have been staged
+    #-----------------------------------------------------------------------------------------------------
+    def get_state(self):
+        return (self.nfids, [list(cids) for cids in self.cids], self.multi_dim, [attr.value for attr in self.attributes])
+
+    def set_state(self, state):
+        nfids, cids, multi_dim, values=state
+        self.nfids=nfids
+        self.cids=[list(dim_cids) for dim_cids in cids]
+        self.multi_dim=multi_dim
+        for attr, value in zip(self.attributes, values):
+            attr.value=value
+        self.fids=[]
+        self.fid_cids=[]
+
     #------------------------------------------------------------------------
     # get the fids
     #------------------------------------------------------------------------
@@ -903,11 +1486,12 @@ class Variable_metadata:
     # get the number of fids
     #---------------------------------------------------------------------------
     def get_nfiles(self):
-         return len(self.fids)
+         return self.nfids
 
     #------------------------------------------------------------------------
     # add matching coordinate ids for each dimension that are in file fid
     # fid is a single fid, cids is a list/array of length self.ndims
+    # the fid and cids are kept until stage_links() is called
     #------------------------------------------------------------------------
     def add_cids_for_fid(self, fid, cids):
 
@@ -919,9 +1503,12 @@ class Variable_metadata:
             else:
                 #print('Variable_metadata.add_cids_for_fid():',self.name, self.vid, 'adding cids ', cids, 'for fid', fid)
                 self.fids.append(fid)
+                self.fid_cids.append(list(cids))
+                self.nfids+=1
                 for d in range(self.ndims):
                     this_cid=cids[d]
-                    self.cids[d].append(this_cid)
+                    if this_cid not in self.cids[d] and len(self.cids[d])<Variable_metadata.max_cids_per_dim:
+                        self.cids[d].append(this_cid)
 
     #-------------------------------------------------------------------
     # this copies the fid and the cids from other
@@ -935,17 +1522,32 @@ class Variable_metadata:
         else:
             # other will just have one fid and cid for each dimension
             assert(len(other.fids)==1)
-            other_cids=[other.cids[d][0] for d in range(other.ndims)]
-            self.add_cids_for_fid(other.fids[0],other_cids)
+            self.add_cids_for_fid(other.fids[0],other.fid_cids[0])
             # check if we now have a multi dimension
             for d in range(self.ndims):
                 # are the cids for this dim all the same?
-                ncids=len(np.unique(np.asarray(self.cids[d])))
+                ncids=len(self.cids[d])
                 if ncids>1:
                     if self.multi_dim==-1:
                         self.multi_dim=d
                     elif self.multi_dim!=d:
                         raise ValueError(f'Variable_metadata.copy_fid_cids_from_other(): more than one multi dimension for var {self.name}!')
+
+    #-------------------------------------------------------------------
+    # write the fids and cids added since the last call into the Staged_Links table
+    # they are compacted into Coords_Fids_Of_Variables by compact_staged_links() at the end
+    # if there are no dimensions the cid and dimix are saved as -1
+    #-------------------------------------------------------------------
+    def stage_links(self, cur):
+        rows=[]
+        for fid, cids in zip(self.fids, self.fid_cids):
+            if self.ndims==0:
+                rows.append((self.vid, fid, -1, -1))
+            else:
+                rows.extend([(self.vid, fid, d, cids[d]) for d in range(self.ndims)])
+        cur.executemany("""INSERT INTO Staged_Links (vid, fid, dimix, cid) VALUES (?,?,?,?)""", rows)
+        self.fids=[]
+        self.fid_cids=[]
         
 
     # returns array of unique cids for dimension d
@@ -969,15 +1571,10 @@ class Variable_metadata:
     #-------------------------------------------------------------
     def matches_variable(self, other, coords, verbose, thread_name):
         matches=False
-        # some attributes can be different in different files and I've even found that sometimes
-        # they are string and sometimes float!
-        # the ones that should definitely match are:
-        must_match_attr_names=['long_name','standard_name','units', 'dataset','statistic', 'time_step', 'var_desc']
+        must_match_attr_names=Variable_metadata.must_match_attr_names
         if verbose:
-            if len(self.fids)>self.max_fids_cids_to_print:
-                fids_str=f'{self.fids[:int(self.max_fids_cids_to_print/2)]}...{self.fids[-int(self.max_fids_cids_to_print/2):]}'
-            else:
-                fids_str=f'{self.fids}'
+            # the fids are in the Staged_Links table so just print how many there are
+            fids_str=f'[{self.get_nfiles()} files]'
 
         # and the attribute names should all match
         if self.name==other.name and self.ndims==other.ndims:
@@ -1080,59 +1677,31 @@ class Variable_metadata:
            
         return matches
 
+    #--------------------------------------------------------------
+    # key used to put variables into buckets so a new variable only needs to be checked
+    # against the variables in the same bucket with matches_variable
+    # Variables can only match if they have the same name, ndims, attribute names and
+    # values of the attributes in must_match_attr_names. None of these change when
+    # another variable is matched to this one.
+    #-------------------------------------------------------------
+    def get_bucket_key(self):
+        attrnames=tuple(sorted([attr.name for attr in self.attributes]))
+        must_match=tuple(sorted([(attr.name, attr.value) for attr in self.attributes if attr.name in Variable_metadata.must_match_attr_names], key=lambda a: a[0]))
+        return (self.name, self.ndims, attrnames, must_match)
+
     #--------------------------------------------------
-    # insert all the variable metadata into the database
-    # if the cids for a dimension are the same for all fids we can save space in the database by setting fid=-1
-    # and only saving one entry for this cid, however we must have a multi-dimension to do this as we need to
-    # store all the fids somewhere
-    # if there are no dimenions the cid will be saved as -1 for each fid
+    # insert the variable and its attributes into the database
+    # the links to the files and coordinates have already been written to the Staged_Links table by
+    # stage_links() and are written to Coords_Fids_Of_Variables by compact_staged_links()
     #--------------------------------------------------
     def insert_into_database(self,thread_name,cur,verbose=False):
         if verbose:
             print(thread_name, ' Variable_metadata.insert_into_database(): Creating Variable entry', self.vid, self.name)
         cur.execute("""INSERT INTO Variables (vid, name, ndims) VALUES (?,?,?)""", (self.vid, self.name, self.ndims))
-        nfids=self.get_nfiles()
-
-        for d in range(self.ndims):
-            this_cids=self.get_cids_for_dim(d)
-            if len(this_cids)==1:
-                # the cids are the same for all files
-                cid=this_cids[0]
-                if nfids>1 and self.multi_dim>=0:
-                    # make one entry for the unique cid with fid=-1 to indicate all files have the same cid for
-                    # this dimension (there must be a multi dim, otherwise we wont save the fids anywhere)
-                    # note that entries are in the order of the dimensions
-                    fid=-1
-                    if verbose:
-                        print(thread_name, ' Variable_metadata.insert_into_database(): var={} vid={} creating cid={} fid={} for dimension {}'.format(self.name, self.vid, cid, fid, d))
-                    cur.execute("""INSERT INTO Coords_Fids_Of_Variables (vid, cid, fid, dimix) VALUES (?,?,?,?)""", (self.vid, cid, fid, d))
-                else:
-                    if verbose:
-                        print(thread_name, ' Variable_metadata.insert_into_database(): var={} vid={} creating cid={} for fids={} for dimension {}'.format(self.name, self.vid, cid, self.fids, d))
-                    for f in range(nfids):
-                        fid=self.fids[f]
-                        cur.execute("""INSERT INTO Coords_Fids_Of_Variables (vid, cid, fid, dimix) VALUES (?,?,?,?)""", (self.vid, cid, fid, d))
-            else:
-                # This is the case where there is a different cid for each fid
-                if verbose:
-                   print(thread_name, ' Variable_metadata.insert_into_database(): var={} vid={} creating cids={} and fids={} for dimension {}'.format(self.name, self.vid, this_cids, self.fids, d))
-                for f in range(nfids):
-                    cid=this_cids[f]
-                    fid=self.fids[f]
-                    cur.execute("""INSERT INTO Coords_Fids_Of_Variables (vid, cid, fid, dimix) VALUES (?,?,?,?)""", (self.vid, cid, fid, d))
-        if self.ndims==0:
-            # this is the case where there are no dimensions so no cids but we need to add the fids with -1 for a cid and dix
-            cid=int(-1)
-            dix=int(-1)
-            if verbose:
-                print(thread_name, ' Variable_metadata.insert_into_database(): var={} vid={} creating cid={} for fids={}'.format(self.name, self.vid, cid, self.fids))
-            for f in range(nfids):
-                fid=self.fids[f]
-                cur.execute("""INSERT INTO Coords_Fids_Of_Variables (vid, cid, fid, dimix) VALUES (?,?,?,?)""", (self.vid, cid, fid, dix))
-        for att in self.attributes:
-           if verbose:
+        if verbose:
+            for att in self.attributes:
                print(thread_name, ' Variable_metadata.insert_into_database(): Creating attribute for variable', self.vid, self.name, att.name, att.value)
-           cur.execute("""INSERT INTO Var_Attributes (vid, name, value) VALUES (?,?,?)""", (self.vid, att.name, att.value))
+        cur.executemany("""INSERT INTO Var_Attributes (vid, name, value) VALUES (?,?,?)""", [(self.vid, att.name, att.value) for att in self.attributes])
 
     #----------------------------------------------------------------------------------------
     # get the dimension which has multiple files and therefore coordinates
@@ -1144,7 +1713,8 @@ class Variable_metadata:
     # check whether this variable covers all the filters and store the fids that do cover the
     # ranges and are allowed
     # inputs:
-    #    fids - only allow the variable fids that are in this list
+    #    fids - only allow the variable fids that are in this list or, if it is a numpy boolean array
+    #           indexed by fid (see Files_metadata.get_fid_mask()), that are True in it
     #    coord_filters - array of all the filters we may need to check
     #    coords - array of all the coords (note as this is all the coords in the database the cids
     #             are the indices into this array)
@@ -1154,16 +1724,16 @@ class Variable_metadata:
     #----------------------------------------------------------------------------------------
     def check_fids_and_filters(self, fids, coord_filters, coords):
 
-        nfids=self.get_nfiles()
-        allowed_fids=np.zeros(nfids, int)
-        if len(fids)>0:
-            for f in fids:
-                fix=np.where(np.asarray(self.fids)==f)
-                if len(fix[0])>0:
-                    allowed_fids[fix[0][0]]=1
-        nfids_allowed=int(sum(allowed_fids))
+        if isinstance(fids, np.ndarray) and fids.dtype==bool:
+            fid_mask=fids
+        else:
+            fid_mask=get_fid_mask(fids)
+        var_fids=np.asarray(self.fids, dtype=np.int64)
+        in_mask=(var_fids>=0) & (var_fids<len(fid_mask))
+        allowed=np.zeros(len(var_fids), bool)
+        allowed[in_mask]=fid_mask[var_fids[in_mask]]
         coords_in_range=True 
-        if len(coord_filters)>0 and nfids_allowed>0:
+        if len(coord_filters)>0 and np.any(allowed):
             for d in range(self.ndims):
                 this_cids=self.get_cids_for_dim(d)
                 cname=coords[this_cids[0]].name
@@ -1171,43 +1741,39 @@ class Variable_metadata:
                 matches=np.asarray([cname.find(coord_filter.name) for coord_filter in coord_filters])
                 filter_ix=np.where(matches>=0)
                 if len(filter_ix[0])>0:
-                    if coord_filters[filter_ix[0][0]].min_val!=None or coord_filters[filter_ix[0][0]].max_val!=None:
+                    coord_filter=coord_filters[filter_ix[0][0]]
+                    if coord_filter.min_val!=None or coord_filter.max_val!=None:
                         # we need to check this dimension
-                        ncids=len(this_cids)
-                        if ncids==1:
+                        if len(this_cids)==1:
                             # there is only 1 coord for all files so this coord must cover the range
                             cmin, cmax, cdelta=coords[this_cids[0]].get_min_max_delta()
                         else:
                             # range must be covered by all the cids and need to work out which files are in the range
-                            for c in range(ncids):
-                                if allowed_fids[c]==1:
-                                    this_cmin, this_cmax, cdelta=coords[this_cids[c]].get_min_max_delta()
-                                    if coord_filters[filter_ix[0][0]].min_val!=None:
-                                        if this_cmax<coord_filters[filter_ix[0][0]].min_val:
-                                            # dont need this as it ends before min required
-                                            allowed_fids[c]=0
-                                    if coord_filters[filter_ix[0][0]].max_val!=None:
-                                        if this_cmin>coord_filters[filter_ix[0][0]].max_val:
-                                            # dont need this as it starts after max required
-                                            allowed_fids[c]=0
-                                    # find overall min and max
-                                    if c==0:
-                                         cmin=this_cmin
-                                         cmax=this_cmax
-                                    else:
-                                         cmin=np.amin([cmin,this_cmin])
-                                         cmax=np.amax([cmax,this_cmax])
+                            # the min and max of each different cid are only worked out once
+                            unique_cids, cixes=np.unique(this_cids, return_inverse=True)
+                            ranges=np.asarray([coords[cid].get_min_max_delta()[:2] for cid in unique_cids], dtype=float)
+                            this_cmins=ranges[cixes,0]
+                            this_cmaxs=ranges[cixes,1]
+                            # find overall min and max of the allowed files
+                            cmin=np.amin(this_cmins[allowed])
+                            cmax=np.amax(this_cmaxs[allowed])
+                            if coord_filter.min_val!=None:
+                                # dont need the files that end before min required
+                                allowed&=~(this_cmaxs<coord_filter.min_val)
+                            if coord_filter.max_val!=None:
+                                # dont need the files that start after max required
+                                allowed&=~(this_cmins>coord_filter.max_val)
 
                         #check that fids cover the whole range
-                        if coord_filters[filter_ix[0][0]].min_val!=None:
-                            if cmin>coord_filters[filter_ix[0][0]].min_val:                
+                        if coord_filter.min_val!=None:
+                            if cmin>coord_filter.min_val:                
                                 coords_in_range=False    
-                        if coord_filters[filter_ix[0][0]].max_val!=None:
-                            if cmax<coord_filters[filter_ix[0][0]].max_val:
+                        if coord_filter.max_val!=None:
+                            if cmax<coord_filter.max_val:
                                 coords_in_range=False
         # save the allowed_fids
-        self.allowed_fids=allowed_fids
-        nfids_allowed=int(sum(allowed_fids))
+        self.allowed_fids=allowed.astype(int)
+        nfids_allowed=int(np.count_nonzero(allowed))
         return coords_in_range, nfids_allowed
 
 
@@ -1230,7 +1796,7 @@ class Variable_metadata:
     # print info
     #---------------------------------------------------------------------------
     def print(self):
-        print('vid=',self.vid, self.name, 'ndims=', self.ndims, 'nfids=',len(self.fids))
+        print('vid=',self.vid, self.name, 'ndims=', self.ndims, 'nfids=',self.get_nfiles())
         if len(self.fids)<5:
             print('\tfids=', self.fids)
         for d in range(self.ndims):
@@ -1257,6 +1823,139 @@ def read_all_directories(cur):
 
     return dirpaths
 
+#----------------------------------------------------------------------------------------------------------
+# add the size column to the Files table of a database created before it was used to check for changed files
+#----------------------------------------------------------------------------------------------------------
+def add_file_size_column(cur):
+    column_names=[row[1] for row in cur.execute("""PRAGMA table_info(Files)""").fetchall()]
+    if 'size' not in column_names:
+        cur.execute("""ALTER TABLE Files ADD COLUMN size INTEGER""")
+
+#----------------------------------------------------------------------------------------------------------
+# add the epoch_min, epoch_max, delta_seconds and is_time columns to the Coords table of a database created
+# before they were added and fill them in
+# returns:
+#    the number of coords updated, 0 if the columns were already there
+#----------------------------------------------------------------------------------------------------------
+def add_coord_epoch_columns(cur):
+    if has_coord_epoch_columns(cur):
+        return 0
+    for column in ['epoch_min REAL', 'epoch_max REAL', 'delta_seconds REAL', 'is_time INTEGER']:
+        cur.execute("ALTER TABLE Coords ADD COLUMN "+column)
+    coords=read_coords_in_bulk(cur)
+    cur.executemany("""UPDATE Coords SET epoch_min=?, epoch_max=?, delta_seconds=?, is_time=? WHERE cid=?""",
+                    [this_coord.get_epoch_range()+(this_coord.cid,) for this_coord in coords])
+    return len(coords)
+
+#----------------------------------------------------------------------------------------------------------
+# returns a numpy boolean array indexed by fid which is True for the fids given
+#----------------------------------------------------------------------------------------------------------
+def get_fid_mask(fids):
+    fids=np.asarray(fids, dtype=np.int64)
+    if len(fids)>0:
+        fid_mask=np.zeros(int(np.amax(fids))+1, bool)
+        fid_mask[fids]=True
+    else:
+        fid_mask=np.zeros(0, bool)
+    return fid_mask
+
+#----------------------------------------------------------------------------------------------------------
+# delete the rows of table where column is one of ids, this is done in chunks using IN so the table
+# is only scanned once for each chunk rather than once for each id
+# cur may be a cursor or a Db_writer
+#----------------------------------------------------------------------------------------------------------
+def delete_rows(cur, table, column, ids, chunk_size=500):
+    ids=list(ids)
+    for i in range(0,len(ids),chunk_size):
+        chunk=ids[i:i+chunk_size]
+        sql="DELETE FROM {table} WHERE {column} IN ({marks})".format(table=table, column=column, marks=','.join(['?']*len(chunk)))
+        cur.execute(sql, tuple(chunk))
+
+#----------------------------------------------------------------------------------------------------------
+# find the vids of the variables in any of the files fids
+#----------------------------------------------------------------------------------------------------------
+def select_vids_of_fids(cur, fids, chunk_size=500):
+    fids=list(fids)
+    vids=set()
+    for i in range(0,len(fids),chunk_size):
+        chunk=fids[i:i+chunk_size]
+        sql="SELECT DISTINCT vid FROM Coords_Fids_Of_Variables WHERE fid IN ({marks})".format(marks=','.join(['?']*len(chunk)))
+        vids.update([row[0] for row in cur.execute(sql, tuple(chunk)).fetchall()])
+    return sorted(vids)
+
+#----------------------------------------------------------------------------------------------------------
+# The links between variables, files and coordinates are written to the Staged_Links table, one row for
+# each dimension of each variable in each file, as the files are read. At the end compact_staged_links()
+# writes them to Coords_Fids_Of_Variables in a few SQL statements.
+#----------------------------------------------------------------------------------------------------------
+def create_staging_table(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS Staged_Links(vid INTEGER, fid INTEGER, dimix INTEGER, cid INTEGER)")
+
+#----------------------------------------------------------------------------------------------------------
+# copy the links of variables vids already in Coords_Fids_Of_Variables into the Staged_Links table, except
+# for the files exclude_fids, so they can be compacted again with the links of new files. Used when updating.
+#----------------------------------------------------------------------------------------------------------
+def expand_links_to_staging(cur, vids, exclude_fids=[]):
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Expand_Vids(vid INTEGER PRIMARY KEY)")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Excluded_Fids(fid INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM Expand_Vids")
+    cur.execute("DELETE FROM Excluded_Fids")
+    cur.executemany("INSERT OR IGNORE INTO Expand_Vids(vid) VALUES (?)", [(vid,) for vid in vids])
+    cur.executemany("INSERT OR IGNORE INTO Excluded_Fids(fid) VALUES (?)", [(fid,) for fid in exclude_fids])
+    # the rows with a cid for each file
+    cur.execute("""INSERT INTO Staged_Links (vid, fid, dimix, cid)
+                   SELECT vid, fid, dimix, cid FROM Coords_Fids_Of_Variables
+                   WHERE vid IN (SELECT vid FROM Expand_Vids) AND fid>=0 AND fid NOT IN (SELECT fid FROM Excluded_Fids)""")
+    # a row with fid=-1 means all the files have that cid for that dimension
+    cur.execute("""INSERT INTO Staged_Links (vid, fid, dimix, cid)
+                   SELECT f.vid, f.fid, c.dimix, c.cid FROM
+                       (SELECT DISTINCT vid, fid FROM Coords_Fids_Of_Variables
+                        WHERE vid IN (SELECT vid FROM Expand_Vids) AND fid>=0 AND fid NOT IN (SELECT fid FROM Excluded_Fids)) AS f
+                       JOIN (SELECT vid, dimix, cid FROM Coords_Fids_Of_Variables
+                             WHERE vid IN (SELECT vid FROM Expand_Vids) AND fid=-1) AS c ON c.vid=f.vid""")
+
+#----------------------------------------------------------------------------------------------------------
+# read the number of files and the different cids of each dimension for each variable in Staged_Links
+# returns:
+#    dictionary of vid to (nfids, dim_cids) where dim_cids is a dictionary of dimix to a list of cids
+#----------------------------------------------------------------------------------------------------------
+def read_staged_links_summary(cur):
+    summary={}
+    for vid, nfids in cur.execute("""SELECT vid, COUNT(DISTINCT fid) FROM Staged_Links GROUP BY vid""").fetchall():
+        summary[vid]=(nfids, {})
+    for vid, dimix, cid in cur.execute("""SELECT vid, dimix, cid FROM Staged_Links GROUP BY vid, dimix, cid ORDER BY vid, dimix, MIN(fid)""").fetchall():
+        summary[vid][1].setdefault(dimix, []).append(cid)
+    return summary
+
+#----------------------------------------------------------------------------------------------------------
+# write the links in Staged_Links into Coords_Fids_Of_Variables and drop Staged_Links
+# If the cids for a dimension are the same for all fids we save space in the database by saving a single
+# row for this cid with fid=-1, however the variable must have a multi dimension (a dimension with different
+# cids) to do this as we need to store all the fids somewhere.
+# Any rows already in Coords_Fids_Of_Variables for the staged variables are replaced.
+# The rows for each variable are written in the order of the dimensions and then the fids.
+#----------------------------------------------------------------------------------------------------------
+def compact_staged_links(cur, verbose=False):
+    cur.execute("""DELETE FROM Coords_Fids_Of_Variables WHERE vid IN (SELECT vid FROM Staged_Links)""")
+    # the number of different cids for each dimension of each variable
+    cur.execute("""CREATE TEMP TABLE Dim_Stats AS SELECT vid, dimix, COUNT(DISTINCT cid) AS ncids, MIN(cid) AS cid
+                   FROM Staged_Links GROUP BY vid, dimix""")
+    # the variables that have a multi dimension
+    cur.execute("""CREATE TEMP TABLE Multi_Vars AS SELECT DISTINCT vid FROM Dim_Stats WHERE ncids>1""")
+    cur.execute("""INSERT INTO Coords_Fids_Of_Variables (vid, cid, fid, dimix)
+                   SELECT vid, cid, fid, dimix FROM (
+                       SELECT d.vid, d.cid, -1 AS fid, d.dimix FROM Dim_Stats AS d
+                           WHERE d.ncids=1 AND d.vid IN (SELECT vid FROM Multi_Vars)
+                       UNION ALL
+                       SELECT s.vid, s.cid, s.fid, s.dimix FROM Staged_Links AS s JOIN Dim_Stats AS d ON s.vid=d.vid AND s.dimix=d.dimix
+                           WHERE d.ncids>1 OR d.vid NOT IN (SELECT vid FROM Multi_Vars))
+                   ORDER BY vid, dimix, fid""")
+    if verbose:
+        print('compact_staged_links():', cur.rowcount, 'rows written to Coords_Fids_Of_Variables')
+    cur.execute("DROP TABLE Dim_Stats")
+    cur.execute("DROP TABLE Multi_Vars")
+    cur.execute("DROP TABLE Staged_Links")
+
 #-----------------------------------------------------------
 # functions to select certain rows of variables and coords
 #-----------------------------------------------------------
@@ -1267,6 +1966,354 @@ def select_all_variables(cur, order=False):
         res=cur.execute("""SELECT vid,name,ndims FROM Variables""")
     return res.fetchall()
 
+#----------------------------------------------------------------------------------------------------------
+# read the variables of var_rows (rows of vid, name, ndims from the Variables table) reading each of
+# Coords_Fids_Of_Variables and Var_Attributes once rather than twice for each variable.
+# The rows are read ordered by vid into numpy arrays, chunk_size rows at a time, and split into
+# the rows of each variable by finding the group boundaries with searchsorted.
+# returns:
+#    list of Variable_metadata in the same order as var_rows
+#----------------------------------------------------------------------------------------------------------
+def read_variables_in_bulk(cur, var_rows, verbose=False, chunk_size=1000000):
+    if len(var_rows)==0:
+        return []
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Bulk_Vids(vid INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM Bulk_Vids")
+    cur.executemany("INSERT OR IGNORE INTO Bulk_Vids (vid) VALUES (?)", [(row[0],) for row in var_rows])
+
+    # the links of each variable in the order init_from_database reads them
+    res=cur.execute("""SELECT vid, cid, fid, dimix FROM Coords_Fids_Of_Variables
+                       WHERE vid IN (SELECT vid FROM Bulk_Vids) ORDER BY vid, dimix, fid""")
+    chunks=[]
+    rows=res.fetchmany(chunk_size)
+    while len(rows)>0:
+        chunks.append(np.asarray(rows, dtype=np.int64))
+        rows=res.fetchmany(chunk_size)
+    if len(chunks)>0:
+        links=np.concatenate(chunks)
+    else:
+        links=np.zeros((0,4), np.int64)
+    link_vids=links[:,0]
+
+    attr_rows=cur.execute("""SELECT vid, name, value FROM Var_Attributes
+                             WHERE vid IN (SELECT vid FROM Bulk_Vids) ORDER BY vid, rowid""").fetchall()
+    attr_vids=np.asarray([attr_row[0] for attr_row in attr_rows], dtype=np.int64)
+    cur.execute("DROP TABLE Bulk_Vids")
+
+    vids=np.asarray([row[0] for row in var_rows], dtype=np.int64)
+    link_starts=np.searchsorted(link_vids, vids, side='left')
+    link_ends=np.searchsorted(link_vids, vids, side='right')
+    attr_starts=np.searchsorted(attr_vids, vids, side='left')
+    attr_ends=np.searchsorted(attr_vids, vids, side='right')
+    variables=[None]*len(var_rows)
+    for v, row in enumerate(var_rows):
+        attributes=[Attribute(attr_row[1], attr_row[2]) for attr_row in attr_rows[attr_starts[v]:attr_ends[v]]]
+        variables[v]=Variable_metadata(row, links[link_starts[v]:link_ends[v],1:], attributes, verbose)
+    return variables
+
+#----------------------------------------------------------------------------------------------------------
+# search the text attributes for all the words in text, eg. 'sea surface temperature' finds the attributes
+# with a value containing sea, surface and temperature. A word also matches longer words that start with it.
+# The Attribute_Text full-text index is used and the matches are ranked by how well they match. If the
+# database does not have the index the attribute tables are searched with LIKE and the matches are in
+# id order.
+# returns:
+#    vids - the vids of the variables with an attribute that matches or with a coord with an attribute that matches
+#    fids - the fids of the files with a global attribute that matches
+#----------------------------------------------------------------------------------------------------------
+def search_attribute_text(cur, text):
+    words=text.split()
+    if len(words)==0:
+        return [], []
+    matches={}
+    if has_text_index(cur):
+        query=' '.join('"'+word.replace('"', '""')+'"*' for word in words)
+        res=cur.execute("""SELECT kind, id, MIN(rank) AS best FROM Attribute_Text WHERE Attribute_Text MATCH ?
+                           GROUP BY kind, id ORDER BY best""", (query,))
+        for kind, this_id, rank in res.fetchall():
+            matches.setdefault(kind, []).append(this_id)
+    else:
+        condition=' AND '.join(["value LIKE ?"]*len(words))
+        for kind, id_column, table in text_index_sources:
+            res=cur.execute("SELECT DISTINCT "+id_column+" FROM "+table+" WHERE typeof(value)='text' AND "+condition+
+                            " ORDER BY "+id_column, ['%'+word+'%' for word in words])
+            matches[kind]=[row[0] for row in res.fetchall()]
+
+    vids=matches.get('variable', [])
+    cids=matches.get('coord', [])
+    if len(cids)>0:
+        # the variables with these coords come after the variables that matched themselves
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS Text_Cids(cid INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM Text_Cids")
+        cur.executemany("INSERT INTO Text_Cids (cid) VALUES (?)", [(cid,) for cid in cids])
+        coord_vids=[row[0] for row in cur.execute("""SELECT DISTINCT vid FROM Coords_Fids_Of_Variables
+                                                     WHERE cid IN (SELECT cid FROM Text_Cids) ORDER BY vid""").fetchall()]
+        cur.execute("DROP TABLE Text_Cids")
+        found=set(vids)
+        vids=vids+[vid for vid in coord_vids if vid not in found]
+    return vids, matches.get('file', [])
+
+#----------------------------------------------------------------------------------------------------------
+# find which files of which variables match a search with one query rather than reading every variable
+# and checking it with Variable_metadata.check_fids_and_filters()
+# The files must be in directory did (-1 for all directories) and match filename_exp (see get_filename_condition()),
+# the variable must be called variable ('*' for all variables) and the coordinates of each dimension with
+# a coord_filter are compared with the filter range. The filter of a dimension is the first one whose name
+# is part of the coordinate name. Time coordinates are compared using the epoch_min and epoch_max
+# columns of the Coords table, so the database must have them (see add_coord_epoch_columns()).
+# A file is left out if the coordinate of any of its dimensions is outside a filter range and a variable
+# is in range if the coordinates of its remaining files cover the whole range of every filter.
+# If text_vids and text_fids are given (see search_attribute_text()) only the variables in text_vids and
+# the files in text_fids of the other variables are kept.
+# If vids is given only those variables are searched, so a large search can be done a block at a time.
+# returns:
+#    list of (vid, in_range, fids) in vid order for each variable with at least one file left, where fids
+#    is a numpy array of the fids of the files left
+#----------------------------------------------------------------------------------------------------------
+def select_valid_variables(cur, did, filename_exp, coord_filters, variable='*', text_vids=None, text_fids=None, vids=None):
+    filename_condition, filename_value=get_filename_condition(cur, filename_exp, 'f.filename', '?2')
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Query_Filters(fix INTEGER PRIMARY KEY, name TEXT, min_val REAL, max_val REAL)")
+    cur.execute("DELETE FROM Query_Filters")
+    cur.executemany("INSERT INTO Query_Filters (fix, name, min_val, max_val) VALUES (?,?,?,?)",
+                    [(i, coord_filter.name, coord_filter.min_val, coord_filter.max_val) for i, coord_filter in enumerate(coord_filters)])
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Query_Vids(vid INTEGER PRIMARY KEY)")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Query_Fids(fid INTEGER PRIMARY KEY)")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS Query_Block(vid INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM Query_Vids")
+    cur.execute("DELETE FROM Query_Fids")
+    cur.execute("DELETE FROM Query_Block")
+    conditions=["(l.fid=-1 OR ((?1=-1 OR f.did=?1) AND "+filename_condition+"))",
+                "(?3='*' OR l.vid IN (SELECT vid FROM Variables WHERE name=?3))",
+                "(?4=0 OR l.fid=-1 OR l.vid IN (SELECT vid FROM Query_Vids) OR l.fid IN (SELECT fid FROM Query_Fids))"]
+    # the block is only in the SQL when it is needed so the links are then found from the index by vid
+    if vids!=None:
+        cur.executemany("INSERT OR IGNORE INTO Query_Block (vid) VALUES (?)", [(vid,) for vid in vids])
+        conditions.append("l.vid IN (SELECT vid FROM Query_Block)")
+    use_text=text_vids!=None or text_fids!=None
+    if use_text:
+        cur.executemany("INSERT OR IGNORE INTO Query_Vids (vid) VALUES (?)", [(vid,) for vid in (text_vids or [])])
+        cur.executemany("INSERT OR IGNORE INTO Query_Fids (fid) VALUES (?)", [(fid,) for fid in (text_fids or [])])
+
+    res=cur.execute("WITH "+get_valid_variables_ctes('', '', conditions)+" "+get_valid_variables_select('')+" ORDER BY vid, fid",
+                    (did, filename_value, variable, int(use_text)))
+    rows=np.asarray(res.fetchall(), dtype=np.int64).reshape(-1,3)
+    for table in ['Query_Filters', 'Query_Vids', 'Query_Fids', 'Query_Block']:
+        cur.execute("DROP TABLE "+table)
+    return split_valid_rows(rows)
+
+#----------------------------------------------------------------------------------------------------------
+# The common table expressions of the query in select_valid_variables() for the tables in schema, eg. 'cat0.'
+# or '' for the main database. The names of the expressions end with suffix so the expressions for several
+# databases can be in one query and the links are those that match all the conditions.
+# The filters must be in the Query_Filters table.
+#----------------------------------------------------------------------------------------------------------
+def get_valid_variables_ctes(schema, suffix, conditions):
+    return """
+        Coord_Ranges{n} AS MATERIALIZED (
+            SELECT c.cid, q.min_val AS fmin, q.max_val AS fmax,
+                   CASE WHEN c.is_time=1 THEN c.epoch_min ELSE c.min_val END AS cmin,
+                   CASE WHEN c.is_time=1 THEN c.epoch_max ELSE c.max_val END AS cmax
+            FROM {s}Coords c JOIN Query_Filters q
+            ON q.fix=(SELECT MIN(fix) FROM Query_Filters WHERE instr(c.name, name)>0)),
+        Links{n} AS MATERIALIZED (
+            SELECT l.vid, l.fid, l.dimix, r.fmin, r.fmax, r.cmin, r.cmax
+            FROM {s}Coords_Fids_Of_Variables l
+            LEFT JOIN {s}Files f ON f.fid=l.fid
+            LEFT JOIN Coord_Ranges{n} r ON r.cid=l.cid
+            WHERE {c}),
+        Dim_Ranges{n} AS (
+            SELECT vid, MIN(cmin) AS dmin, MAX(cmax) AS dmax, MIN(fmin) AS fmin, MIN(fmax) AS fmax
+            FROM Links{n} GROUP BY vid, dimix),
+        Coverage{n} AS (
+            SELECT vid, MIN(COALESCE(dmin>fmin, 0)=0 AND COALESCE(dmax<fmax, 0)=0) AS in_range
+            FROM Dim_Ranges{n} GROUP BY vid),
+        File_Ranges{n} AS (
+            SELECT vid, fid, MAX(COALESCE(cmax<fmin, 0) OR COALESCE(cmin>fmax, 0)) AS excluded
+            FROM Links{n} WHERE fid>=0 GROUP BY vid, fid)""".format(s=schema, n=suffix, c='\n            AND '.join(conditions))
+
+# the files left of the variables found by the expressions of get_valid_variables_ctes() with suffix
+def get_valid_variables_select(suffix):
+    return """SELECT fr.vid AS vid, cv.in_range AS in_range, fr.fid AS fid FROM File_Ranges{n} fr JOIN Coverage{n} cv
+        ON cv.vid=fr.vid WHERE fr.excluded=0""".format(n=suffix)
+
+#----------------------------------------------------------------------------------------------------------
+# split the (vid, in_range, fid) rows in vid order found by a valid variables query into the fids of each variable
+# returns:
+#    list of (vid, in_range, fids) in vid order where fids is a numpy array
+#----------------------------------------------------------------------------------------------------------
+def split_valid_rows(rows):
+    vids, starts=np.unique(rows[:,0], return_index=True)
+    ends=np.append(starts[1:], len(rows))
+    return [(int(vids[v]), bool(rows[starts[v],1]), rows[starts[v]:ends[v],2]) for v in range(len(vids))]
+
+#----------------------------------------------------------------------------------------------------------
+# A federated catalogue lets several databases be searched with one SQL statement rather than a query for
+# each of them. The databases are ATTACHed read only to an in-memory database as cat0, cat1, ... and the temp
+# views Federated_Directories, Federated_Files, Federated_Variables, Federated_Coords and Federated_Links join
+# up their tables with a dbix column, the index of the database in dbnames, so (dbix, did), (dbix, fid),
+# (dbix, vid) and (dbix, cid) identify a directory, file, variable or coord in all of them.
+# SQLite can only have a limited number of databases attached at once (10 unless it was compiled with more)
+# so the databases are split into batches of up to that many and attach_batch() replaces the databases
+# of the previous batch.
+#----------------------------------------------------------------------------------------------------------
+class Federated_catalogue:
+
+    # the name of each view, the table it joins up and the columns it has, a column a database does not
+    # have, eg. the epoch columns of Coords in an older database, is NULL
+    views=[
+        ('Federated_Directories', 'Directories', ['did', 'dirpath']),
+        ('Federated_Files', 'Files', ['fid', 'did', 'filename', 'size']),
+        ('Federated_Variables', 'Variables', ['vid', 'name', 'ndims']),
+        ('Federated_Coords', 'Coords', ['cid', 'name', 'nvals', 'min_val', 'max_val', 'delta', 'epoch_min', 'epoch_max', 'delta_seconds', 'is_time']),
+        ('Federated_Links', 'Coords_Fids_Of_Variables', ['vid', 'cid', 'fid', 'dimix']),
+        ]
+
+    def __init__(self, dbnames, verbose=False):
+        self.dbnames=dbnames
+        self.verbose=verbose
+        # the databases are attached with a URI so they can be read only
+        self.con=sqlite3.connect('file::memory:', uri=True, check_same_thread=False)
+        self.cur=self.con.cursor()
+        if hasattr(self.con, 'getlimit'):
+            max_attached=self.con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        else:
+            # before python 3.11 the limit can't be read so use the default
+            max_attached=10
+        self.batches=[list(range(first, min(first+max_attached, len(dbnames)))) for first in range(0, len(dbnames), max_attached)]
+        self.batch=[]
+        self.has_epoch_columns=False
+
+    # the schema name of database dbix in the batch attached
+    def get_schema(self, dbix):
+        return 'cat{}'.format(self.batch.index(dbix))
+
+    #------------------------------------------------------------------------------------------------------
+    # attach the databases of batch, a list of dbix, instead of the ones attached and make the views of them
+    #------------------------------------------------------------------------------------------------------
+    def attach_batch(self, batch):
+        if batch==self.batch:
+            return
+        for view, table, columns in Federated_catalogue.views:
+            self.cur.execute("DROP VIEW IF EXISTS "+view)
+        for b in range(len(self.batch)):
+            self.cur.execute("DETACH DATABASE cat{}".format(b))
+        self.batch=[]
+        for b, dbix in enumerate(batch):
+            if self.verbose:
+                print('Federated_catalogue.attach_batch() attaching', self.dbnames[dbix], 'as', 'cat{}'.format(b))
+            self.cur.execute("ATTACH DATABASE ? AS cat{}".format(b), ('file:'+pathname2url(os.path.abspath(self.dbnames[dbix]))+'?mode=ro',))
+        self.batch=list(batch)
+
+        self.has_epoch_columns=True
+        for view, table, columns in Federated_catalogue.views:
+            selects=[]
+            for dbix in self.batch:
+                schema=self.get_schema(dbix)
+                table_columns=[row[1] for row in self.cur.execute("PRAGMA "+schema+".table_info("+table+")").fetchall()]
+                if table=='Coords' and 'epoch_min' not in table_columns:
+                    self.has_epoch_columns=False
+                selects.append("SELECT {dbix} AS dbix, ".format(dbix=dbix)+
+                               ", ".join([column if column in table_columns else "NULL AS "+column for column in columns])+
+                               " FROM "+schema+"."+table)
+            self.cur.execute("CREATE TEMP VIEW "+view+" AS "+" UNION ALL ".join(selects))
+
+    #------------------------------------------------------------------------------------------------------
+    # the different variable names in all the databases of the batch in name order
+    #------------------------------------------------------------------------------------------------------
+    def select_variable_names(self):
+        return [row[0] for row in self.cur.execute("""SELECT DISTINCT name FROM Federated_Variables ORDER BY name""").fetchall()]
+
+    #------------------------------------------------------------------------------------------------------
+    # the (vid, name, ndims) rows of the variables called one of names in each database of the batch
+    # returns:
+    #    dictionary of dbix to the rows of that database in name order
+    #------------------------------------------------------------------------------------------------------
+    def select_variable_rows(self, names):
+        self.set_query_names(names)
+        var_rows={}
+        for dbix, vid, name, ndims in self.cur.execute("""SELECT dbix, vid, name, ndims FROM Federated_Variables
+                                                           WHERE name IN (SELECT name FROM Query_Names) ORDER BY name, dbix, vid""").fetchall():
+            var_rows.setdefault(dbix, []).append((vid, name, ndims))
+        self.cur.execute("DROP TABLE Query_Names")
+        return var_rows
+
+    def set_query_names(self, names):
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS Query_Names(name TEXT PRIMARY KEY)")
+        self.cur.execute("DELETE FROM Query_Names")
+        self.cur.executemany("INSERT OR IGNORE INTO Query_Names (name) VALUES (?)", [(name,) for name in names])
+
+    #------------------------------------------------------------------------------------------------------
+    # find which files of the variables called one of names match a search in all the databases of the batch
+    # with one query. It is the same search as select_valid_variables() except that the directory is given
+    # by its dirpath ('*' for all directories) as the dids of each database are different. All the
+    # databases of the batch must have the epoch columns in their Coords table.
+    # returns:
+    #    list of (dbix, vid, in_range, fids) in dbix, vid order for each variable with at least one file
+    #    left, where fids is a numpy array of the fids of the files left
+    #------------------------------------------------------------------------------------------------------
+    def select_valid_variables(self, dirpath, filename_exp, coord_filters, names):
+        if self.has_epoch_columns==False:
+            raise ValueError('Federated_catalogue.select_valid_variables() all the databases must have the epoch columns, see add_coord_epoch_columns()')
+        filename_condition, filename_value=get_filename_condition(self.cur, filename_exp, 'f.filename', '?2')
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS Query_Filters(fix INTEGER PRIMARY KEY, name TEXT, min_val REAL, max_val REAL)")
+        self.cur.execute("DELETE FROM Query_Filters")
+        self.cur.executemany("INSERT INTO Query_Filters (fix, name, min_val, max_val) VALUES (?,?,?,?)",
+                             [(i, coord_filter.name, coord_filter.min_val, coord_filter.max_val) for i, coord_filter in enumerate(coord_filters)])
+        self.set_query_names(names)
+
+        ctes=[]
+        selects=[]
+        for dbix in self.batch:
+            schema=self.get_schema(dbix)+'.'
+            conditions=["(l.fid=-1 OR ((?1='*' OR f.did IN (SELECT did FROM "+schema+"Directories WHERE dirpath=?1)) AND "+filename_condition+"))",
+                        "l.vid IN (SELECT vid FROM "+schema+"Variables WHERE name IN (SELECT name FROM Query_Names))"]
+            ctes.append(get_valid_variables_ctes(schema, dbix, conditions))
+            selects.append("SELECT {dbix} AS dbix, * FROM (".format(dbix=dbix)+get_valid_variables_select(dbix)+")")
+        res=self.cur.execute("WITH "+",".join(ctes)+" "+" UNION ALL ".join(selects)+" ORDER BY dbix, vid, fid", (dirpath, filename_value))
+        rows=np.asarray(res.fetchall(), dtype=np.int64).reshape(-1,4)
+        for table in ['Query_Filters', 'Query_Names']:
+            self.cur.execute("DROP TABLE "+table)
+
+        valid_variables=[]
+        dbixes, starts=np.unique(rows[:,0], return_index=True)
+        ends=np.append(starts[1:], len(rows))
+        for d in range(len(dbixes)):
+            valid_variables.extend([(int(dbixes[d]),)+valid for valid in split_valid_rows(rows[starts[d]:ends[d],1:])])
+        return valid_variables
+
+    # stop the query that is running, this can be called from another thread
+    def interrupt(self):
+        self.con.interrupt()
+
+    def close(self):
+        self.con.close()
+
+#----------------------------------------------------------------------------------------------------------
+# get the variable names starting with prefix in name order, limit at a time, so the names don't all have
+# to be read to choose one. If after is given only the names after it are returned, eg. the last name of
+# the previous call. The names are found from the Variables_name index.
+# returns:
+#    list of up to limit names
+#----------------------------------------------------------------------------------------------------------
+def select_variable_names(cur, prefix='', after=None, limit=100):
+    conditions=[]
+    params=[]
+    if after!=None:
+        conditions.append("name>?")
+        params.append(after)
+    elif prefix!='':
+        conditions.append("name>=?")
+        params.append(prefix)
+    if prefix!='':
+        # the names starting with prefix are less than prefix with its last character incremented
+        conditions.append("name<?")
+        params.append(prefix[:-1]+chr(ord(prefix[-1])+1))
+    sql="SELECT DISTINCT name FROM Variables"
+    if len(conditions)>0:
+        sql=sql+" WHERE "+" AND ".join(conditions)
+    res=cur.execute(sql+" ORDER BY name LIMIT ?", params+[limit])
+    return [row[0] for row in res.fetchall()]
+
 def select_variables_by_name(name,cur):
     res=cur.execute("""SELECT vid,name,ndims FROM Variables WHERE name=?""", (name,))
     return res.fetchall()
@@ -1280,12 +2327,154 @@ def select_cid_fid_of_variables_by_vid(cur,vid):
     res=cur.execture(sql, (vid,))
     return res.fetchall()
 
+#----------------------------------------------------------------------------------------------------------
+# read all the coords with one query each of Coords, Coord_Attributes and Discrete_Coord_Values rather
+# than two queries for each coord. The rows are read in cid order and split into the rows of each coord
+# by finding the group boundaries with searchsorted.
+# returns:
+#    list of Coord_metadata in cid order
+#----------------------------------------------------------------------------------------------------------
+def read_coords_in_bulk(cur):
+    rows=cur.execute("SELECT "+get_coord_columns(cur)+" FROM Coords ORDER BY cid").fetchall()
+    cids=np.asarray([row[0] for row in rows], dtype=np.int64)
+
+    attr_rows=cur.execute("""SELECT cid, name, value FROM Coord_Attributes ORDER BY cid, rowid""").fetchall()
+    attr_cids=np.asarray([attr_row[0] for attr_row in attr_rows], dtype=np.int64)
+    attr_starts=np.searchsorted(attr_cids, cids, side='left')
+    attr_ends=np.searchsorted(attr_cids, cids, side='right')
+
+    value_rows=cur.execute("""SELECT cid, value FROM Discrete_Coord_Values ORDER BY cid, rowid""").fetchall()
+    value_cids=np.asarray([value_row[0] for value_row in value_rows], dtype=np.int64)
+    values=np.asarray([value_row[1] for value_row in value_rows], dtype=np.float64)
+    value_starts=np.searchsorted(value_cids, cids, side='left')
+    value_ends=np.searchsorted(value_cids, cids, side='right')
+
+    coords=[None]*len(rows)
+    for c, row in enumerate(rows):
+        if value_ends[c]>value_starts[c]:
+            coord_values=values[value_starts[c]:value_ends[c]]
+        else:
+            coord_values=[]
+        coords[c]=Coord_metadata(row, [attr_row[1:] for attr_row in attr_rows[attr_starts[c]:attr_ends[c]]], coord_values)
+    return coords
+
+#----------------------------------------------------------------------------------------------------------
+# dictionary-encode values, ie. replace each value by the index of that value in a list of the different values
+# the type is part of the key so that eg. 1 and 1.0 are kept apart
+# returns:
+#    numpy array of the index of each value and the list of different values
+#----------------------------------------------------------------------------------------------------------
+def encode_values(values):
+    codes={}
+    unique_values=[]
+    ixes=np.zeros(len(values), np.int32)
+    for i, value in enumerate(values):
+        key=(type(value), value)
+        if key not in codes:
+            codes[key]=len(unique_values)
+            unique_values.append(value)
+        ixes[i]=codes[key]
+    return ixes, unique_values
+
+#--------------------------------------------------
+# Coord_columns holds all the coords of a database as numpy arrays rather than as one Coord_metadata for
+# each coord, so it takes much less memory for a large database. The columns of the Coords table are
+# in the structured array columns, the names and the names and values of the attributes are
+# dictionary-encoded and the discrete values of all the coords are in one array.
+# coords[cid] gives the Coord_metadata for a coord, which is only made the first time it is asked for.
+#--------------------------------------------------
+class Coord_columns:
+
+    dtype=[('cid', np.int64), ('name', np.int32), ('nvals', np.int64), ('min_val', np.float64), ('max_val', np.float64),
+           ('delta', np.float64), ('epoch_min', np.float64), ('epoch_max', np.float64), ('delta_seconds', np.float64),
+           ('is_time', np.int8)]
+
+    def __init__(self, cur):
+        self.has_epoch_columns=has_coord_epoch_columns(cur)
+        rows=cur.execute("SELECT "+get_coord_columns(cur)+" FROM Coords ORDER BY cid").fetchall()
+        ncolumns=len(rows[0]) if len(rows)>0 else 0
+        name_ixes, self.names=encode_values([row[1] for row in rows])
+        # None (NULL) is kept as nan in the float columns and -1 in is_time
+        self.columns=np.zeros(len(rows), Coord_columns.dtype)
+        for c, column in enumerate(Coord_columns.dtype[:ncolumns]):
+            if c==1:
+                self.columns['name']=name_ixes
+            elif column[1]==np.float64:
+                self.columns[column[0]]=[np.nan if row[c]==None else row[c] for row in rows]
+            else:
+                self.columns[column[0]]=[-1 if row[c]==None else row[c] for row in rows]
+        del rows
+
+        attr_rows=cur.execute("""SELECT cid, name, value FROM Coord_Attributes ORDER BY cid, rowid""").fetchall()
+        self.attr_cids=np.asarray([attr_row[0] for attr_row in attr_rows], dtype=np.int64)
+        self.attr_name_ixes, self.attr_names=encode_values([attr_row[1] for attr_row in attr_rows])
+        self.attr_value_ixes, self.attr_values=encode_values([attr_row[2] for attr_row in attr_rows])
+        del attr_rows
+
+        value_rows=cur.execute("""SELECT cid, value FROM Discrete_Coord_Values ORDER BY cid, rowid""").fetchall()
+        self.value_cids=np.asarray([value_row[0] for value_row in value_rows], dtype=np.int64)
+        self.values=np.asarray([value_row[1] for value_row in value_rows], dtype=np.float64)
+        del value_rows
+
+        # the Coord_metadata already made, by cid
+        self.coords={}
+
+    def __len__(self):
+        return len(self.columns)
+
+    # index of coord cid in the columns
+    def get_ix(self, cid):
+        ix=int(np.searchsorted(self.columns['cid'], cid))
+        if ix>=len(self.columns) or self.columns['cid'][ix]!=cid:
+            raise IndexError('Coord_columns: no coord with cid '+str(cid))
+        return ix
+
+    def get_name(self, cid):
+        return self.names[self.columns['name'][self.get_ix(cid)]]
+
+    def __getitem__(self, cid):
+        cid=int(cid)
+        if cid not in self.coords:
+            column_values=self.columns[self.get_ix(cid)]
+            row=[cid, self.names[column_values['name']], int(column_values['nvals'])]
+            for column in ['min_val', 'max_val', 'delta', 'epoch_min', 'epoch_max', 'delta_seconds']:
+                value=float(column_values[column])
+                row.append(None if np.isnan(value) else value)
+            row.append(None if column_values['is_time']<0 else int(column_values['is_time']))
+            if self.has_epoch_columns==False:
+                row=row[:6]
+            start, end=np.searchsorted(self.attr_cids, [cid, cid+1])
+            attr_rows=[(self.attr_names[self.attr_name_ixes[a]], self.attr_values[self.attr_value_ixes[a]]) for a in range(start, end)]
+            start, end=np.searchsorted(self.value_cids, [cid, cid+1])
+            if end>start:
+                values=self.values[start:end]
+            else:
+                values=[]
+            self.coords[cid]=Coord_metadata(row, attr_rows, values)
+        return self.coords[cid]
+
+#----------------------------------------------------------------------------------------------------------
+# the epoch columns of the Coords table are only in databases built since they were added
+#----------------------------------------------------------------------------------------------------------
+def has_coord_epoch_columns(cur):
+    column_names=[row[1] for row in cur.execute("""PRAGMA table_info(Coords)""").fetchall()]
+    return 'epoch_min' in column_names
+
+#----------------------------------------------------------------------------------------------------------
+# the columns to select from the Coords table
+#----------------------------------------------------------------------------------------------------------
+def get_coord_columns(cur):
+    columns='cid, name, nvals, min_val, max_val, delta'
+    if has_coord_epoch_columns(cur):
+        columns+=', epoch_min, epoch_max, delta_seconds, is_time'
+    return columns
+
 def select_all_coords(cur):
-    res=cur.execute("""SELECT cid, name, nvals, min_val, max_val, delta FROM Coords""")
+    res=cur.execute("SELECT "+get_coord_columns(cur)+" FROM Coords")
     return res.fetchall()
     
 def select_all_coords_like_name(cur,name, fetch_one):
-    res_coords=cur.execute("""SELECT cid, name, nvals, min_val, max_val, delta FROM Coords WHERE name LIKE ?""", (name+'%',))
+    res_coords=cur.execute("SELECT "+get_coord_columns(cur)+" FROM Coords WHERE name LIKE ?", (name+'%',))
     if fetch_one:
         rows=res_coords.fetchone()
     else:
@@ -0,0 +1,240 @@
+'''
+    Code to merge several databases built by build_metadata_db.py into one database.
+
+    A large directory tree can be split into several parts, each built into its own database (a shard)
+    at the same time, eg. on different nodes, and then merged into one catalogue with this.
+    The shards are merged in the order given. Each file in a shard is registered in the merged database
+    in the same way as if it had just been read by build_metadata_db.py: it is given the next fid and its
+    coordinates and variables are matched against those already in the merged database with
+    Coord_metadata.matches_coord() and Variable_metadata.matches_variable(). So a coordinate or variable
+    found in several shards only appears once and a variable whose coordinates are different in the files
+    of different shards gets its multi file dimension as it would in a single build.
+    None of the data files are opened, everything is read from the shards which are not changed.
+    If the same file is in more than one shard only the first one is used.
+
+    Usage:
+    python merge_metadata_db.py <database_name> <shard1 shard2 ...> <options -v=verbose>
+'''
+
+import sys
+import os
+import time
+import itertools
+from urllib.request import pathname2url
+from read_metadata_thread import *
+
+#-----------------------------------------------------------------------------------
+# read the rows of cur, which must be in fid order, a fid at a time
+# yields:
+#    fid, rows - the rows for each fid
+#-----------------------------------------------------------------------------------
+def group_by_fid(cur):
+    for fid, rows in itertools.groupby(cur, key=lambda row: row[0]):
+        yield fid, list(rows)
+
+#-----------------------------------------------------------------------------------
+# read the variables of a shard without their links to files
+# returns:
+#    dictionary of vid to (name, ndims, attributes, fixed_cids) where fixed_cids is a dictionary of
+#    dimix to cid for the dimensions which have the same coord in all the files of the variable
+#-----------------------------------------------------------------------------------
+def read_shard_variables(cur):
+    shard_vars={}
+    for vid, name, ndims in cur.execute("""SELECT vid, name, ndims FROM Variables""").fetchall():
+        shard_vars[vid]=(name, ndims, [], {})
+    for vid, name, value in cur.execute("""SELECT vid, name, value FROM Var_Attributes ORDER BY rowid""").fetchall():
+        shard_vars[vid][2].append(Attribute(name, value))
+    for vid, dimix, cid in cur.execute("""SELECT vid, dimix, cid FROM Coords_Fids_Of_Variables WHERE fid=-1""").fetchall():
+        shard_vars[vid][3][dimix]=cid
+    return shard_vars
+
+#-----------------------------------------------------------------------------------
+# rebuild the File_record of each file in a shard as if the file had just been read
+# inputs:
+#    con: connection to the shard
+#    shard_dirs: dictionary of the shard did to the Directory in the merged database
+#    known_files: set of (dirpath, filename) of the files already merged, the files are added to it
+# yields:
+#    the File_record for each file not already merged in fid order
+#-----------------------------------------------------------------------------------
+def read_shard_records(con, shard_dirs, known_files):
+    cur=con.cursor()
+    shard_coords={this_coord.cid:this_coord for this_coord in read_coords_in_bulk(cur)}
+    shard_vars=read_shard_variables(cur)
+
+    # the links and global attributes are read in fid order alongside the files
+    links=group_by_fid(con.cursor().execute("""SELECT fid, vid, dimix, cid FROM Coords_Fids_Of_Variables WHERE fid>=0 ORDER BY fid, vid, dimix"""))
+    attrs=group_by_fid(con.cursor().execute("""SELECT fid, name, value FROM Global_Attributes ORDER BY fid, rowid"""))
+    next_links=next(links, (None, []))
+    next_attrs=next(attrs, (None, []))
+
+    # SELECT * so this still works for shards built before the size column was added
+    for row in con.cursor().execute("""SELECT * FROM Files ORDER BY fid"""):
+        this_file=File_metadata(row, cur)
+        shard_fid=this_file.fid
+        file_links=[]
+        while next_links[0]!=None and next_links[0]<=shard_fid:
+            if next_links[0]==shard_fid:
+                file_links=next_links[1]
+            next_links=next(links, (None, []))
+        this_file.global_attributes=[]
+        while next_attrs[0]!=None and next_attrs[0]<=shard_fid:
+            if next_attrs[0]==shard_fid:
+                this_file.global_attributes=[Attribute(name, value) for fid, name, value in next_attrs[1]]
+            next_attrs=next(attrs, (None, []))
+
+        this_dir=shard_dirs[this_file.did]
+        if (this_dir.dirpath, this_file.filename) in known_files:
+            print('skipping', get_filepath(this_dir.dirpath, this_file.filename), 'as it is already in the merged database')
+            continue
+        known_files.add((this_dir.dirpath, this_file.filename))
+        this_file.did=this_dir.did
+
+        record=File_record(this_dir, this_file.filename)
+        record.ok=True
+        record.this_file=this_file
+        # the coords of this file in the record refer to their shard cid
+        coord_ixes={}
+        for vid, rows in itertools.groupby(file_links, key=lambda link: link[1]):
+            name, ndims, attributes, fixed_cids=shard_vars[vid]
+            dim_cids=dict(fixed_cids)
+            for fid, vid, dimix, cid in rows:
+                dim_cids[dimix]=cid
+            ixes=[]
+            for d in range(ndims):
+                cid=dim_cids[d]
+                if cid not in coord_ixes:
+                    coord_ixes[cid]=record.add_coord(shard_coords[cid])
+                ixes.append(coord_ixes[cid])
+            this_var=Variable_metadata(UNKNOWN_ID, name, ndims)
+            this_var.attributes=list(attributes)
+            record.add_variable(this_var, ixes)
+        yield record
+
+#-----------------------------------------------------------------------------------
+# check that shard_name is a finished metadata database that can be merged
+# raises ValueError if it is not
+#-----------------------------------------------------------------------------------
+def check_shard(shard_name):
+    if os.path.exists(shard_name)==False:
+        raise ValueError(shard_name+' does not exist')
+    con=sqlite3.connect('file:'+pathname2url(os.path.abspath(shard_name))+'?mode=ro', uri=True)
+    try:
+        table_names=[row[0] for row in con.execute("""SELECT name FROM sqlite_master WHERE type='table'""").fetchall()]
+    except sqlite3.DatabaseError as err:
+        raise ValueError(shard_name+' is not a metadata database, error='+str(err))
+    finally:
+        con.close()
+    if 'Variables' not in table_names:
+        raise ValueError(shard_name+' is not a metadata database')
+    if 'Build_Progress' in table_names or 'Staged_Links' in table_names:
+        raise ValueError('the build of '+shard_name+' did not finish, resume it before merging')
+
+#-----------------------------------------------------------------------------------
+# add the contents of a shard to the merged database
+# inputs:
+#    shard_name: the shard database
+#    known_dirs: dictionary of dirpath to did of the directories in the merged database
+#    known_files: set of (dirpath, filename) of the files in the merged database
+# returns:
+#    the number of files merged from this shard
+#-----------------------------------------------------------------------------------
+def merge_shard(shard_name, known_dirs, known_files):
+    con=sqlite3.connect(shard_name)
+    cur=con.cursor()
+
+    # the directories are added to the merged database when they are first found
+    shard_dirs={}
+    for row in cur.execute("""SELECT did, dirpath FROM Directories""").fetchall():
+        shard_dir=Directory(row)
+        if shard_dir.dirpath not in known_dirs:
+            this_dir=Directory(len(known_dirs), shard_dir.dirpath)
+            known_dirs[this_dir.dirpath]=this_dir.did
+            this_dir.insert_into_database('parent',Read_metadata_thread.writer,Read_metadata_thread.verbose)
+            Read_metadata_thread.writer.commit()
+        shard_dirs[shard_dir.did]=Directory(known_dirs[shard_dir.dirpath], shard_dir.dirpath)
+
+    nfiles=0
+    for record in read_shard_records(con, shard_dirs, known_files):
+        registrar=Read_metadata_thread(record.this_dir, record.filename)
+        registrar.register_record(record)
+        nfiles+=1
+    con.close()
+    return nfiles
+
+#-----------------------------------------------------------------------------------
+# merge the shards into a new database dbname
+# All the shards are checked before dbname is created and if the merge fails dbname is deleted
+# so it can be run again.
+#-----------------------------------------------------------------------------------
+def merge_db(dbname, shard_names):
+    if os.path.exists(dbname):
+        print(dbname, 'already exists')
+        exit()
+    for shard_name in shard_names:
+        check_shard(shard_name)
+
+    start_time=time.time()
+    Read_metadata_thread.con = sqlite3.connect(dbname,check_same_thread=False)
+    Read_metadata_thread.cur = Read_metadata_thread.con.cursor()
+    create_tables(Read_metadata_thread.cur, verbose=Read_metadata_thread.verbose)
+    create_staging_table(Read_metadata_thread.cur)
+    Read_metadata_thread.con.commit()
+
+    Read_metadata_thread.writer=Db_writer(dbname, verbose=Read_metadata_thread.verbose)
+    Read_metadata_thread.writer.start()
+
+    known_dirs={}
+    known_files=set()
+    merged=False
+    try:
+        for shard_name in shard_names:
+            nfiles=merge_shard(shard_name, known_dirs, known_files)
+            print(nfiles, 'files merged from', shard_name)
+
+        for this_var in Read_metadata_thread.variables:
+            this_var.insert_into_database('parent',Read_metadata_thread.writer,Read_metadata_thread.verbose)
+        Read_metadata_thread.writer.close()
+        compact_staged_links(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+        create_indexes(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+        create_text_index(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+        create_directory_counts(Read_metadata_thread.cur, Read_metadata_thread.verbose)
+        Read_metadata_thread.con.commit()
+        merged=True
+    finally:
+        try:
+            # the writer is not a daemon thread so if the merge fails python would wait for it forever
+            if Read_metadata_thread.writer.is_alive():
+                Read_metadata_thread.writer.close()
+        finally:
+            if merged==False:
+                # don't leave a half merged database behind
+                Read_metadata_thread.con.close()
+                os.remove(dbname)
+    Read_metadata_thread.con.close()
+
+    print('Merged in {t:.1f} seconds: {d} Directories {f} Files {c} Coords and {v} Variables in database'.format(
+          t=time.time()-start_time, d=len(known_dirs), f=len(known_files), c=len(Read_metadata_thread.coords), v=len(Read_metadata_thread.variables)))
+
+# -----------------------------------------------------------------------------------
+# main - read the arguments and call merge_db
+# -----------------------------------------------------------------------------------
+def main():
+
+    if len(sys.argv)<3:
+        print('usage:', sys.argv[0], '<database_name> <shard1 shard2 ...> <options eg -v=verbose>')
+        exit()
+    else:
+        dbname=sys.argv[1]
+        shard_names=[]
+        for arg in sys.argv[2:]:
+            if arg=='-v':
+                Read_metadata_thread.verbose=True
+            else:
+                shard_names.append(arg)
+
+    merge_db(dbname, shard_names)
+
+
+if __name__ == '__main__':
+    main()
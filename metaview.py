@@ -6,8 +6,8 @@
 
     If the user gives a single database name (ends in .db) then we just open that database but if they
     give a directory name we will search the directory for anything with a .db extension and create
-    a Database_reader which opens the database. We find the list of directories and unique variables
-    that are found in these databases.
+    a Database_reader which opens the database. We find the list of directories in these databases, the
+    variable names are read as they are needed by the type-ahead variable list.
     The coord1 coord2 etc are the names of coordinates that we can filter on
 
 '''
@@ -18,6 +18,11 @@ from tkinter import messagebox
 import warnings
 import pdb
 import sqlite3
+import threading
+import queue
+import time
+import concurrent.futures
+from urllib.request import pathname2url
 from db_functions import *       
 
 # set default font for Labels and Text
@@ -26,54 +31,119 @@ font=('Ariel', 11)
 databases=[]
 unique_dirnames=[]
 current_dix=-1 # index to unique_dirnames for current dir
-unique_varnames=[]
+variable_names=['*'] # the names in the variable list
+variable_prefix=None # the start of the names in the variable list, None until it is first filled
+more_variable_names=False # True if there may be more names to add to the variable list
 current_var='*'
 verbose=False
 coord_filters=[]
 current_db=-1 # index to current database set by dirname which is initially all
-
-# class for structuring the list of directories so we can have submenus
-# this is recursive
+search_thread=None # the Search_thread of the search that is running
+max_search_threads=8 # number of databases searched at the same time
+federation=None # Federated_catalogue of all the databases when there are several that can be searched with one query
+search_queue=queue.Queue() # the messages from the Search_thread to poll_search()
+result_rows=[] # (dbix, vix, nactive_files) of the results of the search, see show_results()
+first_result=0 # index into result_rows of the first result that can be seen
+result_tags=set() # the tags of the results widget that have been bound to on_result_click()
+
+#-----------------------------------------------------------------------------------
+# class for the trie of directory paths used for the Directory menu so we can have submenus
+# Each Directory is one part of a path and holds the Directories below it in subdirs. The trie is built
+# once from the directories of all the databases and the menu of a Directory is only filled when it is
+# first posted, so the menus of the directories that are never looked at are not made.
+#-----------------------------------------------------------------------------------
 class Directory:
-    def __init__(self, index, all_dirnames):
-        self.index=index
-        
-        self.subdirs=[]
-        this_root=all_dirnames[index]
-        i=index+1
-        while i <len(all_dirnames):
-            if all_dirnames[index] in all_dirnames[i]:
-                wsplit=all_dirnames[i].split(this_root+'/')
-                if len(wsplit)>1:
-                    self.subdirs.append(Directory(i, all_dirnames))
-                    i=self.subdirs[-1].next_index
-                else:
-                    i+=1
-            else:
-                break
-        self.next_index=i
-        
-    def print(self, tab, all_dirnames):
-        print(tab, all_dirnames[self.index])
-        for dir in self.subdirs:
-            dir.print(tab+'\t', all_dirnames)
-
-    def create_menu(self, all_dirnames, parent_menu):
+    def __init__(self, path):
+        self.path=path
+        self.index=-1 # index into unique_dirnames if this is a directory in the databases
+        self.subdirs={} # name of each subdirectory to its Directory
+        self.nfiles=0 # the files in this directory
+        self.nvariables=0 # the variables in the files of this directory, None if not known
+        self.total_files=0 # the files in this directory and all those below it
+        self.menu=None
+        self.filled=False
+
+    #-------------------------------------------------------------------------------
+    # add directory dirpath, which is unique_dirnames[index], with the number of files and variables in it
+    #-------------------------------------------------------------------------------
+    def add(self, dirpath, index, nfiles, nvariables):
+        this_dir=self
+        this_dir.total_files+=nfiles
+        parts=dirpath.split('/')
+        for p in range(len(parts)):
+            if p==0 and parts[0]=='':
+                # dirpath starts with /
+                continue
+            if parts[p] not in this_dir.subdirs:
+                this_dir.subdirs[parts[p]]=Directory('/'.join(parts[:p+1]))
+            this_dir=this_dir.subdirs[parts[p]]
+            this_dir.total_files+=nfiles
+        if this_dir.index==-1:
+            this_dir.index=index
+        # a directory in more than one database has the counts of all of them
+        this_dir.nfiles+=nfiles
+        if this_dir.nvariables!=None and nvariables!=None:
+            this_dir.nvariables+=nvariables
+        else:
+            this_dir.nvariables=None
+
+    #-------------------------------------------------------------------------------
+    # the directory to show in the menu for this one, the parts of a path that are not directories in the
+    # databases and only have one subdirectory are skipped, eg. /home/user/data
+    #-------------------------------------------------------------------------------
+    def get_shown(self):
+        this_dir=self
+        while this_dir.index==-1 and len(this_dir.subdirs)==1:
+            this_dir=next(iter(this_dir.subdirs.values()))
+        return this_dir
+
+    def get_label(self):
+        if self.nvariables==None:
+            return '{p} ({f} files)'.format(p=self.path, f=self.nfiles)
+        return '{p} ({f} files, {v} variables)'.format(p=self.path, f=self.nfiles, v=self.nvariables)
+
+    #-------------------------------------------------------------------------------
+    # add this directory to parent_menu, if it has subdirs a cascade menu is made which is filled by
+    # fill_menu() when it is posted
+    #-------------------------------------------------------------------------------
+    def add_to_menu(self, parent_menu):
         if len(self.subdirs)==0:
             # just create the command to set this dir in the parent
-            parent_menu.add_command(label=all_dirnames[self.index], command=lambda d=self.index: set_dirname(d))
+            parent_menu.add_command(label=self.get_label(), command=lambda d=self.index: set_dirname(d))
+        else:
+            self.menu = Menu(parent_menu, tearoff=False, postcommand=self.fill_menu)
+            parent_menu.add_cascade(label='{p} ({f} files)'.format(p=self.path, f=self.total_files), menu=self.menu)
+
+    def fill_menu(self):
+        if self.filled:
+            return
+        self.filled=True
+        if self.index>=0:
+            self.menu.add_command(label=self.get_label(), command=lambda d=self.index: set_dirname(d))
+        self.add_subdirs_to_menu(self.menu)
+
+    def add_subdirs_to_menu(self, menu):
+        for name in sorted(self.subdirs):
+            self.subdirs[name].get_shown().add_to_menu(menu)
+
+    #-------------------------------------------------------------------------------
+    # add the directories to the top menu, called for the Directory at the root of the trie
+    #-------------------------------------------------------------------------------
+    def create_menu(self, top_menu):
+        shown=self.get_shown()
+        if shown==self:
+            self.add_subdirs_to_menu(top_menu)
         else:
-            # this has subdirs so create a cascade menu
-            self.menu = Menu(parent_menu, tearoff=False)
-            parent_menu.add_cascade(label=all_dirnames[self.index], menu=self.menu)
-            self.menu.add_command(label=all_dirnames[self.index], command=lambda d=self.index: set_dirname(d))
-            for d in range(len(self.subdirs)):
-                self.subdirs[d].create_menu(all_dirnames, self.menu)
+            shown.add_to_menu(top_menu)
 
 
 # only update the status every UPDATE_COUNT times round a loop otherwise it slows things down too much
 UPDATE_COUNT=100
 def update_status(text):
+    if threading.current_thread()!=threading.main_thread():
+        # tkinter can only be used from the main thread so the status of a search is sent to poll_search()
+        search_queue.put(('status', text))
+        return
     status_bar['text']=text
     root.update_idletasks()
     
@@ -94,6 +164,10 @@ class Database_reader:
 
         self.cur = self.con.cursor()
         self.dbname=dbname
+        # searches are run by a Search_thread with their own read-only connection, which can be interrupted
+        # when the search is cancelled, the popups use self.cur
+        self.search_con=sqlite3.connect('file:'+pathname2url(os.path.abspath(dbname))+'?mode=ro', uri=True, check_same_thread=False)
+        self.search_cur=self.search_con.cursor()
 
         #-----------------------------------------------------------------------------------
         # get a list of all directory names from database
@@ -101,32 +175,29 @@ class Database_reader:
         self.dirpaths=read_all_directories(self.cur)
         if verbose:
             print(dbname, 'directories:', self.dirpaths)
-
-        #-----------------------------------------------------------------------------------
-        # get list of all unique variable names from database - we only need name at this stage
-        #-----------------------------------------------------------------------------------
-        self.unique_varnames=[]
-        res=self.cur.execute("""SELECT name FROM Variables""")
-        all_varnames=np.asarray(res.fetchall())
-        # just get the unique varnames
-        for v in np.unique(all_varnames):
-            self.unique_varnames.append(v)
+        # the number of files and variables in each directory for the Directory menu
+        self.dir_counts=read_directory_counts(self.cur)
 
         #-----------------------------------------------------------------------------------
         # have a place to store coordinates, variables and files that have been searched for
         #-----------------------------------------------------------------------------------
         # place to store coords but only read when needed
         self.coords=[]
-        # also store the stuff we get back from get_min_max_delta_str()
-        self.coords_str=[]
-        self.coords_nlines=[]
-        self.coords_max_line_len=[] 
-        self.coords_min_vals=[]
+        # cache of what we get back from get_min_max_delta_str() for each cid, this is only
+        # worked out when a coordinate is displayed as it is slow for time coordinates
+        self.coords_info={}
         
         # place to store the files- initially no files but read on a search        
         self.files_metadata=Files_metadata()
         # hold the variables that were searched for here - initially empty
         self.active_variables=[]
+        # databases built before the epoch columns were added to the Coords table are searched by
+        # checking each variable with check_fids_and_filters() instead of with select_valid_variables()
+        self.has_epoch_columns=has_coord_epoch_columns(self.cur)
+
+    # get the next limit variable names starting with prefix after the name after (None for the first)
+    def get_variable_names(self, prefix, after, limit):
+        return select_variable_names(self.cur, prefix, after, limit)
 
     def has_dirpath(self,dirpath):
          matches=np.asarray([this_dir==dirpath for this_dir in self.dirpaths])
@@ -155,64 +226,101 @@ class Database_reader:
     def read_variables(self,variable,verbose):
         if variable=='*':
             # we are looking for all variables
-            var_rows=select_all_variables(self.cur,True) # order them
+            var_rows=select_all_variables(self.search_cur,True) # order them
         else:
             # we are looking for a specific variable
-            var_rows=select_variables_by_name(variable,self.cur)
+            var_rows=select_variables_by_name(variable,self.search_cur)
         if verbose:
             print('Database_reader.read_variables()', variable)
         nvars=len(var_rows)
-        update_status('reading variables ({}) 0/{}'.format(variable, nvars))
-        self.active_variables=[None]*nvars # create list of required size to hold variables
-        r=0
-        for row in var_rows:
-            self.active_variables[r]=Variable_metadata(row, self.cur, verbose)
-            if r % UPDATE_COUNT ==0:
-                update_status('reading variables ({}) {}/{}'.format(self.active_variables[r].name, r,nvars))
-            r+=1
+        update_status('reading variables ({}) {}'.format(variable, nvars))
+        # read the links and attributes of all the variables at once
+        self.active_variables=read_variables_in_bulk(self.search_cur, var_rows, verbose)
         update_status('')
         return nvars
 
 
-    def create_coord(self, row, ncoords):
-        c=self.coord_counter
-        self.coords[c]=Coord_metadata(row, self.cur)
-        (this_str, nlines, max_line_len, min_val)=self.coords[c].get_min_max_delta_str()
-        self.coords_str[c]=this_str
-        print('coord', self.coords[c].cid, self.coords[c].name, this_str)
-        self.coords_nlines[c]=nlines
-        self.coords_max_line_len[c]=max_line_len
-        self.coords_min_vals[c]=min_val
-        if c % UPDATE_COUNT ==0:
-            update_status('reading coordinates {}/{}'.format(c, ncoords))
-        self.coord_counter=self.coord_counter+1
-            
+    # get the string describing coordinate cix, the number of lines and the longest line in it and the
+    # min_val to sort coordinates by
+    def get_coord_info(self, cix):
+        if cix not in self.coords_info:
+            self.coords_info[cix]=self.coords[cix].get_min_max_delta_str()
+        return self.coords_info[cix]
+
     def read_coordinates(self, verbose):
         if verbose:
             print('Database_reader.read_coordinates()')
         update_status('reading coordinates')
-        rows=select_all_coords(self.cur)
-        ncoords=len(rows)
-        self.coords=[None]*ncoords # create list of appropriate size to hold coords
-        self.coords_str=['']*ncoords
-        self.coords_nlines=np.zeros(ncoords,int)
-        self.coords_max_line_len=np.zeros(ncoords,int)
-        self.coords_min_vals=[None]*ncoords
-        self.coord_counter=0
-        [self.create_coord(row, ncoords) for row in rows]
+        # the coords, their attributes and values are each read in one go and kept in numpy arrays,
+        # a Coord_metadata is only made for the coords that are displayed
+        self.coords=Coord_columns(self.search_cur)
+        self.coords_info={}
+        if verbose:
+            print('Database_reader.read_coordinates() read', len(self.coords), 'coordinates')
         update_status('')
-        return self.coord_counter
+        return len(self.coords)
 
     def read_files(self, did, filename_exp,verbose):
         if verbose:
             print('Database_reader.read_files() did=', did, filename_exp)
-        update_status('reading files')
-        self.files_metadata.read_from_database(self.cur,did,filename_exp)
-        update_status('')
+        # the files are only read again if the directory or filename have changed
+        if self.files_metadata.is_same_search(did, filename_exp)==False:
+            update_status('reading files')
+            self.files_metadata.read_from_database(self.search_cur,did,filename_exp)
+            update_status('')
         return self.files_metadata.get_nfiles()
 
+    # find the variables and files with attributes that contain all the words in text
+    # returns the vids, best match first, and the fids (see search_attribute_text())
+    def search_text(self, text, verbose):
+        if verbose:
+            print('Database_reader.search_text()', text)
+        update_status('searching attributes for '+text)
+        text_vids, text_fids=search_attribute_text(self.search_cur, text)
+        update_status('')
+        return text_vids, text_fids
+
+    # get the rows of the variables to search in the order they are shown: by name or, if text_vids are given,
+    # in the order of text_vids with the others after them
+    # active_variables is emptied ready for the variables found by search_variables()
+    def get_search_rows(self, variable, text_vids):
+        if variable=='*':
+            var_rows=select_all_variables(self.search_cur,True) # order them
+        else:
+            var_rows=select_variables_by_name(variable,self.search_cur)
+        if text_vids!=None:
+            text_ranks={vid:rank for rank, vid in enumerate(text_vids)}
+            var_rows.sort(key=lambda row: text_ranks.get(row[0], len(text_ranks)))
+        self.active_variables=[]
+        return var_rows
+
+    # find which of the variables of var_rows match the search with one query and read just those variables,
+    # they are added to active_variables with their allowed_fids set to the files that matched
+    # returns the number of variables with matching files
+    def search_variables(self, var_rows, did, filename_exp, coord_filters, text_vids, text_fids, verbose):
+        if verbose:
+            print('Database_reader.search_variables()', did, filename_exp, len(var_rows))
+        valid_variables=select_valid_variables(self.search_cur, did, filename_exp, coord_filters, '*', text_vids, text_fids,
+                                               [row[0] for row in var_rows])
+        return self.add_valid_variables(var_rows, valid_variables, verbose)
+
+    # read the variables of var_rows that are in range in valid_variables, the (vid, in_range, fids) found by
+    # select_valid_variables(), and add them to active_variables with their allowed_fids set to the files that matched
+    # returns the number of variables with matching files
+    def add_valid_variables(self, var_rows, valid_variables, verbose):
+        valid_fids={vid:fids for vid, in_range, fids in valid_variables if in_range}
+        variables=read_variables_in_bulk(self.search_cur, [row for row in var_rows if row[0] in valid_fids], verbose)
+        for this_var in variables:
+            this_var.allowed_fids=np.isin(this_var.fids, valid_fids[this_var.vid]).astype(int)
+        # the variables are only added once they are complete as they may be shown while the next ones are searched
+        self.active_variables.extend(variables)
+        return len(valid_variables)
+
     def check_valid_variable(self, vix, fids, coord_filters):
         this_var=self.active_variables[vix]        
+        if self.has_epoch_columns:
+            # search_variables() only kept the variables in range
+            return True, int(np.sum(this_var.allowed_fids))
         # check if all coordinates and fids of this variable are in requested range
         coords_in_range, nactive_files=this_var.check_fids_and_filters(fids, coord_filters, self.coords)
         return coords_in_range, nactive_files
@@ -236,9 +344,7 @@ def set_dirname(d):
         if verbose:
             print('set_dirname(): setting dirname to', this_dirname)
         dirname_lab["text"]=this_dirname
-        results['state']='normal'
-        results.delete("1.0",END)
-        results['state']='disabled'
+        clear_results()
         # work out which database this dirname is in
         if this_dirname=='*':
             current_db=-1
@@ -249,10 +355,6 @@ def set_dirname(d):
                     current_db=dbix
                     if verbose:
                         print('set_dirname(): current database is now', databases[current_db].dbname)
-                    if len(databases[current_db].dirpaths)>1:
-                        if databases[current_db].files_metadata.get_nfiles()>0:
-                            # clear all files except those in selected directory
-                            databases[current_db].files_metadata.clear()
     update_status('')
     
 #----------------------------------------------------
@@ -260,20 +362,9 @@ def set_dirname(d):
 #----------------------------------------------------
 def set_filename(d):
 
-    global current_db
-    global databases
-
-    results['state']='normal'
-    results.delete("1.0",END)
-    results['state']='disabled'
+    clear_results()
 
-    if current_db==-1:
-        for db in databases:
-            if db.files_metadata.get_nfiles()>0:
-                db.files_metadata.clear()
-    else:
-        if databases[current_db].files_metadata.get_nfiles()>0:
-            databases[current_db].files_metadata.clear()
+    # the files are only read again by the next search (see Database_reader.read_files())
     update_status('')
     return True
 
@@ -283,25 +374,23 @@ def set_filename(d):
 def set_variable(v):
     global current_db
     global databases
-    global unique_varnames
+    global variable_names
     global current_var
     global verbose
 
     if len(v)==0:
         print('set_variable(): invalid size of variable index', v)
         return
-    if v[0]>len(unique_varnames):
+    if v[0]>len(variable_names):
         print('set_variable(): variable index chosen is too big', v)
         return
-    variable=unique_varnames[v[0]]
+    variable=variable_names[v[0]]
     if current_var!=variable:
         if verbose:
             print('set_variable(): setting variable to', variable)
         current_var=variable
-        #variable_lab["text"]=unique_varnames[v]
-        results['state']='normal'
-        results.delete("1.0",END)
-        results['state']='disabled'
+        #variable_lab["text"]=variable_names[v]
+        clear_results()
         # variable has changed so clear active_variables apart from the one we now want
         if current_db==-1:
             for db in databases:
@@ -317,6 +406,50 @@ def set_variable(v):
 
     update_status('')
                 
+# the number of names read for the variable list at a time, more are read when it is scrolled to the end
+VARIABLE_NAMES=100
+
+#----------------------------------------------------
+# get the next VARIABLE_NAMES variable names in all the databases starting with prefix after the name
+# after (None for the first) in name order
+#----------------------------------------------------
+def find_variable_names(prefix, after=None):
+    names=set()
+    for db in databases:
+        # the first VARIABLE_NAMES of all the databases are in the first VARIABLE_NAMES of each one
+        names.update(db.get_variable_names(prefix, after, VARIABLE_NAMES))
+    return sorted(names)[:VARIABLE_NAMES]
+
+#----------------------------------------------------
+# the start of the variable name has been typed, show the first names that start with it
+#----------------------------------------------------
+def show_variable_names(prefix):
+    global variable_names
+    global variable_prefix
+    global more_variable_names
+
+    if prefix==variable_prefix:
+        return
+    names=find_variable_names(prefix)
+    variable_names=['*']+names
+    variable_prefix=prefix
+    more_variable_names=len(names)==VARIABLE_NAMES
+    variable_menu.delete(0, END)
+    variable_menu.insert(END, *variable_names)
+
+#----------------------------------------------------
+# the variable list has been scrolled, if the end of it can be seen the next names are added to it
+#----------------------------------------------------
+def scroll_variable_names(first, last):
+    global more_variable_names
+
+    variable_scrollbar.set(first, last)
+    if more_variable_names and float(last)>=1.0:
+        names=find_variable_names(variable_prefix, variable_names[-1])
+        variable_names.extend(names)
+        more_variable_names=len(names)==VARIABLE_NAMES
+        variable_menu.insert(END, *names)
+
 #-----------------------------------------------------
 # validation of coord_filter entries
 # %d = Type of action (1=insert, 0=delete, -1 for others)
@@ -335,9 +468,7 @@ def on_validate(d, P, s, S):
         else:
             ok=S in ['0','1','2','3','4','5','6','7','8','9'] # allow a number
         if ok==True:
-            results['state']='normal'
-            results.delete("1.0",END)
-            results['state']='disabled'
+            clear_results()
         
     return ok
 
@@ -385,9 +516,7 @@ def on_validate_time(d, P, s, S):
                        ok=S in ['0','1']
 
             if ok==True:
-                results['state']='normal'
-                results.delete("1.0",END)
-                results['state']='disabled'
+                clear_results()
 
 
     return ok
@@ -421,9 +550,9 @@ def popupVarDetails(event,var_tag,dbix,vix):
 def popupCoordDetails(event,coord_tag,dbix,cix):
     # show the range of this coordinate
     global databases
-    coord_str=databases[dbix].coords_str[cix]
+    coord_str=databases[dbix].get_coord_info(cix)[0]
     info_window = Tk()
-    info_window.title(databases[dbix].coords[cix].name)
+    info_window.title(databases[dbix].coords.get_name(cix))
     info_window.geometry("+{0}+{1}".format(event.x_root+6, event.y_root+2))
     label = Label(info_window, text=coord_str, anchor="w",justify='left',borderwidth=1, relief="solid", font=font)
     label.pack(fill=BOTH)
@@ -456,15 +585,17 @@ def popupMultiCoordDetails(event,tag,dbix,vix,d):
     this_cids=np.asarray(databases[dbix].active_variables[vix].get_cids_for_dim(d))
     this_cids=this_cids[this_fixes[0]]
     assert(len(this_fids)!=0)
-    coords_min_vals=np.asarray(databases[dbix].coords_min_vals)[this_cids]
+    coords_info=[databases[dbix].get_coord_info(cix) for cix in this_cids]
+    coords_min_vals=np.asarray([info[3] for info in coords_info])
     # sort  the coords
     ix=np.argsort(coords_min_vals)
     this_cids=this_cids[ix]
     this_fids=this_fids[ix]
+    coords_info=[coords_info[i] for i in ix]
     
-    coords_str=np.asarray(databases[dbix].coords_str)[this_cids]
-    coords_nlines=databases[dbix].coords_nlines[this_cids]
-    coords_max_line_len=databases[dbix].coords_max_line_len[this_cids]
+    coords_str=[info[0] for info in coords_info]
+    coords_nlines=np.asarray([info[1] for info in coords_info])
+    coords_max_line_len=[info[2] for info in coords_info]
     # combine coord_str with filepath for that coord
     text_str=['']*len(this_cids)
     max_line_lens=[add_coord_filepath(text_str, dbix,coords_str[c],coords_max_line_len[c],this_fids[c],c) for c in range(len(this_cids))]
@@ -473,7 +604,7 @@ def popupMultiCoordDetails(event,tag,dbix,vix,d):
     this_max_line_len=max(max_line_lens)
     max_line_len=min([this_max_line_len,80])
     info_window = Tk()
-    info_window.title(databases[dbix].active_variables[vix].name+': '+databases[dbix].coords[this_cids[0]].name)
+    info_window.title(databases[dbix].active_variables[vix].name+': '+databases[dbix].coords.get_name(this_cids[0]))
     info_window.geometry("+{0}+{1}".format(event.x_root+6, event.y_root+2))
 
     max_height=12
@@ -539,7 +670,7 @@ def popupFilesDetails(event,file_tag,dbix,vix):
             this_cids=np.asarray(databases[dbix].active_variables[vix].get_cids_for_dim(d))
             this_cids=this_cids[this_fixes[0]]
             # show the coords and files in ascending order by coord min_val
-            min_vals=np.asarray(databases[dbix].coords_min_vals)[this_cids]
+            min_vals=np.asarray([databases[dbix].get_coord_info(cix)[3] for cix in this_cids])
             ix=np.argsort(min_vals)
             this_fids=this_fids[ix]
         else:
@@ -587,133 +718,448 @@ def popupFilesDetails(event,file_tag,dbix,vix):
 
 
 #-------------------------------------------------------------------------------
-# display the variable details and create popups to display more details
-# inputs:
-#    dbix - the index into databases
-#    fids - the valid fids ([] is all valid)
-#    vix - index into the active_variables of the database
-#    ftag, vtag and ctag are numbers used to form a unique tag for the popup
-# returns:
-#    valid, ftag, vtag, ctag - updated
+# The results of a search are kept in result_rows, a list of (dbix, vix, nactive_files) for each valid
+# variable, where dbix is the index into databases, vix is the index into the active_variables of the
+# database and nactive_files is the number of its files that matched the search. Only the RESULT_LINES
+# results from first_result on are put in the results Text widget, so a search with a lot of results
+# does not make a lot of text and tags. The parts of each line have the tag 'variable', 'dim0', 'dim1'...
+# or 'files', each is bound once to on_result_click() which finds the result from the line clicked on.
 #-------------------------------------------------------------------------------
-def show_valid_variable(dbix, fids, vix, ftag, vtag, ctag):
+RESULT_LINES=20
 
-    global databases
-    global verbose
+#-------------------------------------------------------------------------------
+# returns a list of (text, tag) of the parts of the line for a result
+#-------------------------------------------------------------------------------
+def get_result_parts(dbix, vix, nactive_files):
+    this_var=databases[dbix].active_variables[vix]
+    parts=[(this_var.name+' (', 'variable')]
+    for d in range(this_var.ndims):
+        this_cids=this_var.get_cids_for_dim(d)
+        parts.append((databases[dbix].coords.get_name(this_cids[0])+',', 'dim{d:d}'.format(d=d)))
+    parts.append((') for {n:d} files\n'.format(n=nactive_files), 'files'))
+    return parts
 
-    # check if all coordinates and fids of this variable are in requested range
-    coords_in_range, nactive_files=databases[dbix].check_valid_variable(vix, fids, coord_filters)
-    if verbose:
-        print('show_valid_variable(): ', databases[dbix].active_variables[vix].name, nactive_files,'active_files')
-    if coords_in_range and nactive_files>0:
-        this_var=databases[dbix].active_variables[vix]
-        var_tag='var_attr{t:d}'.format(t=vtag)
-        vtag=vtag+1
-        results.insert(INSERT, this_var.name+' (',(var_tag))
-        results.tag_bind(var_tag, '<Button-1>', lambda e,dbix=dbix,vix=vix:popupVarDetails(e,var_tag,dbix,vix))
-        for d in range(this_var.ndims):
-            this_cids=this_var.get_cids_for_dim(d)
-            dimname=databases[dbix].coords[this_cids[0]].name
-            coord_tag='coord_tag{t:d}'.format(t=ctag)
-            ctag=ctag+1
-            if len(this_cids)==1:
-                # can have a popup for coord details
-                results.insert(INSERT, dimname+',',(coord_tag))
-                results.tag_bind(coord_tag, '<Button-1>', lambda e,dbix=dbix,cix=this_cids[0]:popupCoordDetails(e,coord_tag,dbix,cix))
+#-------------------------------------------------------------------------------
+# put the results that can be seen in the results widget and set the scrollbar
+#-------------------------------------------------------------------------------
+def show_results():
+    results['state']='normal'
+    results.delete("1.0",END)
+    for dbix, vix, nactive_files in result_rows[first_result:first_result+RESULT_LINES]:
+        for text, tag in get_result_parts(dbix, vix, nactive_files):
+            if tag not in result_tags:
+                results.tag_bind(tag, '<Button-1>', lambda e,tag=tag:on_result_click(e,tag))
+                result_tags.add(tag)
+            results.insert(END, text, (tag))
+    results['state']='disabled'
+    set_results_scrollbar()
+
+def set_results_scrollbar():
+    if len(result_rows)==0:
+        results_scrollbar.set(0, 1)
+    else:
+        results_scrollbar.set(first_result/len(result_rows), min(first_result+RESULT_LINES, len(result_rows))/len(result_rows))
+
+#-------------------------------------------------------------------------------
+# add the results (dbix, vix, nactive_files) of a search, they are only shown if they can be seen
+#-------------------------------------------------------------------------------
+def add_results(rows):
+    can_see=len(result_rows)<first_result+RESULT_LINES
+    result_rows.extend(rows)
+    if can_see:
+        show_results()
+    else:
+        set_results_scrollbar()
+
+#-------------------------------------------------------------------------------
+# stop the search and clear the results, this is used when any of the search options change
+#-------------------------------------------------------------------------------
+def clear_results():
+    global first_result
+
+    stop_search()
+    result_rows.clear()
+    first_result=0
+    show_results()
+
+#-------------------------------------------------------------------------------
+# the results scrollbar or mouse wheel has been used, the arguments are those of the Text yview() method
+#-------------------------------------------------------------------------------
+def scroll_results(*args):
+    global first_result
+
+    first=first_result
+    if args[0]=='moveto':
+        first=int(float(args[1])*len(result_rows))
+    elif args[0]=='scroll':
+        first=first_result+int(args[1])*(RESULT_LINES if args[2]=='pages' else 1)
+    first=max(0, min(first, len(result_rows)-RESULT_LINES))
+    if first!=first_result:
+        first_result=first
+        show_results()
+    return 'break'
+
+#-------------------------------------------------------------------------------
+# a result has been clicked on, tag is the tag of the part of the line clicked on
+# the variable name and the files show the popups for the variable, each dimension shows its coordinate
+#-------------------------------------------------------------------------------
+def on_result_click(event, tag):
+    line=int(results.index('@{x:d},{y:d}'.format(x=event.x, y=event.y)).split('.')[0])
+    row=first_result+line-1
+    if row>=len(result_rows):
+        return
+    dbix, vix, nactive_files=result_rows[row]
+    if tag=='variable':
+        popupVarDetails(event,tag,dbix,vix)
+    elif tag=='files':
+        popupFilesDetails(event,tag,dbix,vix)
+    else:
+        d=int(tag[3:])
+        this_cids=databases[dbix].active_variables[vix].get_cids_for_dim(d)
+        if len(this_cids)==1:
+            # can have a popup for coord details
+            popupCoordDetails(event,tag,dbix,this_cids[0])
+        else:
+            # more than one coord covers the range
+            popupMultiCoordDetails(event,tag,dbix,vix,d)
+
+#--------------------------------------------------------------------------------
+# Class to run a search on its own thread so the window does not freeze while it runs
+# The valid variables are sent to poll_search() on search_queue a batch at a time as they are found,
+# followed by ('done', nfiles, nvars, nvars_valid), ('cancelled', nfiles, nvars, nvars_valid) if cancel()
+# was called or ('error', message). The databases are read with their search_cur.
+# When there is more than one database to search up to max_search_threads of them are searched at the
+# same time by a pool of threads, each with the search_cur of its database, and the batches of each
+# database are sent as they are found. If all the databases are searched and there is no text to search
+# for they are searched together with one query for each batch of variable names by the federation instead.
+#--------------------------------------------------------------------------------
+class Search_thread(threading.Thread):
+
+    # the variables are searched BATCH_SIZE at a time and the valid ones found so far are sent at least
+    # every SEND_INTERVAL seconds
+    BATCH_SIZE=500
+    SEND_INTERVAL=0.2
+
+    #---------------------------------------------------------------------------------------
+    # searches is a list of (dbix, did) of the databases to search and the directory id to search in
+    # each (-1 for all directories)
+    #---------------------------------------------------------------------------------------
+    def __init__(self, searches, filename_exp, text, variable):
+        threading.Thread.__init__(self, daemon=True)
+        self.searches=searches
+        self.filename_exp=filename_exp
+        self.text=text
+        self.variable=variable
+        self.cancelled=threading.Event()
+
+    #---------------------------------------------------------------------------------------
+    # stop the search, this is called from the main thread
+    #---------------------------------------------------------------------------------------
+    def cancel(self):
+        self.cancelled.set()
+        # stop the query that is running so we don't wait for it to finish
+        for dbix, did in self.searches:
+            databases[dbix].search_con.interrupt()
+        if federation!=None:
+            federation.interrupt()
+
+    #---------------------------------------------------------------------------------------
+    # search the databases and send how the search ended
+    #---------------------------------------------------------------------------------------
+    def run(self):
+        self.error=None
+        if len(self.searches)==1:
+            counts=[self.try_search_database(*self.searches[0])]
+        elif federation!=None and self.text=='' and all(did==-1 for dbix, did in self.searches):
+            counts=[self.try_search_federation()]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_search_threads, len(self.searches))) as pool:
+                futures=[pool.submit(self.try_search_database, dbix, did) for dbix, did in self.searches]
+                counts=[future.result() for future in futures]
+        nfiles=0
+        nvars=0
+        nvars_valid=0
+        for this_nfiles, this_nvars, this_nvars_valid in counts:
+            nfiles=nfiles+this_nfiles
+            nvars=nvars+this_nvars
+            nvars_valid=nvars_valid+this_nvars_valid
+        if self.error!=None:
+            search_queue.put(('error', self.error))
+        elif self.cancelled.is_set():
+            search_queue.put(('cancelled', nfiles, nvars, nvars_valid))
+        else:
+            search_queue.put(('done', nfiles, nvars, nvars_valid))
+
+    #--------------------------------------------------------------------------------
+    # search database dbix with search_database(), if it fails the error is kept and the other searches are stopped
+    #--------------------------------------------------------------------------------
+    def try_search_database(self, dbix, did):
+        try:
+            return self.search_database(dbix, did)
+        except Exception as err:
+            # an interrupted query raises an exception when the search is cancelled
+            if self.cancelled.is_set()==False:
+                print('Search_thread error searching', databases[dbix].dbname, err)
+                self.error=str(err)
+                self.cancel()
+            return 0, 0, 0
+
+    #--------------------------------------------------------------------------------
+    # search all the databases with search_federation(), if it fails the error is kept
+    #--------------------------------------------------------------------------------
+    def try_search_federation(self):
+        try:
+            return self.search_federation()
+        except Exception as err:
+            if self.cancelled.is_set()==False:
+                print('Search_thread error searching the federated databases', err)
+                self.error=str(err)
+            return 0, 0, 0
+
+    #--------------------------------------------------------------------------------
+    # search all the directories of all the databases for the files that match filename_exp with the
+    # federation, the variable names are searched BATCH_SIZE at a time in all the databases of a batch
+    # with one query and the valid variables of each database are sent
+    # returns the number of files, the number of variables and the number of valid variables found
+    #--------------------------------------------------------------------------------
+    def search_federation(self):
+        nfiles=0
+        for dbix, did in self.searches:
+            db=databases[dbix]
+            nfiles+=db.read_files(did, self.filename_exp, verbose)
+            if len(db.coords)==0:
+                db.read_coordinates(verbose)
+            db.active_variables=[]
+        if verbose:
+            print('Search_thread.search_federation(): found', nfiles, 'files in', len(self.searches), 'databases')
+        nvars=0
+        nvars_valid=0
+        if nfiles>0:
+            for batch in federation.batches:
+                if self.cancelled.is_set():
+                    break
+                federation.attach_batch(batch)
+                if self.variable=='*':
+                    names=federation.select_variable_names()
+                else:
+                    names=[self.variable]
+                for first_name in range(0, len(names), Search_thread.BATCH_SIZE):
+                    if self.cancelled.is_set():
+                        break
+                    update_status('searching variables {} of {}'.format(first_name, len(names)))
+                    block=names[first_name:first_name+Search_thread.BATCH_SIZE]
+                    valid_variables=federation.select_valid_variables('*', self.filename_exp, coord_filters, block)
+                    var_rows=federation.select_variable_rows(block)
+                    for dbix in batch:
+                        db=databases[dbix]
+                        first_vix=len(db.active_variables)
+                        nvars+=db.add_valid_variables(var_rows.get(dbix, []), [valid[1:] for valid in valid_variables if valid[0]==dbix], verbose)
+                        nvars_valid+=self.send_valid_variables(dbix, first_vix, db.files_metadata.get_fid_mask(), None, None)
+            update_status('')
+        return nfiles, nvars, nvars_valid
+
+    #--------------------------------------------------------------------------------
+    # search database dbix for the files in directory did (-1 for all directories) that match filename_exp
+    # and send the valid variables, if text is not '' only the variables or files with attributes that
+    # contain its words are used
+    # returns the number of files, the number of variables and the number of valid variables found
+    #--------------------------------------------------------------------------------
+    def search_database(self, dbix, did):
+        if self.cancelled.is_set():
+            # this search had not started when the search was cancelled
+            return 0, 0, 0
+        db=databases[dbix]
+        # get files with matching did
+        nfiles=db.read_files(did, self.filename_exp, verbose)
+        if verbose:
+            print('Search_thread.search_database(): found', nfiles, 'files in database', db.dbname, 'with did', did)
+        nvars=0
+        nvars_valid=0
+        if nfiles>0:
+            if len(db.coords)==0:
+                db.read_coordinates(verbose)
+            # the variables with attributes containing the text and the files of other variables with global
+            # attributes containing it
+            text_vids=None
+            text_fids=None
+            if self.text!='':
+                text_vids, text_fids=db.search_text(self.text, verbose)
+            fids=db.files_metadata.get_fid_mask()
+            text_fid_mask=get_fid_mask(text_fids or [])
+            nmask=min(len(fids), len(text_fid_mask))
+            text_fid_mask=fids[:nmask] & text_fid_mask[:nmask]
+            if db.has_epoch_columns:
+                # only the variables that match are read, they are searched BATCH_SIZE at a time so the first
+                # ones are shown quickly
+                var_rows=db.get_search_rows(self.variable, text_vids)
+                for first_row in range(0, len(var_rows), Search_thread.BATCH_SIZE):
+                    if self.cancelled.is_set():
+                        break
+                    update_status('searching variables {} of {}'.format(first_row, len(var_rows)))
+                    first_vix=len(db.active_variables)
+                    nvars+=db.search_variables(var_rows[first_row:first_row+Search_thread.BATCH_SIZE], did, self.filename_exp,
+                                               coord_filters, text_vids, text_fids, verbose)
+                    nvars_valid+=self.send_valid_variables(dbix, first_vix, fids, text_vids, text_fid_mask)
+            else:
+                # if we have not changed the variable since last search db.active_variables will still have the variables in it
+                nvars=len(db.active_variables)
+                if nvars==0:
+                    nvars=db.read_variables(self.variable,verbose)
+                update_status('checking which variables are valid')
+                nvars_valid=self.send_valid_variables(dbix, 0, fids, text_vids, text_fid_mask)
+            if verbose:
+                print('Search_thread.search_database(): read', len(db.active_variables), 'variables')
+            update_status('')
+        return nfiles, nvars, nvars_valid
+
+    #--------------------------------------------------------------------------------
+    # check the active_variables of database dbix from first_vix on and send the valid ones to poll_search()
+    # inputs:
+    #    fids - numpy boolean array indexed by fid of the files that can be used
+    #    text_vids, text_fid_mask - if text_vids is not None the variables not in it can only use the
+    #    files in text_fid_mask
+    # returns the number of valid variables
+    #--------------------------------------------------------------------------------
+    def send_valid_variables(self, dbix, first_vix, fids, text_vids, text_fid_mask):
+        db=databases[dbix]
+        if text_vids!=None:
+            text_vids=set(text_vids)
+        nvars_valid=0
+        batch=[]
+        send_time=time.time()
+        for vix in range(first_vix, len(db.active_variables)):
+            if self.cancelled.is_set():
+                break
+            if text_vids!=None and db.active_variables[vix].vid not in text_vids:
+                var_fids=text_fid_mask
+            else:
+                var_fids=fids
+            # check if all coordinates and fids of this variable are in requested range
+            coords_in_range, nactive_files=db.check_valid_variable(vix, var_fids, coord_filters)
+            if verbose:
+                print('Search_thread.send_valid_variables(): ', db.active_variables[vix].name, nactive_files,'active_files')
+            if coords_in_range and nactive_files>0:
+                batch.append((vix, nactive_files))
+            if len(batch)>=Search_thread.BATCH_SIZE or (len(batch)>0 and time.time()-send_time>Search_thread.SEND_INTERVAL):
+                search_queue.put(('variables', dbix, batch))
+                nvars_valid+=len(batch)
+                batch=[]
+                send_time=time.time()
+        if len(batch)>0:
+            search_queue.put(('variables', dbix, batch))
+            nvars_valid+=len(batch)
+        return nvars_valid
+
+# how often, in milliseconds, poll_search() looks for results and for how long, in seconds, it shows them
+# before letting the window update
+POLL_INTERVAL=50
+POLL_TIME=0.1
+
+#--------------------------------------------------------------------------------
+# show the results sent by the Search_thread this_search, this is run by root.after() until the search ends
+#--------------------------------------------------------------------------------
+def poll_search(this_search):
+    global search_thread
+
+    if this_search!=search_thread:
+        # the search was stopped by stop_search()
+        return
+    finished=None
+    poll_end=time.time()+POLL_TIME
+    rows=[]
+    while finished==None and time.time()<poll_end:
+        try:
+            message=search_queue.get_nowait()
+        except queue.Empty:
+            break
+        if message[0]=='status':
+            if message[1]=='':
+                status_bar['text']='searching: {} valid variables found so far'.format(len(result_rows)+len(rows))
             else:
-                # more than one coord covers the range
-                results.insert(INSERT, dimname+',',(coord_tag))
-                results.tag_bind(coord_tag, '<Button-1>', lambda e,dbix=dbix,vix=vix,d=d:popupMultiCoordDetails(e,coord_tag,dbix,vix,d))
-        files_tag='files_details{t:d}'.format(t=ftag)
-        ftag=ftag+1
-        results.insert(INSERT, ') for {n:d} files\n'.format(n=nactive_files),files_tag)
-        results.tag_bind(files_tag, '<Button-1>', lambda e,dbix=dbix,vix=vix:popupFilesDetails(e,files_tag,dbix,vix))
+                status_bar['text']=message[1]
+        elif message[0]=='variables':
+            rows.extend([(message[1], vix, nactive_files) for vix, nactive_files in message[2]])
+        else:
+            finished=message
+    if len(rows)>0:
+        add_results(rows)
 
-    return (coords_in_range and nactive_files>0), ftag, vtag, ctag
+    if finished==None:
+        root.after(POLL_INTERVAL, poll_search, this_search)
+        return
+    search_thread=None
+    searchB['state']='normal'
+    cancelB['state']='disabled'
+    if finished[0]=='error':
+        update_status('Search failed: '+finished[1])
+    else:
+        status='Found {} files, {} variables in database ({} valid)'.format(finished[1], finished[2], finished[3])
+        if finished[0]=='cancelled':
+            status='Search cancelled. '+status
+        update_status(status)
+    print('done search_db()')
+
+#--------------------------------------------------------------------------------
+# Cancel button pressed - the search stops and poll_search() shows what was found
+#--------------------------------------------------------------------------------
+def cancel_search():
+    if search_thread!=None:
+        update_status('cancelling search')
+        search_thread.cancel()
+
+#--------------------------------------------------------------------------------
+# stop the search that is running, if there is one, and forget its results, this is used when the
+# directory, filename or variable change as the search uses them
+#--------------------------------------------------------------------------------
+def stop_search():
+    global search_thread
+
+    if search_thread!=None:
+        search_thread.cancel()
+        search_thread.join()
+        search_thread=None
+        searchB['state']='normal'
+        cancelB['state']='disabled'
+    while search_queue.empty()==False:
+        search_queue.get_nowait()
 
 #--------------------------------------------------------------------------------
 # Search button pressed
 # read all the filters (dirname, variable and coord_filters)
-# select the appropriate variables and which fids of those variables are allowed
-# display the variable details and create popups to display more details
+# start a Search_thread to select the appropriate variables and which fids of those variables are allowed
+# poll_search() then displays the variable details and creates popups to display more details
 #-------------------------------------------------------------------------------
 def search_db():
     global databases
     global current_db
     global verbose
-    global unique_varnames
     global current_var
+    global search_thread
 
-    results['state']='normal'
-    results.delete("1.0",END)
+    clear_results()
          
-#    current_var=variable_lab["text"]
     if verbose:
         print('search_db():',dirname_lab["text"]+'/*'+filename_entry.get(),'variable=',current_var)
 
     dirname=dirname_lab["text"]
     filename_exp=filename_entry.get()
-    # if we have not changed the variable since last search db.active_variables will still have the variables in it
-    nvars=0
-    nfiles=0
-    nvars_valid=0
+    text=text_entry.get().strip()
     # set up the coord_filters min max values from the widgets
     for i in range(nfilters):
         if coord_filters[i].is_valid:
             coord_filters[i].get()
 
-    ftag=0
-    vtag=0
-    ctag=0
     if dirname=='*':
-        for dbix in range(len(databases)):
-            db=databases[dbix]
-            this_nfiles=db.read_files(-1, filename_exp, verbose)
-            if verbose:
-                print('search_db(): found', this_nfiles, 'files in database', db.dbname)
-            nfiles=nfiles+this_nfiles
-            if this_nfiles>0:
-                fids=databases[current_db].files_metadata.get_fids()
-                this_ncoords=len(db.coords)
-                if this_ncoords==0:
-                    this_ncoords=db.read_coordinates(verbose)
-                this_nvars=len(db.active_variables)
-                if this_nvars==0:
-                    this_nvars=db.read_variables(current_var,verbose)
-                update_status('checking which variables are valid')
-                for vix in range(this_nvars):
-                    is_valid, ftag, vtag, ctag=show_valid_variable(dbix, fids, vix, ftag, vtag, ctag)
-                    if is_valid:
-                        nvars_valid+=1
-                update_status('')
-                nvars=nvars+this_nvars
-
+        searches=[(dbix, -1) for dbix in range(len(databases))]
     else:
-        did=databases[current_db].get_did(dirname)
-        # get files with matching did
-        nfiles=databases[current_db].read_files(did, filename_exp,verbose)
-        if verbose:
-            print('search_db(): found', nfiles, 'files in database', databases[current_db].dbname, 'with did', did, dirname)
-        if nfiles>0:
-            fids=databases[current_db].files_metadata.get_fids()
-            this_ncoords=len(databases[current_db].coords)
-            if this_ncoords==0:
-                this_ncoords=databases[current_db].read_coordinates(verbose)
-            nvars=len(databases[current_db].active_variables)
-            if nvars==0:
-                nvars=databases[current_db].read_variables(current_var,verbose)
-            if verbose:
-                print('search_db(): read', nvars, 'variables')
-            update_status('checking which variables are valid')
-            for vix in range(nvars):
-                is_valid, ftag, vtag, ctag=show_valid_variable(current_db, fids, vix, ftag, vtag, ctag)
-                if is_valid:
-                    nvars_valid+=1
+        searches=[(current_db, databases[current_db].get_did(dirname))]
 
-    update_status('Found {} files, {} variables in database ({} valid)'.format(nfiles, nvars, nvars_valid))
-
-    results['state']='disabled'
-    print('done search_db()')
+    search_thread=Search_thread(searches, filename_exp, text, current_var)
+    searchB['state']='disabled'
+    cancelB['state']='normal'
+    update_status('searching')
+    search_thread.start()
+    root.after(POLL_INTERVAL, poll_search, search_thread)
 
 ##############################################################################################
 # start of main code
@@ -741,7 +1187,6 @@ if wsplit[-1]=='db':
         raise ValueError('No such database '+dbname_or_dir)
     databases.append(Database_reader(dbname_or_dir,verbose))
     unique_dirnames=unique_dirnames+databases[-1].dirpaths
-    unique_varnames=unique_varnames+databases[-1].unique_varnames
 else:
     for dirpath, dirnames, filenames in os.walk(dbname_or_dir):
         for filename in filenames:
@@ -749,16 +1194,21 @@ else:
             if wsplit[-1]=='db':
                 databases.append(Database_reader(dirpath+'/'+filename,verbose))
                 unique_dirnames=unique_dirnames+databases[-1].dirpaths
-                unique_varnames=unique_varnames+databases[-1].unique_varnames
     if len(databases)==0:
         raise ValueError('No databases found in '+dbname_or_dir)
     
-dir_struct=Directory(0, unique_dirnames)
-
-unique_varnames=['*']+list(np.unique(np.asarray(unique_varnames)))
-if verbose:
-    print(len(unique_varnames)-1, 'unique varnames')
-    print(unique_varnames)
+# several databases are searched together with one query if they all have the epoch columns
+if len(databases)>1 and all(db.has_epoch_columns for db in databases):
+    federation=Federated_catalogue([db.dbname for db in databases], verbose)
+
+# the trie of all the directories for the Directory menu
+dir_struct=Directory('')
+dix=0
+for db in databases:
+    for did in range(len(db.dirpaths)):
+        nfiles, nvariables=db.dir_counts.get(did, (0, None))
+        dir_struct.add(db.dirpaths[did], dix, nfiles, nvariables)
+        dix=dix+1
 
 #-------------------------------------------------------------------------------------
 # create the root window and set up frames to display widgets:
@@ -792,24 +1242,27 @@ dirname_mb = Menubutton(setup_frame, text ="Directory", relief=RAISED, width=10,
 dirname_mb.menu = Menu ( dirname_mb, tearoff = 0 )
 dirname_mb["menu"] = dirname_mb.menu
 dirname_mb.menu.add_command(label='*', command=lambda d=-1: set_dirname(d))
-dir_struct.create_menu(unique_dirnames, dirname_mb.menu) # this recursively creates the cascaded menus
+dir_struct.create_menu(dirname_mb.menu) # the cascaded menus are only filled when they are posted
 dirname_mb.grid(row=0,column=0, sticky='W', pady=2)
 # the label to show what has been chosen
 dirname_lab = Label(master=setup_frame, text='*',width=90,borderwidth=1, anchor='w', relief="solid", font=font)
 dirname_lab.grid(row=0, column=1, sticky='W', pady=2, columnspan=5)
 
-# selecting variable
+# selecting variable - typing the start of a name in variable_entry lists the names starting with it
 var_frame = Frame(master=setup_frame)
-choicesvar = StringVar(value=unique_varnames)
 variable_text = Label(master=var_frame, text='Variable:',width=10, font=font)
 variable_text.pack(side=LEFT)
-variable_menu = Listbox(var_frame, width=30, height=5, font=font, listvariable=choicesvar)
+variable_entry = Entry(master=var_frame, width=20, font=font)
+variable_entry.bind('<KeyRelease>', lambda e: show_variable_names(variable_entry.get()))
+variable_entry.pack(side=LEFT, anchor='n')
+variable_menu = Listbox(var_frame, width=30, height=5, font=font, exportselection=False)
 variable_menu.bind("<<ListboxSelect>>", lambda e: set_variable(variable_menu.curselection()))
 variable_menu.pack(side=LEFT)
-ys = Scrollbar(var_frame, orient = 'vertical', command = variable_menu.yview)
-variable_menu.configure(yscrollcommand=ys.set)
-ys.pack(side=RIGHT, fill=Y)
+variable_scrollbar = Scrollbar(var_frame, orient = 'vertical', command = variable_menu.yview)
+variable_menu.configure(yscrollcommand=scroll_variable_names)
+variable_scrollbar.pack(side=RIGHT, fill=Y)
 var_frame.grid(row=1, column=0, sticky='W', pady=2, columnspan=5)
+show_variable_names('')
 
 # selecting filename - free form so handles regular expressions
 vcmd_filename = (setup_frame.register(set_filename), '%d')
@@ -819,6 +1272,12 @@ filename_entry = Entry(master=setup_frame, width=50, font=font, validate="key",
 filename_entry.grid(row=5, column=1, sticky='W', pady=2, columnspan=5)
 #filename_entry.insert(0,'*')
 
+# words to search for in the attributes of the variables, coordinates and files
+text_lab = Label(master=setup_frame, text='Attributes:', anchor='w', font=font)
+text_lab.grid(row=6, column=0, sticky='W', pady=2)
+text_entry = Entry(master=setup_frame, width=50, font=font)
+text_entry.grid(row=6, column=1, sticky='W', pady=2, columnspan=5)
+
 
 # set up widgets to handle bespoke filtering on coordinate values
 vcmd_number = (setup_frame.register(on_validate),
@@ -856,13 +1315,19 @@ for i in range(nfilters):
 # search button to kick off search
 searchB = Button(setup_frame, text ="Search", command = search_db, font=font)
 searchB.grid(row=row,column=5, sticky='W',pady=2)
-
-# widget to display results
-results = Text(results_frame, state='disabled', height=20, width=120, font=font)
-ys = Scrollbar(results_frame, orient = 'vertical', command = results.yview)
-results['yscrollcommand'] = ys.set
-ys.pack(side=RIGHT,fill=Y)
+# cancel button to stop a search that is running
+cancelB = Button(setup_frame, text ="Cancel", command = cancel_search, font=font, state='disabled')
+cancelB.grid(row=row,column=4, sticky='W',pady=2)
+
+# widget to display results, only the results that can be seen are put in it (see show_results())
+results = Text(results_frame, state='disabled', height=RESULT_LINES, width=120, font=font, wrap='none')
+results_scrollbar = Scrollbar(results_frame, orient = 'vertical', command = scroll_results)
+results_scrollbar.pack(side=RIGHT,fill=Y)
 results.pack()
+# the mouse wheel scrolls the results rather than the text in the widget
+results.bind('<MouseWheel>', lambda e: scroll_results('scroll', -1 if e.delta>0 else 1, 'units'))
+results.bind('<Button-4>', lambda e: scroll_results('scroll', -1, 'units'))
+results.bind('<Button-5>', lambda e: scroll_results('scroll', 1, 'units'))
 
 
 # kick it all off
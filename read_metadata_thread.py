@@ -10,16 +10,21 @@
     no guarantee that the metadata will be adequate to identify which keys are variables and which are
     coordinates.
 
-    In future the -u option will be implemented so that we can check what is already in the database and
-    make sure it is up to date
+    With the -u option of build_metadata_db.py only the files that are new or have changed since the database
+    was built are read and registered here, see build_metadata_db.py.
 
 
-    Uses the threading library to make the building of the database multi-threaded
+    The files are read one at a time as the netcdf and hdf5 libraries are not thread safe, with
+    --workers N they are read in parallel by worker processes.
+    Reading a file is split into extracting the metadata into a File_record (which does not touch any
+    shared data so can be done in a separate process) and registering that record which assigns
+    the fid, cids and vids and writes to the database.
 
 '''
 
 import warnings
 import threading
+import multiprocessing
 import numpy as np
 import datetime as dt
 import sqlite3
@@ -27,18 +32,49 @@ from netCDF4 import Dataset
 import h5py as h5py
 from db_functions import *
 
+#-----------------------------------------------------------------------------------
+# Class to hold all the metadata extracted from one file before any ids have been assigned
+# This only holds plain data so can be pickled and passed back from a worker process.
+# The coords are in the order they were found in the file and the variables refer to
+# their coordinates by the index into this list (var_coord_ixes) rather than by cid
+#-----------------------------------------------------------------------------------
+class File_record:
+    def __init__(self, this_dir, filename):
+        self.this_dir=this_dir
+        self.filename=filename
+        self.ok=False        # set to True once the file has been opened
+        self.this_file=None  # File_metadata for this file
+        self.coords=[]       # Coord_metadata for each coordinate in the file
+        self.variables=[]    # Variable_metadata for each variable in the file
+        self.var_coord_ixes=[] # for each variable, a list of indices into coords for each dimension
+
+    #----------------------------------------------------------------------
+    # add a coordinate and return its index in this record
+    #----------------------------------------------------------------------
+    def add_coord(self, this_coord):
+        self.coords.append(this_coord)
+        return len(self.coords)-1
+
+    #----------------------------------------------------------------------
+    # add a variable with the indices of the coords for each dimension
+    #----------------------------------------------------------------------
+    def add_variable(self, this_var, coord_ixes):
+        self.variables.append(this_var)
+        self.var_coord_ixes.append(list(coord_ixes))
+
 #-----------------------------------------------------------------------------------
 # Class to define the thread used to handle reading one file
 # This creates a Files entry and several Coords entries into the database but does not
 # insert the Variables as this is done at the end of reading all files
+# The same class is used to register the File_records read by worker processes
 #-----------------------------------------------------------------------------------
 class Read_metadata_thread(threading.Thread):
 
     # shared data between threads
     lock = threading.Lock()
-    update=False  # if True, check all the file dates and if the file is not in the database
-                  # then add data from the file as new content, or if the date has changed
-                  # then update the records for this file - not yet implemented 
+    update=False  # if True, check all the file sizes and dates and if the file is not in the database
+                  # then add data from the file as new content, or if the size or date has changed
+                  # then update the records for this file
     verbose=False # control printing
     ftype=''      # the type of files to read (currently netcdf (nc) and hdf5 (hdf5) is supported)
                   # for nc we will only open files with .nc extension
@@ -49,12 +85,17 @@ class Read_metadata_thread(threading.Thread):
 
     con=None # shared connection to the database
     cur=None # shared cursor to the database
+    writer=None # Db_writer which does all the writing to the database so the threads never use the cursor
+    journal=None # Build_journal which records the completed files so an interrupted build can be resumed
     # make sure python integers int32 and int64 are saved as INTEGER not BLOB
     sqlite3.register_adapter(np.int64, int) #lambda val: int(val))
     sqlite3.register_adapter(np.int32, int) #lambda val: int(val))
     nfiles=0
     coords=[]
+    coord_index={} # dictionary of coord fingerprint to a list of cids with that fingerprint
     variables=[]
+    variable_index={} # dictionary of variable bucket key to a list of vids in that bucket
+    changed_vids=set() # vids of existing variables that have had files added, used when updating
     bad_files=[]
 
     #------------------------------------------------------------------
@@ -80,99 +121,157 @@ class Read_metadata_thread(threading.Thread):
     # This needs to acquire the lock while determining what the next available fid is
     # inputs:
     #    this_file - an instance of File_metadata to be added to the database (does not have valid fid)
+    #    rows - the Row_buffer the file entry is written to
     # returns:
     #    this_fid -  the fid of the newly created file entry
     #---------------------------------------------------------------------------------------
-    def create_file_entry(self, this_file):
+    def create_file_entry(self, this_file, rows):
         # acquire lock to access nfiles shared data
-        Read_metadata_thread.lock.acquire()
-        # find next available fid
-        this_fid=Read_metadata_thread.nfiles
-        this_file.fid=this_fid
-        Read_metadata_thread.nfiles+=1
-        # store file entry in database
-        this_file.insert_into_database(self.thread_name, Read_metadata_thread.cur,Read_metadata_thread.verbose)
-        Read_metadata_thread.con.commit()
-        Read_metadata_thread.lock.release()
+        with Read_metadata_thread.lock:
+            # find next available fid
+            this_fid=Read_metadata_thread.nfiles
+            this_file.fid=this_fid
+            Read_metadata_thread.nfiles+=1
+            # store file entry in database
+            this_file.insert_into_database(self.thread_name, rows, Read_metadata_thread.verbose)
 
         return this_fid
 
+    #-----------------------------------------------------------------------------------------------------------------
+    # Function to add a coordinate with a valid cid to the coords list and the index of fingerprints
+    # The caller must hold the lock. The cid must be the index into the coords list
+    #-----------------------------------------------------------------------------------------------------------------
+    def add_coord(this_coord):
+        Read_metadata_thread.coords.append(this_coord)
+        key=this_coord.get_fingerprint()
+        if key in Read_metadata_thread.coord_index:
+            Read_metadata_thread.coord_index[key].append(this_coord.cid)
+        else:
+            Read_metadata_thread.coord_index[key]=[this_coord.cid]
+
     #-----------------------------------------------------------------------------------------------------------------
     # Function to check whether this_coord already exists (doesn't need to match cid but should match everything else
     # if it doesn't exist then add it to coord list with next available cid and insert into database
+    # Only the coords with a matching fingerprint are checked with matches_coord
     # inputs:
     #    this_coord - the new coordinate we need to match or create (does not have a valid cid)
+    #    rows - the Row_buffer a new coordinate is written to
     # returns:
     #    this_cid -  the cid of the newly created or matching coordinate
     #-----------------------------------------------------------------------------------------------------------------
-    def create_or_find_matching_coord(self, this_coord):
+    def create_or_find_matching_coord(self, this_coord, rows):
 
+        # work out the fingerprints before we get the lock
+        keys=this_coord.get_fingerprints_to_check()
         # acquire lock to access coords shared data
-        Read_metadata_thread.lock.acquire()
-        # do we already have this coordinate
-        coord_matches=np.asarray([coord.matches_coord(this_coord) for coord in Read_metadata_thread.coords])
-        matches=False
-        ix=np.where(coord_matches)
-        if len(ix[0])==1:
-            this_coord=Read_metadata_thread.coords[ix[0][0]]
-            this_cid=this_coord.cid
-            matches=True
-        if len(ix[0])>1:
-            raise ValueError(self.thread_name+' Read_metadata_thread.create_or_find_matching_coord(): new coord matches more than one existing coord! '+this_coord.name) 
-
-        if matches==False:
-            # we don't have it so append it to coords list and store it in the database
-            ncoords=len(Read_metadata_thread.coords)
-            this_cid=ncoords
-            this_coord.cid=this_cid
-            Read_metadata_thread.coords.append(this_coord)
-            this_coord.insert_into_database(self.thread_name, Read_metadata_thread.cur,Read_metadata_thread.verbose)
-            Read_metadata_thread.con.commit()
+        with Read_metadata_thread.lock:
+            # do we already have this coordinate
+            candidates=[cid for key in keys for cid in Read_metadata_thread.coord_index.get(key, [])]
+            coord_matches=[cid for cid in candidates if Read_metadata_thread.coords[cid].matches_coord(this_coord)]
+            matches=False
+            if len(coord_matches)==1:
+                this_coord=Read_metadata_thread.coords[coord_matches[0]]
+                this_cid=this_coord.cid
+                matches=True
+            if len(coord_matches)>1:
+                raise ValueError(self.thread_name+' Read_metadata_thread.create_or_find_matching_coord(): new coord matches more than one existing coord! '+this_coord.name) 
+
+            if matches==False:
+                # we don't have it so append it to coords list and store it in the database
+                ncoords=len(Read_metadata_thread.coords)
+                this_cid=ncoords
+                this_coord.cid=this_cid
+                Read_metadata_thread.add_coord(this_coord)
+                this_coord.insert_into_database(self.thread_name, rows, Read_metadata_thread.verbose)
 
-        Read_metadata_thread.lock.release()
         if matches==True and Read_metadata_thread.verbose:
             print(self.thread_name, ' Read_metadata_thread.create_or_find_matching_coord(): matching coordinate exists', this_coord.name, this_coord.cid)
 
         return this_cid
 
+    #--------------------------------------------------------------------------------------------------------
+    # Function to add a variable with a valid vid to the variables list and the index of bucket keys
+    # The caller must hold the lock. The vid must be the index into the variables list
+    #--------------------------------------------------------------------------------------------------------
+    def add_variable(this_var):
+        Read_metadata_thread.variables.append(this_var)
+        key=this_var.get_bucket_key()
+        if key in Read_metadata_thread.variable_index:
+            Read_metadata_thread.variable_index[key].append(this_var.vid)
+        else:
+            Read_metadata_thread.variable_index[key]=[this_var.vid]
+
     #--------------------------------------------------------------------------------------------------------
     # Function to check whether this_var already exists
     # if it doesn't exist then add it to variables list with next available vid
     # if it does then copy the fid and cid of this_var into the matching variable
-    # Note we cannot add this_var to the database until the end when we have added all the fid cid pairs
+    # Only the variables in the same bucket (see Variable_metadata.get_bucket_key()) are checked
+    # The fid and cids are written to the Staged_Links table straight away but we cannot add this_var
+    # to the Variables table until the end as its attributes may change as more files are added
     # inputs:
     #    this_var - the new variable we need to match or create (does not have a valid vid)
+    #    rows - the Row_buffer the links are staged in
+    #    saved_states - dictionary of vid to Variable_metadata.get_state() which the state of each variable
+    #                   checked is added to before it can be changed
+    # returns:
+    #    the vid of the matching variable or -1 if this_var was added as a new variable
     #--------------------------------------------------------------------------------------------------------
-    def create_or_find_matching_variable(self, this_var):
+    def create_or_find_matching_variable(self, this_var, rows, saved_states):
+        key=this_var.get_bucket_key()
+        matched_vid=-1
         # acquire lock to access variables shared data
-        Read_metadata_thread.lock.acquire()
-        var_matches=np.asarray([var.matches_variable(this_var,Read_metadata_thread.coords,Read_metadata_thread.verbose, self.thread_name) for var in Read_metadata_thread.variables])
-        # do we already have this variable
-        matches=False
-        ix=np.where(var_matches)
-        if len(ix[0])==1:
-            Read_metadata_thread.variables[ix[0][0]].copy_fid_cids_from_other(this_var)
-            if Read_metadata_thread.verbose:
-                print(self.thread_name, ' Read_metadata_thread.create_or_find_matching_variable(): matching variable exists', this_var.name, Read_metadata_thread.variables[ix[0][0]].vid)
-
-            this_var=[]
-            matches=True
-        elif len(ix[0])>1:
-            raise ValueError(self.thread_name+' Read_metadata_thread.create_or_find_matching_variable(): new var matches more than one existing var! '+this_var.name) 
-
-        if matches==False:
-            # add the new variable
-            nvars=len(Read_metadata_thread.variables)
-            this_var.vid=nvars
-            Read_metadata_thread.variables.append(this_var)
-
-
-        if Read_metadata_thread.verbose:
-            if matches==False:
-                print(self.thread_name, ' Read_metadata_thread.create_or_find_matching_variable(): New variable', this_var.name, this_var.vid, 'in files', this_var.fids, 'with cids', this_var.cids)
+        with Read_metadata_thread.lock:
+            candidates=Read_metadata_thread.variable_index.get(key, [])
+            # matches_variable() changes the file specific attributes of a variable that matches
+            for vid in candidates:
+                if vid not in saved_states:
+                    saved_states[vid]=Read_metadata_thread.variables[vid].get_state()
+            var_matches=[vid for vid in candidates if Read_metadata_thread.variables[vid].matches_variable(this_var,Read_metadata_thread.coords,Read_metadata_thread.verbose, self.thread_name)]
+            # do we already have this variable
+            if len(var_matches)==1:
+                matched_vid=var_matches[0]
+                Read_metadata_thread.variables[matched_vid].copy_fid_cids_from_other(this_var)
+                Read_metadata_thread.variables[matched_vid].stage_links(rows)
+                if Read_metadata_thread.verbose:
+                    print(self.thread_name, ' Read_metadata_thread.create_or_find_matching_variable(): matching variable exists', this_var.name, matched_vid)
+            elif len(var_matches)>1:
+                raise ValueError(self.thread_name+' Read_metadata_thread.create_or_find_matching_variable(): new var matches more than one existing var! '+this_var.name) 
+            else:
+                # add the new variable
+                nvars=len(Read_metadata_thread.variables)
+                this_var.vid=nvars
+                Read_metadata_thread.add_variable(this_var)
+                if Read_metadata_thread.verbose:
+                    print(self.thread_name, ' Read_metadata_thread.create_or_find_matching_variable(): New variable', this_var.name, this_var.vid, 'in files', this_var.fids, 'with cids', this_var.cids)
+                this_var.stage_links(rows)
 
+        return matched_vid
 
-        Read_metadata_thread.lock.release()
+    #--------------------------------------------------------------------------------------------------------
+    # Function to put the shared data back as it was before a file which could not be registered was started
+    # Only one file is registered at a time so the fids, coords and variables added since then all belong to
+    # that file. The caller must hold the lock.
+    # inputs:
+    #    nfiles, ncoords, nvars - the number of files, coords and variables before the file was started
+    #    saved_states - dictionary of vid to the state of the variables checked by create_or_find_matching_variable()
+    #--------------------------------------------------------------------------------------------------------
+    def undo_registration(nfiles, ncoords, nvars, saved_states):
+        Read_metadata_thread.nfiles=nfiles
+        for this_coord in Read_metadata_thread.coords[ncoords:]:
+            key=this_coord.get_fingerprint()
+            Read_metadata_thread.coord_index[key].remove(this_coord.cid)
+            if len(Read_metadata_thread.coord_index[key])==0:
+                del Read_metadata_thread.coord_index[key]
+        del Read_metadata_thread.coords[ncoords:]
+        for this_var in Read_metadata_thread.variables[nvars:]:
+            key=this_var.get_bucket_key()
+            Read_metadata_thread.variable_index[key].remove(this_var.vid)
+            if len(Read_metadata_thread.variable_index[key])==0:
+                del Read_metadata_thread.variable_index[key]
+        del Read_metadata_thread.variables[nvars:]
+        for vid in saved_states:
+            if vid<nvars:
+                Read_metadata_thread.variables[vid].set_state(saved_states[vid])
 
     #-----------------------------------------------------------------------------------
     # initiation of thread to handle a file
@@ -180,47 +279,47 @@ class Read_metadata_thread(threading.Thread):
     # inputs:
     #    this_dir - Directory object containing directory info of file
     #    filename - filename of file we are reading
+    #    file_stat, symlink - the os.stat and symbolic link target of the file if already known
     #-----------------------------------------------------------------------------------
-    def __init__(self, this_dir, filename): 
+    def __init__(self, this_dir, filename, file_stat=None, symlink=''): 
         threading.Thread.__init__(self)
         self.this_dir=this_dir
         self.filename=filename
+        self.file_stat=file_stat
+        self.symlink=symlink
         self.thread_name=threading.current_thread().name+'_'+filename
 
     #-----------------------------------------------------------------------------------
-    # Adds to database the metadata from one netcdf file.
-    # This will create the entry for the file in the Files table and entries for any coords in the Coords table
-    # Any variables will be held in the variables list but cannot be added to the database until we have read
-    # all files and set up all the cids and fids.
+    # Extracts the metadata from one netcdf file into a File_record.
+    # This does not assign any ids or touch the shared data so it can be run in a worker process.
+    # The record will contain the file entry, a coord for each dimension and the variables which refer
+    # to the coords by their index in the record.
     #
     # returns:
-    #    ok=True/False - indicates whether we could read the file
+    #    record - File_record with record.ok=True/False indicating whether we could read the file
     #-----------------------------------------------------------------------------------
     def read_netcdf(self):
-        ok=False
+        record=File_record(self.this_dir, self.filename)
         filepath=get_filepath(self.this_dir.dirpath, self.filename)
 
         try:
             if Read_metadata_thread.verbose:
                 print(self.thread_name,' Read_metadata_thread.read_netcdf(): reading', filepath)
             data=Dataset(filepath, "r", format="NETCDF4")
-            ok=True
+            record.ok=True
 
         except OSError as err:
 
             warnings.warn(self.thread_name+' Read_metadata_thread.read_netcdf(): Cannot read file {filename}, error={err}'.format(filename=filepath, err=err), UserWarning)
-            Read_metadata_thread.lock.acquire()
-            Read_metadata_thread.bad_files.append(filepath)
-            Read_metadata_thread.lock.release()
-            return ok
+            return record
             
-        this_file=File_metadata(UNKNOWN_ID, self.this_dir.did, self.this_dir.dirpath, self.filename)
+        this_file=File_metadata(UNKNOWN_ID, self.this_dir.did, self.this_dir.dirpath, self.filename, self.file_stat, self.symlink)
         # get the global attributes
         this_file.global_attributes=[Attribute(attrname,getattr(data, attrname)) for attrname in data.ncattrs()]
-        this_fid=self.create_file_entry(this_file)
+        record.this_file=this_file
 
-        # get the coords from this file - remember the cids and dimnames to match with the variables
-        this_cids=[]
+        # get the coords from this file - remember the index into record.coords and dimnames to match with the variables
+        this_coord_ixes=[]
         this_dimnames=[]
         # a coordinate is a dimension of a variable but it is usually also stored in netcdf as a
         # variable too because it has values and attributes
@@ -228,7 +327,8 @@ class Read_metadata_thread(threading.Thread):
         for d in data.dimensions:
             if d in vkeys:
                 # read the information about this coordinate by creating a coordinate instance
-                this_coord=Coord_metadata(UNKNOWN_ID, d, data[d][:], self.thread_name)
+                # pass the netcdf variable so the values can be read a chunk at a time
+                this_coord=Coord_metadata(UNKNOWN_ID, d, data[d], self.thread_name)
                 # need to add one attribute at a time so we can check for units and calendar attributes
                 for attrname in data[d].ncattrs():
                     value=getattr(data[d], attrname)
@@ -236,8 +336,7 @@ class Read_metadata_thread(threading.Thread):
             else:
                 # there is no information for this coordinate but we must still create a coordinate
                 this_coord=Coord_metadata(UNKNOWN_ID, d, [], self.thread_name)
-            this_cid=self.create_or_find_matching_coord(this_coord)
-            this_cids.append(this_cid)
+            this_coord_ixes.append(record.add_coord(this_coord))
             this_dimnames.append(d)
         this_dimnames=np.asarray(this_dimnames)
 
@@ -256,27 +355,26 @@ class Read_metadata_thread(threading.Thread):
                 # find related coords
                 if ndims>0:
                     cdixes=[np.where(this_dimnames==d)[0] for d in data[v].dimensions]
-                    found=np.asarray([len(cdixes)>0 for d in data[v].dimensions])
+                    found=np.asarray([len(c)>0 for c in cdixes])
                     ix=np.where(found==False)    
                     if len(ix[0])>0:
                         raise ValueError(self.thread_name+': Read_metadata_thread.read_netcdf(): cannot find dimnames for dims {}'.format(ix[0]))
                     else:
-                        cids=[this_cids[c[0]] for c in cdixes]
+                        coord_ixes=[this_coord_ixes[c[0]] for c in cdixes]
                 else:
-                    cids=[]
-                if Read_metadata_thread.verbose:
-                    print(self.thread_name, ' Read_metadata_thread.read_netcdf(): creating new variable to check if it exists', this_var.name, 'fid=',this_fid, 'cids=', cids, len(Read_metadata_thread.variables), 'existing vars')
-                this_var.add_cids_for_fid(this_fid, cids)
-                self.create_or_find_matching_variable(this_var)             
+                    coord_ixes=[]
+                record.add_variable(this_var, coord_ixes)
 
-        return ok
+        data.close()
+        return record
 
     #-----------------------------------------------------------------------------------
-    # Add to database the metadata from one hdf5 file
+    # Extract the metadata from one hdf5 file
     # Note this is not well tested yet
     #-----------------------------------------------------------------------------------
     # get the attributes from the data for this variable
     # attributes may tells us about the dimension names of the variable which we can link to coordinates
+    # this_coord_cids are the indices of the coordinates in the File_record
     def build_attribute_list(self, varname, atts, ndims, this_coord_names, this_coord_cids):
     
         dimension_found=np.zeros(ndims,int)
@@ -307,16 +405,15 @@ class Read_metadata_thread(threading.Thread):
         return attributes_list, dimension_found, var_cids
         
     #-----------------------------------------------------------------------------------
-    # This descends the hierarchy of keys in an hdf5 file and creates coords and variables
-    # the coords will be added to the Coords table, but the variables cannot be added to the
-    # database untill all files have been read and  the cids and fids have been set up
+    # This descends the hierarchy of keys in an hdf5 file and adds coords and variables to the record
+    # the variables refer to the coords by the index into record.coords as no cids have been assigned yet
     # inputs:
-    #    fid - is the id of the file we are reading
+    #    record - is the File_record of the file we are reading
     #    group is the data at this level of the hierarchy
     #-----------------------------------------------------------------------------------
-    def read_keys(self, fid, group):
+    def read_keys(self, record, group):
         keys=group.keys()
-        this_coord_cids=[]
+        this_coord_ixes=[]
         this_coord_names=[]
 
         # look for any coordinate data first
@@ -338,13 +435,12 @@ class Read_metadata_thread(threading.Thread):
                             #print('coord attribute:',attrname, value)
                             this_coord.add_attribute(attrname, value)
 
-                    this_cid=self.create_or_find_matching_coord(this_coord)
-                    this_coord_cids.append(this_cid)
+                    this_coord_ixes.append(record.add_coord(this_coord))
                     this_coord_names.append(key)
 
         # now look at all the other keys
         this_coord_names=np.asarray(this_coord_names)
-        this_coord_cids=np.asarray(this_coord_cids)
+        this_coord_ixes=np.asarray(this_coord_ixes)
         for key in keys:
             if key not in this_coord_names:
                 this_group=group[key]
@@ -354,18 +450,18 @@ class Read_metadata_thread(threading.Thread):
                     ndims=len(this_group.shape)
                     this_var=Variable_metadata(UNKNOWN_ID,this_group.name,ndims)
                     atts=dict(this_group.attrs)
-                    attributes_list, dimension_found, var_cids=self.build_attribute_list(this_var.name, atts, ndims, this_coord_names, this_coord_cids)
+                    attributes_list, dimension_found, var_coord_ixes=self.build_attribute_list(this_var.name, atts, ndims, this_coord_names, this_coord_ixes)
                     this_var.attributes=attributes_list
 
                     # if we haven't found the dimension because there was no attribute called DimensionNames or coordinates
                     # we will have to work out which coordinate goes with which dimension from shape
                     dix=np.where(dimension_found==0)
-                    dimlen=np.asarray([Read_metadata_thread.coords[cid].nvals for cid in this_coord_cids])
+                    dimlen=np.asarray([record.coords[c].nvals for c in this_coord_ixes])
                     for d in dix[0]:
                         cix=np.where(dimlen==this_group.shape[d])
                         if len(cix[0])==1:
-                            var_cids[d]=this_coords_cids[cix[0][0]]
-                            print(self.thread_name+'Read_metadata_thread.read+keys():', this_group.name, f'has coord[{d}]',var_cids[d])
+                            var_coord_ixes[d]=this_coord_ixes[cix[0][0]]
+                            print(self.thread_name+'Read_metadata_thread.read+keys():', this_group.name, f'has coord[{d}]',var_coord_ixes[d])
                             dimension_found[d]=1
                         else:
                             raise ValueError(self.thread_name+' Read_metadata_thread.read_keys(): cannot work out coordinate for dimension {}'.format(d))
@@ -374,53 +470,112 @@ class Read_metadata_thread(threading.Thread):
                     if len(dix[0])>0:
                         raise ValueError(self.thread_name+' Read_metadata_thread.read_keys(): have not found all coordinates for variable '+this_var.name)
                     else:
-                        this_var.add_cids_for_fid(fid, var_cids)
-
-                    self.create_or_find_matching_variable(this_var)             
+                        record.add_variable(this_var, var_coord_ixes)
 
                 elif isinstance(this_group,h5py._hl.group.Group):
                     # this is a group
-                    self.read_keys(fid,this_group)
+                    self.read_keys(record,this_group)
                 else:
                     raise ValueError(self.thread_name+' Read_metadata_thread.read_keys(): Unknown type of this_group {}'.format(type(this_group)))
 
 
 
     #-----------------------------------------------------------------------------------
-    # Adds to database the metadata from one hdf5 file.
-    # This will create the entry for the file in the Files table and calls read_keys to descend the hierarchy
+    # Extracts the metadata from one hdf5 file into a File_record.
+    # This creates the file entry and calls read_keys to descend the hierarchy
     # to read any coordinates and variables
     # returns:
-    #    ok=True/False - indicates whether we could read the file
+    #    record - File_record with record.ok=True/False indicating whether we could read the file
     #-----------------------------------------------------------------------------------
     def read_hdf5(self):
 
-        ok=False
+        record=File_record(self.this_dir, self.filename)
         filepath=get_filepath(self.this_dir.dirpath, self.filename)
 
         try:
             if Read_metadata_thread.verbose:
                 print(self.thread_name,' Read_metadata_thread.read_hdf5(): reading', filepath)
             group = h5py.File(filepath, 'r')
-            ok=True
+            record.ok=True
 
         except OSError as err:
             warnings.warn(self.thread_name+' Read_metadata_thread.read_hdf5(): Cannot read file {filename}, error={err}'.format(filename=filepath, err=err), UserWarning)
-            Read_metadata_thread.lock.acquire()
-            bad_files.append(filepath)
-            Read_metadata_thread.lock.release()
-            return False
+            return record
 
-        this_file=File_metadata(UNKNOWN_ID, self.this_dir.did, self.this_dir.dirpath, self.filename)
+        this_file=File_metadata(UNKNOWN_ID, self.this_dir.did, self.this_dir.dirpath, self.filename, self.file_stat, self.symlink)
         # get the global attributes
         atts = dict(group.attrs)
         this_file.global_attributes=[Attribute(attrname,atts.get(attrname).decode()) for attrname in atts]
-        this_fid=self.create_file_entry(this_file)
+        record.this_file=this_file
 
-        self.read_keys(this_fid, group)
+        self.read_keys(record, group)
+        group.close()
 
-        return ok
+        return record
+
+    #-----------------------------------------------------------------------------------
+    # extract the metadata from the file into a File_record according to ftype
+    #-----------------------------------------------------------------------------------
+    def read_file(self):
+        if Read_metadata_thread.ftype=='nc':
+            record=self.read_netcdf()
+        else:
+            record=self.read_hdf5()
+        return record
+
+    #-----------------------------------------------------------------------------------
+    # Register the metadata extracted from one file.
+    # This creates the entry for the file in the Files table, finds or creates the cids of the coords
+    # and matches the variables to existing variables (or creates new ones).
+    # Any variables will be held in the variables list but cannot be added to the database until we have read
+    # all files and set up all the cids and fids.
+    # If the file can't be registered nothing is written for it and it is added to bad_files.
+    # Only one file may be registered at a time, see undo_registration().
+    # inputs:
+    #    record - the File_record returned by read_file()
+    # returns:
+    #    ok=True/False - indicates whether we could read and register the file
+    #-----------------------------------------------------------------------------------
+    def register_record(self, record):
+        if record.ok==False:
+            with Read_metadata_thread.lock:
+                Read_metadata_thread.bad_files.append(get_filepath(record.this_dir.dirpath, record.filename))
+            return False
 
+        # the rows for the file are kept in rows and only given to the writer once the whole file has been
+        # registered, if it can't be then the shared data is put back so no part of the file is in the catalogue
+        rows=Row_buffer()
+        saved_states={}
+        matched_vids=[]
+        with Read_metadata_thread.lock:
+            nfiles=Read_metadata_thread.nfiles
+            ncoords=len(Read_metadata_thread.coords)
+            nvars=len(Read_metadata_thread.variables)
+        try:
+            this_fid=self.create_file_entry(record.this_file, rows)
+            this_cids=[self.create_or_find_matching_coord(this_coord, rows) for this_coord in record.coords]
+            for this_var, coord_ixes in zip(record.variables, record.var_coord_ixes):
+                cids=[this_cids[c] for c in coord_ixes]
+                if Read_metadata_thread.verbose:
+                    print(self.thread_name, ' Read_metadata_thread.register_record(): creating new variable to check if it exists', this_var.name, 'fid=',this_fid, 'cids=', cids, len(Read_metadata_thread.variables), 'existing vars')
+                this_var.add_cids_for_fid(this_fid, cids)
+                matched_vids.append(self.create_or_find_matching_variable(this_var, rows, saved_states))
+        except Exception as err:
+            filepath=get_filepath(record.this_dir.dirpath, record.filename)
+            warnings.warn(self.thread_name+' Read_metadata_thread.register_record(): Cannot register file {filename}, error={err}'.format(filename=filepath, err=err), UserWarning)
+            with Read_metadata_thread.lock:
+                Read_metadata_thread.undo_registration(nfiles, ncoords, nvars, saved_states)
+                Read_metadata_thread.bad_files.append(filepath)
+            return False
+
+        rows.write_to(Read_metadata_thread.writer)
+        Read_metadata_thread.writer.commit()
+        with Read_metadata_thread.lock:
+            Read_metadata_thread.changed_vids.update([vid for vid in matched_vids if vid>=0])
+        if Read_metadata_thread.journal!=None:
+            Read_metadata_thread.journal.file_completed(this_fid)
+
+        return True
 
     #-----------------------------------------------------------------------------------
     # function called on starting thread
@@ -429,8 +584,23 @@ class Read_metadata_thread(threading.Thread):
 
         self.thread_name=threading.current_thread().name
 
-        if Read_metadata_thread.ftype=='nc':
-            ok=self.read_netcdf()
-        else:
-            ok=self.read_hdf5()
+        record=self.read_file()
+        ok=self.register_record(record)
         return ok
+
+#-----------------------------------------------------------------------------------
+# Functions used when the files are read by a pool of worker processes rather than threads.
+# The worker only extracts the metadata into a File_record which is passed back to the parent
+# process where the ids are assigned and the database is written.
+#-----------------------------------------------------------------------------------
+# set up the shared settings in each worker process as these are not inherited when processes are spawned
+def init_worker(ftype, hdf5_coord_names, verbose):
+    Read_metadata_thread.set_ftype(ftype)
+    Read_metadata_thread.hdf5_coord_names=hdf5_coord_names
+    Read_metadata_thread.verbose=verbose
+
+# read one file in a worker process and return the File_record
+def extract_file_metadata(this_dir, filename, file_stat=None, symlink=''):
+    thr=Read_metadata_thread(this_dir, filename, file_stat, symlink)
+    thr.thread_name=multiprocessing.current_process().name+'_'+filename
+    return thr.read_file()
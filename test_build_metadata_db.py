@@ -56,10 +56,14 @@ def main():
 
     if db_exists==False:
         create_tables(Read_metadata_thread.cur, verbose=verbose)
+        create_staging_table(Read_metadata_thread.cur)
+        Read_metadata_thread.con.commit()
+    Read_metadata_thread.writer=Db_writer(dbname, verbose=Read_metadata_thread.verbose)
+    Read_metadata_thread.writer.start()
     this_dir=Directory(0,dirpath)
     Read_metadata_thread.lock.acquire()
-    this_dir.insert_into_database('parent',Read_metadata_thread.cur,Read_metadata_thread.verbose)
-    Read_metadata_thread.con.commit()
+    this_dir.insert_into_database('parent',Read_metadata_thread.writer,Read_metadata_thread.verbose)
+    Read_metadata_thread.writer.commit()
     Read_metadata_thread.lock.release()
         
     thr = Read_metadata_thread(this_dir,filename)
@@ -68,8 +72,13 @@ def main():
     thr.join()    
     # insert all the variables into the database    
     for this_var in Read_metadata_thread.variables:
-        this_var.insert_into_database('parent',Read_metadata_thread.cur,Read_metadata_thread.verbose)
+        this_var.insert_into_database('parent',Read_metadata_thread.writer,Read_metadata_thread.verbose)
     # commit the changes
+    Read_metadata_thread.writer.close()
+    compact_staged_links(Read_metadata_thread.cur, verbose)
+    create_indexes(Read_metadata_thread.cur, verbose)
+    create_text_index(Read_metadata_thread.cur, verbose)
+    create_directory_counts(Read_metadata_thread.cur, verbose)
     Read_metadata_thread.con.commit()
     Read_metadata_thread.con.close()
     
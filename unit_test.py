@@ -6,8 +6,15 @@
 #---------------------------------------------------------------
 import sys
 import os
+import re
+import subprocess
+import tempfile
+import shutil
+import warnings
 from db_functions import *
 from read_metadata_thread import *
+from build_metadata_db import is_excluded, crawl, get_build_settings
+from netCDF4 import Dataset
 import numpy as np
 import sqlite3
 import pdb
@@ -23,7 +30,7 @@ def test_coord_creation(thr):
     coord_time=Coord_metadata(UNKNOWN_ID, 'time', times, thr.thread_name)
     coord_time.add_attribute('units',t_units)
     coord_time.add_attribute('calendar','julian')
-    thr.create_or_find_matching_coord(coord_time)
+    thr.create_or_find_matching_coord(coord_time, thr.writer)
     assert(len(thr.coords)==1) # it has created a new coord
     thr.coords[0].print()
     assert(thr.coords[0].cid==0)
@@ -40,7 +47,7 @@ def test_coord_creation(thr):
     coord_time2=Coord_metadata(UNKNOWN_ID, 'time', times+24, thr.thread_name)
     coord_time2.add_attribute('units',t_units)
     coord_time2.add_attribute('calendar','julian')
-    thr.create_or_find_matching_coord(coord_time2)
+    thr.create_or_find_matching_coord(coord_time2, thr.writer)
     assert(len(thr.coords)==2) # it has created a new coord
     thr.coords[1].print()
     assert(thr.coords[1].cid==1)
@@ -56,7 +63,7 @@ def test_coord_creation(thr):
     # time coordinate no calendar, uniform times
     coord_time_no_calendar=Coord_metadata(UNKNOWN_ID, 'time', times, thr.thread_name)
     coord_time_no_calendar.add_attribute('units',t_units)
-    thr.create_or_find_matching_coord(coord_time_no_calendar)
+    thr.create_or_find_matching_coord(coord_time_no_calendar, thr.writer)
     assert(len(thr.coords)==3)
     thr.coords[2].print()
     assert(thr.coords[2].cid==2)
@@ -74,7 +81,7 @@ def test_coord_creation(thr):
     coord_time_non_uniform=Coord_metadata(UNKNOWN_ID, 'time', times2, thr.thread_name)
     coord_time_non_uniform.add_attribute('units',t_units)
     coord_time_non_uniform.add_attribute('calendar', 'gregorian')
-    thr.create_or_find_matching_coord(coord_time_non_uniform)
+    thr.create_or_find_matching_coord(coord_time_non_uniform, thr.writer)
     assert(len(thr.coords)==4)
     thr.coords[3].print()
     assert(thr.coords[3].cid==3)
@@ -91,7 +98,7 @@ def test_coord_creation(thr):
     data=np.asarray([1.0,2.0,3.0,4.0])
     masked_data= np.ma.masked_array(data, mask=[0, 0, 1, 0])
     coord_masked=Coord_metadata(UNKNOWN_ID, 'masked_data', masked_data, thr.thread_name)
-    thr.create_or_find_matching_coord(coord_masked)
+    thr.create_or_find_matching_coord(coord_masked, thr.writer)
     assert(len(thr.coords)==5)
     thr.coords[4].print()
     assert(thr.coords[4].cid==4)
@@ -107,7 +114,7 @@ def test_coord_creation(thr):
     data=np.arange(4)+3
     masked_data= np.ma.masked_array(data, mask=[0, 0, 1, 0])
     coord_masked2=Coord_metadata(UNKNOWN_ID, 'masked_data', masked_data, thr.thread_name)
-    thr.create_or_find_matching_coord(coord_masked2)
+    thr.create_or_find_matching_coord(coord_masked2, thr.writer)
     assert(len(thr.coords)==6)
     thr.coords[5].print()
     assert(thr.coords[5].cid==5)
@@ -121,15 +128,62 @@ def test_coord_creation(thr):
     no_values=[]
     coord_no_data=Coord_metadata(UNKNOWN_ID, 'coord_no_data', no_values, thr.thread_name)
     coord_no_data.add_attribute('dimension_attr','no values in this dimension')
-    thr.create_or_find_matching_coord(coord_no_data)
+    thr.create_or_find_matching_coord(coord_no_data, thr.writer)
     assert(len(thr.coords)==7)
     thr.coords[6].print()
     assert(thr.coords[6].cid==6)
     assert(thr.coords[6].nvals==0)
     print('coord_no_data passed\n')
     
-        
+
+# reading the coordinate values a few at a time should give the same result as reading them all at once
+def test_coord_chunks(thr):
+
+    print('--------------------------\nSummarising coordinates in chunks\n--------------------------')
+    regular=np.ma.masked_array(np.arange(10)*0.5, mask=[0,0,0,1,0,0,0,0,1,0])
+    irregular=np.asarray([1000,925,850,700,500,400,300,250,200,150,100], dtype=np.float32)
+    irregular_late=np.append(np.arange(10)*6.0, 100.0) # only irregular in the last chunk
+    integers=np.arange(7)*3
+    for coord_values in [regular, irregular, irregular_late, integers]:
+        Coord_metadata.chunk_size=1000000
+        coord_all=Coord_metadata(UNKNOWN_ID, 'chunks', coord_values, thr.thread_name)
+        Coord_metadata.chunk_size=3
+        coord_chunks=Coord_metadata(UNKNOWN_ID, 'chunks', coord_values, thr.thread_name)
+        Coord_metadata.chunk_size=1000000
+        assert(coord_chunks.nvals==coord_all.nvals)
+        assert(coord_chunks.min_val==coord_all.min_val)
+        assert(coord_chunks.max_val==coord_all.max_val)
+        assert(abs(coord_chunks.delta-coord_all.delta)<COORD_TOLERANCE)
+        assert(len(coord_chunks.values)==len(coord_all.values))
+        assert(np.all(coord_chunks.values==coord_all.values))
+    assert(Coord_metadata(UNKNOWN_ID, 'chunks', regular, thr.thread_name).delta==0.5)
+    assert(len(Coord_metadata(UNKNOWN_ID, 'chunks', irregular, thr.thread_name).values)==len(irregular))
+    print('coord chunks passed\n')
+
+def test_coord_fingerprint(thr):
+
+    print('--------------------------\nMatching coordinates by fingerprint\n--------------------------')
+    ncoords=len(thr.coords)
+    # same as coord_time but values differ by less than COORD_TOLERANCE and round to a different integer
+    times=np.asarray([0,24,48])+0.6*COORD_TOLERANCE
+    coord_time=Coord_metadata(UNKNOWN_ID, 'time', times, thr.thread_name)
+    coord_time.add_attribute('calendar','julian')
+    coord_time.add_attribute('units','hours since 2000-01-01')
+    assert(Coord_metadata.quantise(coord_time.min_val)!=Coord_metadata.quantise(thr.coords[0].min_val))
+    cid=thr.create_or_find_matching_coord(coord_time, thr.writer)
+    assert(cid==0)
+    assert(len(thr.coords)==ncoords) # no new coord
+    print('coord_time with attributes in different order matches cid', cid)
+
+    # same values but different attribute value does not match
+    coord_time=Coord_metadata(UNKNOWN_ID, 'time', times, thr.thread_name)
+    coord_time.add_attribute('units','hours since 2000-01-01')
+    coord_time.add_attribute('calendar','noleap')
+    assert(coord_time.get_fingerprint()[2]!=thr.coords[0].get_fingerprint()[2])
+    print('coord_time with different calendar has different fingerprint\n')
+
 def test_coords_from_database(thr):
+    thr.writer.flush() # make sure all the coords have been written
     res=select_all_coords(thr.cur)
     assert(len(res)==len(thr.coords))
     cid=0
@@ -149,8 +203,29 @@ def test_coords_from_database(thr):
             assert(np.isfinite(thr.coords[cid].min_val)==False)
         if len(coord.values)>0:
             assert(np.any(abs(np.asarray(coord.values)-np.asarray(thr.coords[cid].values))<1e-6))
+        # the epoch range of time coords is stored so it doesn't have to be worked out again
+        is_time, calendar=coord.is_time()
+        if is_time and coord.nvals>0:
+            assert(coord.min_max_delta!=None)
+            assert(np.allclose(coord.get_min_max_delta(), thr.coords[cid].get_min_max_delta()))
         print('coord', coord.cid, coord.name, this_str, coord.values, 'matches created')
         cid+=1
+    # reading them all at once, either as Coord_metadata or into columns, should give the same coords
+    bulk_coords=read_coords_in_bulk(thr.cur)
+    coord_columns=Coord_columns(thr.cur)
+    assert(len(bulk_coords)==len(res) and len(coord_columns)==len(res))
+    for row, bulk_coord in zip(res, bulk_coords):
+        coord=Coord_metadata(row, thr.cur)
+        assert(coord_columns.get_name(coord.cid)==coord.name)
+        column_coord=coord_columns[coord.cid]
+        assert(np.array_equal(np.asarray(column_coord.values), np.asarray(coord.values)))
+        assert([(att.name, att.value) for att in column_coord.attributes]==[(att.name, att.value) for att in coord.attributes])
+        assert(column_coord.get_min_max_delta_str()==coord.get_min_max_delta_str())
+        assert(bulk_coord.cid==coord.cid and bulk_coord.name==coord.name and bulk_coord.nvals==coord.nvals)
+        assert(np.array_equal(np.asarray(bulk_coord.values), np.asarray(coord.values)))
+        assert([(att.name, att.value) for att in bulk_coord.attributes]==[(att.name, att.value) for att in coord.attributes])
+        assert(bulk_coord.get_min_max_delta_str()==coord.get_min_max_delta_str())
+    print(len(bulk_coords), 'coords read in bulk match')
         
 def test_variable_creation(thr):
 
@@ -162,7 +237,7 @@ def test_variable_creation(thr):
     this_var.attributes=[Attribute('long_name','one_dimensional_variable')]
     cids=[0] # a time dimension
     this_var.add_cids_for_fid(0, cids)
-    thr.create_or_find_matching_variable(this_var)
+    thr.create_or_find_matching_variable(this_var, thr.writer, {})
     nvars+=1
     assert(len(thr.variables)==nvars)
     thr.variables[nvars-1].print()
@@ -171,7 +246,7 @@ def test_variable_creation(thr):
     assert(len(thr.variables[nvars-1].cids)==1)
     assert(len(thr.variables[nvars-1].cids[0])==1)
     assert(thr.variables[nvars-1].cids[0][0]==0)
-    assert(thr.variables[nvars-1].fids[0]==0)
+    assert(thr.variables[nvars-1].get_nfiles()==1)
     print('one_d variable passed\n')
     
     # create a 2d variable
@@ -179,7 +254,7 @@ def test_variable_creation(thr):
     this_var.attributes=[Attribute('long_name','two_dimensional_variable')]
     cids=[0,4] # a time for first dimension and masked data coord for 2nd dimension
     this_var.add_cids_for_fid(1, cids)
-    thr.create_or_find_matching_variable(this_var)
+    thr.create_or_find_matching_variable(this_var, thr.writer, {})
     nvars+=1
     assert(len(thr.variables)==nvars)   # its created a new variable
     thr.variables[nvars-1].print()
@@ -190,7 +265,7 @@ def test_variable_creation(thr):
     assert(thr.variables[nvars-1].cids[0][0]==0)
     assert(len(thr.variables[nvars-1].cids[1])==1)
     assert(thr.variables[nvars-1].cids[1][0]==4)
-    assert(thr.variables[nvars-1].fids[0]==1)
+    assert(thr.variables[nvars-1].get_nfiles()==1)
     print('two_d variable passed\n')
 
     # a matching 2d variable with a different fid and time dim
@@ -198,20 +273,19 @@ def test_variable_creation(thr):
     this_var.attributes=[Attribute('long_name','two_dimensional_variable')]
     cids=[1,4] # a time dimension of same units and calendar but different times for first dimension and masked data coord for 2nd dimension
     this_var.add_cids_for_fid(0, cids)
-    thr.create_or_find_matching_variable(this_var) # this should match the variable to the one above
+    thr.create_or_find_matching_variable(this_var, thr.writer, {}) # this should match the variable to the one above
     assert(len(thr.variables)==nvars) # no new variable created
     thr.variables[nvars-1].print()
     assert(thr.variables[nvars-1].ndims==2)
-    assert(len(thr.variables[nvars-1].fids)==2)
-    assert(thr.variables[nvars-1].fids[0]==1)
-    assert(thr.variables[nvars-1].fids[1]==0)
+    assert(thr.variables[nvars-1].get_nfiles()==2)
+    assert(thr.variables[nvars-1].multi_dim==0)
+    # only the different cids are kept for each dimension
     assert(len(thr.variables[nvars-1].cids)==2)
     assert(len(thr.variables[nvars-1].cids[0])==2)
     assert(thr.variables[nvars-1].cids[0][0]==0)
     assert(thr.variables[nvars-1].cids[0][1]==1)
-    assert(len(thr.variables[nvars-1].cids[1])==2)
+    assert(len(thr.variables[nvars-1].cids[1])==1)
     assert(thr.variables[nvars-1].cids[1][0]==4)
-    assert(thr.variables[nvars-1].cids[1][1]==4)
     print('two_d variable passed\n')
     
     # another 2d variable that looks much the same but has a different type of time coord 
@@ -219,14 +293,13 @@ def test_variable_creation(thr):
     this_var.attributes=[Attribute('long_name','two_dimensional_variable')]
     cids=[2,4] # a time dimension with different calendar for first dimension and masked data coord for 2nd dimension
     this_var.add_cids_for_fid(2, cids)
-    thr.create_or_find_matching_variable(this_var)
+    thr.create_or_find_matching_variable(this_var, thr.writer, {})
     nvars+=1
     assert(len(thr.variables)==nvars) # a new variable created
     thr.variables[nvars-1].print()
     assert(thr.variables[nvars-1].vid==nvars-1)
     assert(thr.variables[nvars-1].ndims==2)
-    assert(len(thr.variables[nvars-1].fids)==1)
-    assert(thr.variables[nvars-1].fids[0]==2)
+    assert(thr.variables[nvars-1].get_nfiles()==1)
     assert(len(thr.variables[nvars-1].cids)==2)
     assert(len(thr.variables[nvars-1].cids[0])==1)
     assert(thr.variables[nvars-1].cids[0][0]==2)
@@ -238,7 +311,7 @@ def test_variable_creation(thr):
     this_var.attributes=[Attribute('long_name','two_dimensional_variable')]
     cids=[1,5] # a time dimension of same units and calendar as first variable but different times for first dimension and different masked data coord for 2nd dimension
     this_var.add_cids_for_fid(2, cids)
-    thr.create_or_find_matching_variable(this_var) # this should not match to the 1st variable
+    thr.create_or_find_matching_variable(this_var, thr.writer, {}) # this should not match to the 1st variable
     nvars+=1
     assert(len(thr.variables)==nvars) # a new variable created
     assert(thr.variables[nvars-1].vid==nvars-1)
@@ -250,24 +323,40 @@ def test_variable_creation(thr):
     this_var.attributes=[Attribute('long_name','zero_dimensional_variable')]
     cids=[] # no cid
     this_var.add_cids_for_fid(0, cids)
-    thr.create_or_find_matching_variable(this_var)
+    thr.create_or_find_matching_variable(this_var, thr.writer, {})
     nvars+=1
     assert(len(thr.variables)==nvars) # a new variable created
     thr.variables[nvars-1].print()
     assert(thr.variables[nvars-1].vid==nvars-1)
     assert(thr.variables[nvars-1].ndims==0)
-    assert(len(thr.variables[nvars-1].fids)==1)
-    assert(thr.variables[nvars-1].fids[0]==0)
+    assert(thr.variables[nvars-1].get_nfiles()==1)
     assert(len(thr.variables[nvars-1].cids)==0)
     print('zero_d variable passed\n')
 
+    # the two_d variables that did not match are all in the same bucket
+    assert(thr.variable_index[thr.variables[1].get_bucket_key()]==[1,2,3])
+    this_var=Variable_metadata(UNKNOWN_ID,'two_d',2)
+    this_var.attributes=[Attribute('long_name','two_dimensional_variable'), Attribute('units','K')]
+    assert(this_var.get_bucket_key() not in thr.variable_index)
+    print('variable buckets passed\n')
+
+    # the links are in the staging table in the order the files were added
+    thr.writer.flush()
+    staged={}
+    for vid, fid, dimix, cid in thr.cur.execute("""SELECT vid, fid, dimix, cid FROM Staged_Links ORDER BY rowid""").fetchall():
+        staged.setdefault(vid, {}).setdefault(fid, []).append(cid)
+    assert(staged[1]=={1:[0,4], 0:[1,4]})
+    assert(staged[4]=={0:[-1]})
+    print('staged links passed\n')
+
     for this_var in thr.variables:
         this_var.insert_into_database(thr.thread_name, thr.cur, thr.verbose)
-    
+    compact_staged_links(thr.cur, thr.verbose)
     thr.con.commit()
+    return staged
 
     
-def test_variables_from_database(thr):
+def test_variables_from_database(thr, staged):
     res=select_all_variables(thr.cur)
     assert(len(res)==len(thr.variables))
     vid=0
@@ -283,12 +372,430 @@ def test_variables_from_database(thr):
         assert(this_var.name==thr.variables[r].name)
         assert(this_var.ndims==thr.variables[r].ndims)
         assert(this_var.get_nfiles()==thr.variables[r].get_nfiles())
-        assert(np.all((this_var.fids-thr.variables[r].fids)==0))
+        # the fids are written in order
+        expected_fids=sorted(staged[this_var.vid])
+        assert(np.all((this_var.fids-np.asarray(expected_fids))==0))
         for d in range(this_var.ndims):
-            assert(np.all((this_var.get_cids_for_dim(d)-thr.variables[r].get_cids_for_dim(d))==0))
+            expected_cids=np.asarray([staged[this_var.vid][fid][d] for fid in expected_fids])
+            if d!=this_var.multi_dim:
+                expected_cids=np.unique(expected_cids)
+            assert(np.all((this_var.get_cids_for_dim(d)-expected_cids)==0))
         print(f'variable {r} {thr.variables[r].name} in database matches expected\n')
         r+=1
 
+# reading the variables in bulk should give the same variables as reading them one at a time
+def test_variables_in_bulk(thr):
+    print('--------------------------\nReading variables from database in bulk\n--------------------------')
+    res=select_all_variables(thr.cur, True)
+    bulk_vars=read_variables_in_bulk(thr.cur, res)
+    assert(len(bulk_vars)==len(res))
+    for row, bulk_var in zip(res, bulk_vars):
+        this_var=Variable_metadata(row, thr.cur, False)
+        assert(bulk_var.vid==this_var.vid and bulk_var.name==this_var.name and bulk_var.ndims==this_var.ndims)
+        assert(bulk_var.multi_dim==this_var.multi_dim)
+        assert(np.array_equal(bulk_var.fids, this_var.fids))
+        assert(np.array_equal(bulk_var.cids, this_var.cids))
+        assert([(att.name, att.value) for att in bulk_var.attributes]==[(att.name, att.value) for att in this_var.attributes])
+    # and for just some of the variables
+    res=select_variables_by_name(res[0][1], thr.cur)
+    assert([this_var.vid for this_var in read_variables_in_bulk(thr.cur, res)]==[row[0] for row in res])
+    # the names starting with a prefix should come out in order a page at a time
+    names=sorted(set(row[1] for row in select_all_variables(thr.cur)))
+    assert(select_variable_names(thr.cur, limit=1)+select_variable_names(thr.cur, after=names[0])==names)
+    prefix=names[-1][:2]
+    assert(select_variable_names(thr.cur, prefix)==[name for name in names if name.startswith(prefix)])
+    assert(select_variable_names(thr.cur, 'no_variable_has_this')==[])
+    print(f'{len(bulk_vars)} variables read in bulk as expected\n')
+
+# selecting the valid variables with one query should give the same files as checking each variable
+def test_select_valid_variables(thr, staged):
+    print('--------------------------\nSelecting valid variables from database\n--------------------------')
+    fids=sorted(set(fid for vid in staged for fid in staged[vid]))
+    thr.cur.executemany("""INSERT INTO Files (fid, did, filename) VALUES (?,?,?)""", [(fid, fid%2, f'file{fid}.nc') for fid in fids])
+    coords=read_coords_in_bulk(thr.cur)
+    variables=read_variables_in_bulk(thr.cur, select_all_variables(thr.cur))
+    # without any filters every file of every variable is valid
+    valid=select_valid_variables(thr.cur, -1, '', [])
+    assert([vid for vid, in_range, valid_fids in valid]==sorted(staged.keys()))
+    for vid, in_range, valid_fids in valid:
+        assert(in_range and valid_fids.tolist()==sorted(staged[vid]))
+    # searching a block of variables at a time should find the same
+    vids=sorted(staged.keys())
+    blocks=select_valid_variables(thr.cur, -1, '', [], vids=vids[:2])+select_valid_variables(thr.cur, -1, '', [], vids=vids[2:])
+    assert([(vid, in_range, valid_fids.tolist()) for vid, in_range, valid_fids in blocks]==
+           [(vid, in_range, valid_fids.tolist()) for vid, in_range, valid_fids in valid])
+    # a filter on the range of the first coordinate in the files of directory 1
+    coord_filter=Coord_filter(coords[0].name)
+    coord_filter.min_val, coord_filter.max_val, delta=coords[0].get_min_max_delta()
+    dir_fids=[fid for fid in fids if fid%2==1]
+    files=Files_metadata()
+    files.read_from_database(thr.cur, 1, '.nc')
+    assert(files.get_fids_for_matching_did(1)==dir_fids)
+    assert(np.where(files.get_fid_mask())[0].tolist()==dir_fids)
+    assert(files.get_matching_fid(dir_fids[-1]).fid==dir_fids[-1] and files.get_matching_fid(dir_fids[-1]+1)==None)
+    valid={vid:valid_fids.tolist() for vid, in_range, valid_fids in select_valid_variables(thr.cur, 1, '.nc', [coord_filter]) if in_range}
+    for this_var in variables:
+        # the fids can be given as a list or as a mask indexed by fid
+        assert(this_var.check_fids_and_filters(dir_fids, [coord_filter], coords)==this_var.check_fids_and_filters(files.get_fid_mask(), [coord_filter], coords))
+        coords_in_range, nactive_files=this_var.check_fids_and_filters(dir_fids, [coord_filter], coords)
+        if coords_in_range and nactive_files>0:
+            assert(valid[this_var.vid]==sorted(np.asarray(this_var.fids)[this_var.allowed_fids==1].tolist()))
+        else:
+            assert(this_var.vid not in valid)
+    # filenames can be matched as part of the name, with a glob pattern or with a regular expression
+    patterns={'.nc':lambda name: True, 'file[02]*':lambda name: name[4] in '02',
+              r'^file(1|2)\.nc$':lambda name: name in ['file1.nc', 'file2.nc']}
+    for filename_exp, matches in patterns.items():
+        match_fids=[fid for fid in fids if matches(f'file{fid}.nc')]
+        files.read_from_database(thr.cur, -1, filename_exp)
+        assert(files.get_fids()==match_fids and files.is_same_search(-1, filename_exp))
+        for vid, in_range, valid_fids in select_valid_variables(thr.cur, -1, filename_exp, []):
+            assert(valid_fids.tolist()==[fid for fid in sorted(staged[vid]) if fid in match_fids])
+    # the counts for the Directory menu are the files of each directory and the variables in them
+    thr.cur.executemany("""INSERT INTO Directories (did, dirpath) VALUES (?,?)""", [(0, '/data/even'), (1, '/data/odd')])
+    assert(read_directory_counts(thr.cur)=={0:(len(fids)-len(dir_fids), None), 1:(len(dir_fids), None)})
+    create_directory_counts(thr.cur)
+    for did in [0, 1]:
+        dir_vids=[vid for vid in staged if any(fid%2==did for fid in staged[vid])]
+        assert(read_directory_counts(thr.cur)[did]==(len([fid for fid in fids if fid%2==did]), len(dir_vids)))
+    thr.cur.execute("""DROP TABLE Directory_Counts""")
+    # a federated search of two copies of the database should find the same in both of them with one query
+    thr.con.commit()
+    fed=Federated_catalogue(['unit_test.db', 'unit_test.db'])
+    fed.attach_batch(fed.batches[0])
+    names=fed.select_variable_names()
+    assert(names==sorted(set(this_var.name for this_var in variables)))
+    expected=[(vid, in_range, valid_fids.tolist()) for vid, in_range, valid_fids in select_valid_variables(thr.cur, 1, '.nc', [coord_filter])]
+    found=[(dbix, vid, in_range, valid_fids.tolist()) for dbix, vid, in_range, valid_fids in fed.select_valid_variables('/data/odd', '.nc', [coord_filter], names)]
+    assert(found==[(0,)+valid for valid in expected]+[(1,)+valid for valid in expected])
+    fed.close()
+    thr.cur.execute("""DELETE FROM Directories""")
+    thr.cur.execute("""DELETE FROM Files""")
+    thr.con.commit()
+    print(f'{len(valid)} valid variables selected as expected\n')
+
+# searching the full-text index of the attributes should find the same variables as searching with LIKE
+def test_attribute_text_search(thr):
+    print('--------------------------\nSearching attribute text\n--------------------------')
+    assert(create_text_index(thr.cur))
+    thr.con.commit()
+    # julian is the calendar of some coords so finds the variables with those coords
+    texts=['dimensional', 'two dimensional', 'zero_dimensional_variable', 'julian']
+    for text in texts:
+        text_vids, text_fids=search_attribute_text(thr.cur, text)
+        assert(len(text_vids)>0)
+        thr.cur.execute("""ALTER TABLE Attribute_Text RENAME TO Saved_Attribute_Text""")
+        like_vids, like_fids=search_attribute_text(thr.cur, text)
+        thr.cur.execute("""ALTER TABLE Saved_Attribute_Text RENAME TO Attribute_Text""")
+        assert(sorted(text_vids)==sorted(like_vids) and sorted(text_fids)==sorted(like_fids))
+    assert(search_attribute_text(thr.cur, 'no_attribute_has_this')==([], []))
+    print(f'{len(texts)} texts found as expected\n')
+
+# a variable read from the database for updating should have the same cids as when it was created
+# and staging its links without one of its files should leave it with one file
+def test_variable_update(thr):
+    print('--------------------------\nUpdating variables from database\n--------------------------')
+    multi_vars=[this_var for this_var in thr.variables if this_var.multi_dim>=0]
+    assert(len(multi_vars)>0)
+    create_staging_table(thr.cur)
+    for expected in multi_vars:
+        this_var=Variable_metadata(select_variables_by_name(expected.name, thr.cur)[0], thr.cur, False)
+        last_fid=int(this_var.fids[-1])
+        this_var.prepare_for_update()
+        assert(this_var.get_nfiles()==expected.get_nfiles())
+        assert([sorted(cids) for cids in this_var.cids]==[sorted(cids) for cids in expected.cids])
+        assert(this_var.multi_dim==expected.multi_dim)
+        # stage the links without the last file
+        expand_links_to_staging(thr.cur, [this_var.vid], [last_fid])
+        summary=read_staged_links_summary(thr.cur)
+        nfids, dim_cids=summary[this_var.vid]
+        this_var.set_links_summary(nfids, [dim_cids[d] for d in range(this_var.ndims)])
+        assert(this_var.get_nfiles()==expected.get_nfiles()-1)
+        assert(this_var.multi_dim==-1)
+        thr.cur.execute("""DELETE FROM Staged_Links""")
+        print(f'variable {this_var.name} updated as expected\n')
+    thr.cur.execute("""DROP TABLE Staged_Links""")
+
+def test_build_journal(thr):
+    print('--------------------------\nCheckpointing a build\n--------------------------')
+    settings={'basedir':'/data', 'ftype':'nc'}
+    create_journal_tables(thr.cur, settings)
+    thr.con.commit()
+    journal=Build_journal(thr.writer, checkpoint_seconds=3600)
+    completed=[0, 1, 2]
+    for fid in completed:
+        journal.file_completed(fid)
+    # too soon for a checkpoint unless it is forced
+    journal.checkpoint(thr.variables)
+    assert(thr.cur.execute("""SELECT COUNT(*) FROM Build_Progress""").fetchone()[0]==0)
+    journal.checkpoint(thr.variables, force=True)
+    assert(read_journal_settings(thr.cur)==settings)
+    fids=[row[0] for row in thr.cur.execute("""SELECT fid FROM Build_Progress ORDER BY fid""").fetchall()]
+    assert(fids==completed)
+    saved=read_journal_variables(thr.cur)
+    assert(len(saved)==len(thr.variables))
+    for this_var, expected in zip(saved, thr.variables):
+        assert(this_var.vid==expected.vid and this_var.name==expected.name and this_var.ndims==expected.ndims)
+        assert([(att.name, str(att.value)) for att in this_var.attributes]==[(att.name, str(att.value)) for att in expected.attributes])
+    drop_journal_tables(thr.cur)
+    thr.con.commit()
+    print(f'{len(saved)} variables and {len(fids)} files checkpointed as expected\n')
+
+def test_register_rollback(thr):
+    print('--------------------------\nFailing to register a file\n--------------------------')
+    thr.writer.flush()
+    ncoords=thr.cur.execute("""SELECT COUNT(*) FROM Coords""").fetchone()[0]
+    nfiles=thr.nfiles
+    coord_index={key:list(cids) for key, cids in thr.coord_index.items()}
+    variable_index={key:list(vids) for key, vids in thr.variable_index.items()}
+    states=[this_var.get_state() for this_var in thr.variables]
+    record=File_record(Directory(0, script_dir), 'unit_test.py')
+    record.ok=True
+    record.this_file=File_metadata(UNKNOWN_ID, 0, script_dir, 'unit_test.py')
+    record.this_file.global_attributes=[Attribute('title', 'not registered')]
+    # a new time coord which the one_d variable is matched on before the zero_d variable fails
+    coord_time=Coord_metadata(UNKNOWN_ID, 'time', np.asarray([1000,1024,1048]), thr.thread_name)
+    coord_time.add_attribute('units','hours since 2000-01-01')
+    coord_time.add_attribute('calendar','julian')
+    c=record.add_coord(coord_time)
+    this_var=Variable_metadata(UNKNOWN_ID,'one_d',1)
+    this_var.attributes=[Attribute('long_name','one_dimensional_variable')]
+    record.add_variable(this_var, [c])
+    this_var=Variable_metadata(UNKNOWN_ID,'zero_d',0)
+    this_var.attributes=[Attribute('long_name','zero_dimensional_variable')]
+    record.add_variable(this_var, [c]) # too many dimensions so add_cids_for_fid() raises
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        assert(thr.register_record(record)==False)
+    assert(thr.bad_files[-1]==get_filepath(script_dir, 'unit_test.py'))
+    # nothing is left of the file
+    assert(thr.nfiles==nfiles)
+    assert(thr.coord_index==coord_index and thr.variable_index==variable_index)
+    assert([this_var.get_state() for this_var in thr.variables]==states)
+    thr.writer.flush()
+    assert(thr.cur.execute("""SELECT COUNT(*) FROM Coords""").fetchone()[0]==ncoords)
+    assert(thr.cur.execute("""SELECT COUNT(*) FROM Files""").fetchone()[0]==0)
+    assert(thr.cur.execute("""SELECT COUNT(*) FROM Global_Attributes""").fetchone()[0]==0)
+    print('file not registered as expected\n')
+
+
+#--------------------------------------------------------------
+# tests of building and merging whole databases from a small tree of netcdf files
+# build_metadata_db.py and merge_metadata_db.py are run as scripts as they set up the shared data of
+# Read_metadata_thread for themselves
+#--------------------------------------------------------------
+script_dir=os.path.dirname(os.path.abspath(__file__))
+
+# write a netcdf file with a time coordinate starting at start and the other coordinates in dims,
+# each variable of variables is (name, dimnames)
+def write_test_file(filepath, start, dims, variables):
+    data=Dataset(filepath, 'w', format='NETCDF4')
+    data.title='test file '+os.path.basename(filepath)
+    data.createDimension('time', 4)
+    time_var=data.createVariable('time', 'f8', ('time',))
+    time_var.units='days since 2000-01-01'
+    time_var.calendar='gregorian'
+    time_var[:]=np.arange(start, start+4)
+    for dimname, values in dims.items():
+        data.createDimension(dimname, len(values))
+        dim_var=data.createVariable(dimname, 'f4', (dimname,))
+        dim_var.units='degrees'
+        dim_var[:]=values
+    for varname, dimnames in variables:
+        this_var=data.createVariable(varname, 'f4', dimnames)
+        this_var.long_name=varname+' for testing'
+        this_var.units='K'
+    data.close()
+
+# make the tree of test files in basedir, with a symbolic link to a file, a broken link and a file
+# that is not a netcdf file in c and a scratch directory to exclude
+def make_test_tree(basedir):
+    for dirname in ['a', 'a/b', 'c', 'scratch']:
+        os.makedirs(basedir+'/'+dirname)
+    for f in range(3):
+        write_test_file(basedir+'/a/f'+str(f)+'.nc', f*4, {'lat':[10, 20, 30]}, [('temp', ('time', 'lat')), ('mask', ('lat',))])
+    for f in range(2):
+        write_test_file(basedir+'/a/b/g'+str(f)+'.nc', f*4, {'lon':[0, 90, 180, 270]}, [('wind', ('time', 'lon'))])
+    write_test_file(basedir+'/c/h0.nc', 100, {'lat':[10, 20, 30], 'lon':[0, 90, 180, 270]}, [('temp', ('time', 'lat')), ('height', ('lat', 'lon'))])
+    write_test_file(basedir+'/scratch/t0.nc', 200, {'lat':[40, 50]}, [('temp', ('time', 'lat'))])
+    os.symlink('../a/f0.nc', basedir+'/c/link.nc')
+    os.symlink('missing.nc', basedir+'/c/broken.nc')
+    with open(basedir+'/c/bad.nc', 'w') as bad_file:
+        bad_file.write('this is not a netcdf file\n')
+
+# run a script with args and check that it worked
+def run_script(args):
+    result=subprocess.run([sys.executable]+args, capture_output=True, text=True, timeout=300)
+    if result.returncode!=0:
+        print(result.stdout, result.stderr)
+    assert(result.returncode==0)
+    return result.stdout
+
+#--------------------------------------------------------------
+# read what is in a database in a form that does not depend on the order the files were read in
+# returns:
+#    dictionary of filepath to the symlink of each file, set of (filepath, name, value) of the global attributes
+#    and the list of (name, ndims, attributes, links) of the variables where links is the sorted list
+#    of (filepath, coords) for each file of the variable and coords are the name, nvals, min, max
+#    and attributes of the coord of each dimension
+#--------------------------------------------------------------
+def read_catalogue(dbname):
+    con=sqlite3.connect(dbname)
+    cur=con.cursor()
+    dirpaths=dict(cur.execute("""SELECT did, dirpath FROM Directories""").fetchall())
+    files={}
+    symlinks={}
+    for fid, did, filename, symlink in cur.execute("""SELECT fid, did, filename, symlink FROM Files""").fetchall():
+        files[fid]=get_filepath(dirpaths[did], filename)
+        symlinks[files[fid]]=symlink
+    global_attributes=set((files[fid], name, str(value)) for fid, name, value in cur.execute("""SELECT fid, name, value FROM Global_Attributes""").fetchall())
+    coords={}
+    for cid, name, nvals, min_val, max_val in cur.execute("""SELECT cid, name, nvals, min_val, max_val FROM Coords""").fetchall():
+        attributes=sorted(cur.execute("""SELECT name, value FROM Coord_Attributes WHERE cid=?""", (cid,)).fetchall())
+        coords[cid]=(name, nvals, min_val, max_val, tuple(attributes))
+    variables=[]
+    for vid, name, ndims in cur.execute("""SELECT vid, name, ndims FROM Variables""").fetchall():
+        attributes=sorted(cur.execute("""SELECT name, value FROM Var_Attributes WHERE vid=?""", (vid,)).fetchall())
+        rows=cur.execute("""SELECT cid, fid, dimix FROM Coords_Fids_Of_Variables WHERE vid=?""", (vid,)).fetchall()
+        links=[]
+        for fid in sorted(set(row[1] for row in rows if row[1]>=0)):
+            # the fid=-1 rows are the dimensions with the same coord in all the files of the variable
+            file_coords=[coords[cid] for cid, link_fid, dimix in sorted(rows, key=lambda row: row[2]) if link_fid in [fid, -1]]
+            links.append((files[fid], tuple(file_coords)))
+        variables.append((name, ndims, tuple(attributes), tuple(sorted(links))))
+    con.close()
+    return symlinks, global_attributes, sorted(variables)
+
+# a tree built with threads and with worker processes should give the same database, the file that is
+# not a netcdf file and the broken link are left out and the link to a file is kept with its target
+def test_build_with_workers(basedir):
+    print('--------------------------\nBuilding with threads and worker processes\n--------------------------')
+    catalogues=[]
+    for nworkers in [0, 2]:
+        dbname=basedir+'/workers'+str(nworkers)+'.db'
+        options=['--workers', str(nworkers)] if nworkers>0 else []
+        run_script([script_dir+'/build_metadata_db.py', basedir, 'nc', dbname]+options)
+        catalogues.append(read_catalogue(dbname))
+        os.remove(dbname)
+    assert(catalogues[0]==catalogues[1])
+    symlinks, global_attributes, variables=catalogues[0]
+    assert(basedir+'/c/bad.nc' not in symlinks and basedir+'/c/broken.nc' not in symlinks)
+    assert(symlinks[basedir+'/c/link.nc']=='../a/f0.nc' and symlinks[basedir+'/a/f0.nc']=='')
+    assert(len(symlinks)==8)
+    print(f'{len(symlinks)} files and {len(variables)} variables the same with threads and worker processes\n')
+
+# the crawl should leave out the excluded directories and files and keep links to files, even broken ones
+def test_crawl(basedir):
+    print('--------------------------\nCrawling directories\n--------------------------')
+    Read_metadata_thread.set_ftype('nc')
+    # a directory pattern leaves out the whole directory
+    assert(is_excluded(basedir+'/scratch', ['*/scratch/*']) and is_excluded(basedir+'/scratch/t0.nc', ['*/scratch/*']))
+    assert(is_excluded(basedir+'/c/scratch.nc', ['*/scratch/*'])==False)
+    crawled={dirpath:files for dirpath, files in crawl(basedir, ['*/scratch/*'])}
+    assert(sorted(crawled)==[basedir, basedir+'/a', basedir+'/a/b', basedir+'/c'])
+    assert([filename for filename, file_stat, symlink in crawled[basedir+'/a']]==['f0.nc', 'f1.nc', 'f2.nc'])
+    c_files={filename:(file_stat, symlink) for filename, file_stat, symlink in crawled[basedir+'/c']}
+    assert(sorted(c_files)==['bad.nc', 'broken.nc', 'h0.nc', 'link.nc'])
+    # the stat of a link is the stat of the file it points to
+    assert(c_files['link.nc'][1]=='../a/f0.nc' and c_files['link.nc'][0].st_size==os.stat(basedir+'/a/f0.nc').st_size)
+    assert(c_files['broken.nc']==(None, 'missing.nc'))
+    assert(c_files['h0.nc'][1]=='' and c_files['h0.nc'][0]!=None)
+    # a file pattern only leaves out the files
+    crawled={dirpath:files for dirpath, files in crawl(basedir, ['*/f1.nc'], nthreads=2)}
+    assert(basedir+'/scratch' in crawled)
+    assert([filename for filename, file_stat, symlink in crawled[basedir+'/a']]==['f0.nc', 'f2.nc'])
+    print(f'{len(crawled)} directories crawled as expected\n')
+
+# merging shards built from parts of the tree should give the same database as building the whole tree
+# and the files of a shard that are already merged are skipped
+def test_merge(basedir):
+    print('--------------------------\nMerging databases\n--------------------------')
+    full_name=basedir+'/full.db'
+    shard_names=[basedir+'/shard1.db', basedir+'/shard2.db']
+    merged_name=basedir+'/merged.db'
+    run_script([script_dir+'/build_metadata_db.py', basedir, 'nc', full_name])
+    run_script([script_dir+'/build_metadata_db.py', basedir, 'nc', shard_names[0], '--exclude', basedir+'/a/*'])
+    run_script([script_dir+'/build_metadata_db.py', basedir+'/a', 'nc', shard_names[1]])
+    full=read_catalogue(full_name)
+    # the first shard is everything except a, which is the second shard
+    assert(sorted(read_catalogue(shard_names[0])[0])==[basedir+'/c/h0.nc', basedir+'/c/link.nc', basedir+'/scratch/t0.nc'])
+    assert(len(read_catalogue(shard_names[1])[0])==5)
+    run_script([script_dir+'/merge_metadata_db.py', merged_name]+shard_names)
+    assert(read_catalogue(merged_name)==full)
+    os.remove(merged_name)
+    # the files of the full database are all in the shards so are skipped
+    output=run_script([script_dir+'/merge_metadata_db.py', merged_name]+shard_names+[full_name])
+    assert(output.count('skipping')==len(full[0]))
+    assert(read_catalogue(merged_name)==full)
+    os.remove(merged_name)
+    # a shard with an unfinished build is found before the merged database is made
+    con=sqlite3.connect(shard_names[1])
+    create_journal_tables(con.cursor(), {})
+    con.commit()
+    con.close()
+    result=subprocess.run([sys.executable, script_dir+'/merge_metadata_db.py', merged_name]+shard_names, capture_output=True, text=True, timeout=300)
+    assert(result.returncode!=0 and 'did not finish' in result.stderr and os.path.exists(merged_name)==False)
+    for dbname in shard_names+[full_name]:
+        os.remove(dbname)
+    print(f'{len(full[0])} files merged as expected\n')
+
+# an interrupted build can only be resumed with the same --exclude patterns
+def test_resume_settings(basedir):
+    print('--------------------------\nResuming with different settings\n--------------------------')
+    dbname=basedir+'/resume.db'
+    run_script([script_dir+'/build_metadata_db.py', basedir, 'nc', dbname, '--exclude', '*/scratch/*'])
+    # make it look like the build was interrupted
+    con=sqlite3.connect(dbname)
+    create_journal_tables(con.cursor(), get_build_settings(basedir, 'nc', ['*/scratch/*']))
+    con.commit()
+    nfiles=con.execute("""SELECT COUNT(*) FROM Files""").fetchone()[0]
+    con.close()
+    for excludes in [[], ['--exclude', '*/a/*'], ['--exclude', '*/scratch/*', '--exclude', '*/a/*']]:
+        stdout=run_script([script_dir+'/build_metadata_db.py', basedir, 'nc', dbname, '--resume']+excludes)
+        assert('cannot resume' in stdout)
+    con=sqlite3.connect(dbname)
+    assert(con.execute("""SELECT COUNT(*) FROM Files""").fetchone()[0]==nfiles)
+    con.close()
+    os.remove(dbname)
+    print('resume refused as expected\n')
+
+# read the counts from the summary printed by build_metadata_db.py -u
+def read_update_summary(stdout):
+    counts=re.search(r'(\d+) files added, (\d+) changed, (\d+) removed and (\d+) unchanged', stdout).groups()
+    bad_counts=re.search(r'(\d+) files could not be read, (\d+) of them', stdout).groups()
+    return [int(n) for n in counts+bad_counts]
+
+# updating a database after adding, changing and removing files should give the same catalogue as building
+# it again, and the summary should count a changed file that can no longer be read as a bad file
+def test_update(basedir):
+    print('--------------------------\nUpdating a database\n--------------------------')
+    update_dir=tempfile.mkdtemp(prefix='unit_test_update_')
+    try:
+        tree=update_dir+'/tree'
+        shutil.copytree(basedir, tree, symlinks=True)
+        dbname=update_dir+'/update.db'
+        run_script([script_dir+'/build_metadata_db.py', tree, 'nc', dbname])
+        write_test_file(tree+'/a/f3.nc', 12, {'lat':[10, 20, 30]}, [('temp', ('time', 'lat')), ('mask', ('lat',))])
+        write_test_file(tree+'/c/h0.nc', 300, {'lat':[10, 20, 30], 'lon':[0, 90, 180, 270]}, [('temp', ('time', 'lat')), ('height', ('lat', 'lon'))])
+        modified=os.stat(tree+'/c/h0.nc').st_mtime+10
+        os.utime(tree+'/c/h0.nc', (modified, modified))
+        with open(tree+'/a/f2.nc', 'w') as bad_file:
+            bad_file.write('this is no longer a netcdf file\n')
+        os.remove(tree+'/a/b/g1.nc')
+        # f3 added, h0 changed, g1 removed and f2 can't be read as well as bad.nc and broken.nc
+        stdout=run_script([script_dir+'/build_metadata_db.py', tree, 'nc', dbname, '-u'])
+        assert(read_update_summary(stdout)==[1, 1, 1, 5, 3, 1])
+        rebuilt_name=update_dir+'/rebuilt.db'
+        run_script([script_dir+'/build_metadata_db.py', tree, 'nc', rebuilt_name])
+        assert(read_catalogue(dbname)==read_catalogue(rebuilt_name))
+        # the files that can't be read are tried again but are not counted as added
+        stdout=run_script([script_dir+'/build_metadata_db.py', tree, 'nc', dbname, '-u'])
+        assert(read_update_summary(stdout)==[0, 0, 0, 7, 3, 0])
+        assert(read_catalogue(dbname)==read_catalogue(rebuilt_name))
+    finally:
+        shutil.rmtree(update_dir)
+    print('database updated as expected\n')
+
                                     
 def main():
 
@@ -312,14 +819,38 @@ def main():
 
     if db_exists==False:
         create_tables(Read_metadata_thread.cur, verbose=Read_metadata_thread.verbose)
+        create_staging_table(Read_metadata_thread.cur)
+        Read_metadata_thread.con.commit()
+    Read_metadata_thread.writer=Db_writer(dbname, commit_rows=5)
+    Read_metadata_thread.writer.start()
 
     thr = Read_metadata_thread("","")
     
     test_coord_creation(thr)
+    test_coord_chunks(thr)
+    test_coord_fingerprint(thr)
     test_coords_from_database(thr)      
-    test_variable_creation(thr)
-    test_variables_from_database(thr)      
+    staged=test_variable_creation(thr)
+    test_variables_from_database(thr, staged)      
+    test_variables_in_bulk(thr)
+    test_select_valid_variables(thr, staged)
+    test_attribute_text_search(thr)
+    test_variable_update(thr)
+    test_build_journal(thr)
+    test_register_rollback(thr)
+    thr.writer.close()
     thr.con.close()
+
+    basedir=tempfile.mkdtemp(prefix='unit_test_')
+    try:
+        make_test_tree(basedir)
+        test_build_with_workers(basedir)
+        test_crawl(basedir)
+        test_merge(basedir)
+        test_resume_settings(basedir)
+        test_update(basedir)
+    finally:
+        shutil.rmtree(basedir)
     print('PASSED')
     
 if __name__ == '__main__':